@@ -67,3 +67,16 @@ class DictFilter(ABC):
     def add_filter(self, f):
         """Add a filter object to the filter list."""
         self.filters.append(f)
+
+    def to_query(self, fields: dict):
+        """Translate the filter into an Elasticsearch query, so the database
+        only sends documents that may match.
+
+        The query must match every document `apply` keeps (it may match
+        more, `apply` still runs on what comes back). Return None when the
+        filter can't be translated safely.
+
+        Args:
+            fields (dict): mapping of every queryable field, by dotted path
+        """
+        return None
@@ -1,14 +1,19 @@
 # Open Elastic API
 import asyncio
-import csv
-import json
 import os
-from dataclasses import asdict, dataclass
+import time
 
 import aiohttp
 import prettytable
 import tqdm
 
+from elastic_api import core, export, mapping, passthrough, planner, profile, retry, timeouts
+
+# Exceptions of aiohttp for each kind of retryable failure (see `retry`)
+TIMEOUT_ERRORS = (asyncio.TimeoutError,)
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+
+
 class ElasticAPI(object):
     
     """This is the Async ELastic api (Woah!)
@@ -17,126 +22,188 @@ class ElasticAPI(object):
     """
 
     # BASIC OPTIONS
-    INDICES_URL = "/_cat/indices?format=json"
+    INDICES_URL = core.INDICES_URL
     SEARCH_SIZE = 5700
+    # Indices sampled or profiled at once, fewer under a memory budget
+    INDEX_CONCURRENCY = 16
 
-    @dataclass
-    class ElasticDatabase:
-        """
-        Elastic Database Information
-        """
-        name: str = ""
-        cluster_name: str = ""
-        cluster_uuid: str = ""
-        version_number: str = ""
-        build_flavor: str = ""
-        build_type: str = ""
-        build_hash: str = ""
-        build_date: str = ""
-        build_snapshot: bool = False
-        lucene_version: str = ""
-        minimum_wire_compatibility_version: str = ""
-        minimum_index_compatibility_version: str = ""
-        tagline: str = ""
-
-    @dataclass
-    class ElasticIndex:
-        """
-        Elastic Index Field Names
-        """
-        health: str
-        status: str
-        index: str
-        uuid: str
-        pri: str
-        rep: str
-        docs_count: str
-        docs_deleted: str
-        store_size: str
-        pri_store_size: str
-
-    def __init__(self, host, download_path=os.getcwd(), timeout=1, Filters=None, download=False):
+    ElasticDatabase = core.ElasticDatabase
+    ElasticIndex = core.ElasticIndex
+
+    def __init__(self, host, download_path=os.getcwd(), timeout=None, Filters=None,
+                 download=False, endpoints=None, max_file_size=None, max_docs_per_file=None,
+                 export_format='csv', passthrough=False, doc_filters=None, sample=None, profile=False,
+                 disk_full='trim', rtt=None, dedupe=None, memory_budget=None):
         self.host = host
+        # Other nodes of the same cluster, used to spread download slices
+        self.endpoints = list(endpoints) if endpoints else list()
+        # Connect timeout, adapting to the round trip time to the host when None
         self.timeout = timeout
+        self.timeouts = timeouts.Timeouts(timeout, rtt)
         self.download_path = download_path
         self.download = download
+        # Split exports into part files of at most this many bytes/documents
+        self.max_file_size = max_file_size
+        self.max_docs_per_file = max_docs_per_file
+        self.export_format = export_format
+        # Stream json exports to disk without decoding them (see `passthrough`)
+        self.passthrough = passthrough
+        # Save a random sample of this many documents per index instead of downloading
+        self.sample = sample
+        # Save a profile of every index instead of downloading (see `profile`)
+        self.profile = profile
+        # What to do when the filtered indices don't fit on disk (see `planner`)
+        self.disk_full = disk_full
 
         self.iselastic = None
         self.indices = list()
         self.index_schema = list() # List of Lists, where each list contains
         # the field names for each index
         self.Filters = Filters
+        # DictFilters that downloaded documents must pass
+        self.doc_filters = doc_filters
+        # dedupe.Deduplicator shared by every download of the run, if any
+        self.dedupe = dedupe
+        # utils.memory_budget.MemoryBudget capping the pages in flight across downloads
+        self.memory_budget = memory_budget
+        # Decoded `_mapping` responses by index, so an index mapping is fetched once
+        self.mappings = dict()
         self.ElasticDB = None
         self.filtered_indices = list()
-        
+        self.session = None
+        self.probe_rtt = None
+
         # Clean the hostname for folder naming purposes
         self.clean_host = self.host[7:-5]
 
+    def request_timeout(self, request_class, timeout=None):
+        """The timeout of a class of request (see `timeouts`), unless `timeout` is given
+
+        Returns:
+            aiohttp.ClientTimeout: connect, read and total limits
+        """
+        if timeout is not None:
+            return timeout
+        settings = self.timeouts.settings(request_class)
+        return aiohttp.ClientTimeout(total=settings.total, sock_connect=settings.connect,
+                                     sock_read=settings.read)
+
+    async def get_session(self):
+        """Return the shared client session for this host, creating it if needed.
+
+        Reusing one session keeps the connection to the host alive between
+        requests, so follow-up requests skip the TCP handshake.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        """Close the shared client session"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    is_root_response = staticmethod(core.is_root_response)
+    parse_db_info = staticmethod(core.parse_db_info)
+    get_total_hits = staticmethod(core.get_total_hits)
+
+    async def probe(self, fetch_indices=True):
+        """Probe the host with as few round trips as possible.
+
+        A single `GET /` both detects Elasticsearch and fills `ElasticDB`.
+        Only confirmed clusters go on to request their indices, which reuses
+        the same keep-alive connection.
+
+        Args:
+            fetch_indices (bool, optional): Also retrieve the indices. Defaults to True.
+
+        Returns:
+            bool: True if the host is an Elasticsearch database
+        """
+        try:
+            session = await self.get_session()
+            started = time.monotonic()
+            async with session.get(self.host,
+                                   timeout=self.request_timeout(timeouts.PROBE)) as response:
+                json_data = await response.json(content_type=None)
+            self.probe_rtt = time.monotonic() - started
+            self.timeouts.observe(self.probe_rtt)
+        except Exception:
+            json_data = None
+
+        self.iselastic = core.is_root_response(json_data)
+        if not self.iselastic:
+            return False
+
+        self.ElasticDB = core.parse_db_info(json_data)
+        if fetch_indices:
+            await self.get_db_indicies()
+        return True
+
     async def is_elastic(self):
         """Check if the Host is an elasticsearch database"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.host}/_cat", timeout=self.timeout) as response:
-                    rtext = await response.text()
-                    if "=^.^=" in rtext:
-                        self.iselastic = True
-                    else:
-                        self.iselastic = False
+            session = await self.get_session()
+            async with session.get(f"{self.host}/_cat",
+                                   timeout=self.request_timeout(timeouts.PROBE)) as response:
+                rtext = await response.text()
+                if "=^.^=" in rtext:
+                    self.iselastic = True
+                else:
+                    self.iselastic = False
         except Exception:
             self.iselastic = False
 
     async def get_db_info(self):
         """Retrieve the Elastic Database Information"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.host, timeout=self.timeout) as response:
-                    data = await response.text()
-                    json_data = json.loads(data)
-
-                    self.ElasticDB = ElasticAPI.ElasticDatabase(
-                    name=json_data.get("name", ""),
-                    cluster_name=json_data.get("cluster_name", ""),
-                    cluster_uuid=json_data.get("cluster_uuid", ""),
-                    version_number=json_data.get("version", {}).get("number", ""),
-                    build_flavor=json_data.get("version", {}).get("build_flavor", ""),
-                    build_type=json_data.get("version", {}).get("build_type", ""),
-                    build_hash=json_data.get("version", {}).get("build_hash", ""),
-                    build_date=json_data.get("version", {}).get("build_date", ""),
-                    build_snapshot=json_data.get("version", {}).get("build_snapshot", False),
-                    lucene_version=json_data.get("version", {}).get("lucene_version", ""),
-                    minimum_wire_compatibility_version=json_data.get(
-                        "version", {}).get("minimum_wire_compatibility_version", ""),
-                    minimum_index_compatibility_version=json_data.get(
-                        "version", {}).get("minimum_index_compatibility_version", ""),
-                    tagline=json_data.get("tagline", "")
-                )
+            session = await self.get_session()
+            async with session.get(self.host,
+                                   timeout=self.request_timeout(timeouts.PROBE)) as response:
+                json_data = await response.json(content_type=None)
+                self.ElasticDB = core.parse_db_info(json_data)
         except Exception as e:
             tqdm.tqdm.write(f"Error retrieving database information: {e}")
             return None
 
+    async def get_index_stats(self):
+        """Get the exact counts and sizes of every index with a single `_stats` request
+
+        Returns:
+            dict: core.IndexStats by index name, empty if `_stats` isn't available
+        """
+        try:
+            session = await self.get_session()
+            json_data = await self.send_search(session, self.host, core.stats_request(),
+                                               self.request_timeout(timeouts.METADATA),
+                                               retry.QUICK)
+            return core.parse_index_stats(json_data)
+        except Exception:
+            return {}
+
     async def get_db_indicies(self):
-        """Retrieve the elastic DB Indicies"""
+        """Retrieve the elastic DB Indicies
+
+        Only the `_cat/indices` columns the filters need are requested, and
+        the exact sizes come from one `_stats` request sent alongside.
+        """
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.host + ElasticAPI.INDICES_URL, 
-                                       timeout=self.timeout) as response:
-                    data = await response.text()
-                    json_data = json.loads(data)
-
-                    for index in json_data:
-                        elastic_index = ElasticAPI.ElasticIndex(
-                            health=index.get("health", ""),
-                            status=index.get("status", ""),
-                            index=index.get("index", ""),
-                            uuid=index.get("uuid", ""),
-                            pri=index.get("pri", ""),
-                            rep=index.get("rep", ""),
-                            docs_count=index.get("docs.count", ""),
-                            docs_deleted=index.get("docs.deleted", ""),
-                            store_size=index.get("store.size", ""),
-                            pri_store_size=index.get("pri.store.size", "")
-                        )
-                        self.indices.append(elastic_index)
+            session = await self.get_session()
+            json_data, stats = await asyncio.gather(
+                self.send_search(session, self.host,
+                                 core.indices_request(core.index_fields(self.Filters)),
+                                 self.request_timeout(timeouts.METADATA), retry.QUICK),
+                self.get_index_stats())
+            indices = core.parse_indices(json_data)
+            core.attach_index_stats(indices, stats)
+            self.indices.extend(indices)
 
         except Exception as e:
             tqdm.tqdm.write(f"Error retrieving database indicies from {self.host}: {e}")
@@ -146,92 +213,117 @@ class ElasticAPI(object):
 
     async def filter_db_indices(self):
         """Filter Database Indicies"""
-        if self.Filters is None:
-            self.filtered_indices = self.indices
-        if self.Filters is not None:
-            indices = self.indices
-            for Filter in self.Filters:
-                f_indices = Filter.apply(indices)
-                indices = f_indices
-            self.filtered_indices = indices
+        self.filtered_indices = core.apply_filters(self.indices, self.Filters)
+
+    @staticmethod
+    async def get_index_mapping(host, index, timeout):
+        """Get the decoded mapping of an Elasticsearch index"""
+        async with aiohttp.ClientSession() as session:
+            return await ElasticAPI.send_search(session, host, core.mapping_request(index),
+                                                timeout)
 
     @staticmethod
     async def get_fieldnames_from_index_mapping(host, index, timeout):
         """Get the fieldnames from an Elasticsearch index mapping"""
-        disallowed_types = ['alias', 'completion', 'aggregate_metric_double', 'dense_vector',
-                            'rank_feature', 'rank_features', 'properties']
-        mapping_url = f"{host}/{index}/_mapping"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(mapping_url, timeout=timeout) as mapping_request:
-                mapping_data = await mapping_request.json()
+        mapping_data = await ElasticAPI.get_index_mapping(host, index, timeout)
+        return core.fieldnames_from_mapping(mapping_data, index)
 
-                # Find the mapping for the index
-                index_mapping = mapping_data[index]['mappings']
+    async def get_mapping(self, host, index, timeout=None):
+        """Get the decoded mapping of an index, from the cache when it was fetched before"""
+        if index not in self.mappings:
+            session = await self.get_session()
+            self.mappings[index] = await self.send_search(
+                session, host, core.mapping_request(index),
+                self.request_timeout(timeouts.METADATA, timeout))
+        return self.mappings[index]
 
-                # Get the fieldnames from the mapping
-                fieldnames = []
-                for mapping in index_mapping.values():
-                    try:
-                        for fieldname, field_mapping in mapping.items():
-                            if mapping.get('properties', {}):
-                                properties = mapping.get('properties', {})
-                                for fieldname, field_mapping in properties.items():
-                                    if field_mapping.get('type'):
-                                        fieldnames.append(fieldname)
-                            elif field_mapping.get('type') not in disallowed_types:
-                                fieldnames.append(fieldname)
-                    except AttributeError as err:
-                        print(f"Failed to get index mapping for {host}: {err}")
-                        break
-                return fieldnames
+    async def get_filters_query(self, host, index, timeout, doc_filters, mapping_data=None):
+        """Translate document filters into a query for the index, using its mapping
+
+        Returns:
+            dict: the query, or None when no filter could be translated
+        """
+        if not doc_filters:
+            return None
+        if mapping_data is None:
+            mapping_data = await self.get_mapping(host, index, timeout)
+        fields = mapping.queryable_fields(mapping.mapping_properties(mapping_data, index))
+        return core.filters_query(doc_filters, fields)
 
     @staticmethod
-    async def fetch_scroll_id(session, host, index, timeout, scroll_time="720m", search_size=1000):
-        """Fetch a scroll ID
+    async def send_search(session, host, request, timeout, policy=retry.DEFAULT,
+                          on_body_bytes=None):
+        """Send a request built by the core and return the decoded response
+
+        Failures are retried following `policy` (see `retry`).
 
         Args:
             session (aiohttp.ClientSession()): session object
             host (str): host
-            index (str): Name of index to scroll
-            timeout (int): _description_
-            scroll_time (str, optional): How long to scroll. Defaults to "720m".
-            search_size (int, optional): How many records to return. Defaults to 1000.
+            request (core.SearchRequest): request to send
+            timeout (int): request timeout
+            policy (retry.RetryPolicy, optional): Defaults to retry.DEFAULT.
+            on_body_bytes (callable, optional): called with the size of the response body
+
+        Raises:
+            retry.HostUnavailable: If the host's circuit breaker is open.
 
         Returns:
-            str: scroll ID
+            dict: decoded response
         """
-        scroll_url = f"{host}/{index}/_search?scroll={scroll_time}&size={search_size}"
-        async with session.post(scroll_url, timeout=timeout) as scroll_request:
-            # Return the scroll Data
-            return await scroll_request.json()
+        attempts = retry.Attempts(policy, host, TIMEOUT_ERRORS, CONNECTION_ERRORS)
+        while True:
+            attempts.check()
+            try:
+                async with session.request(request.method, host + request.path,
+                                           params=request.params, json=request.body,
+                                           timeout=timeout) as search_request:
+                    retry.check_status(search_request.status, search_request.headers)
+                    body = await search_request.read()
+                    json_data = await search_request.json(content_type=None)
+            except Exception as ex:
+                await asyncio.sleep(attempts.failed(ex))
+            else:
+                attempts.succeeded()
+                if on_body_bytes is not None:
+                    on_body_bytes(len(body))
+                return json_data
 
     @staticmethod
-    async def fetch_scroll_data(session, host, timeout, scroll_id, scroll_time="720m", 
-                                retry_count=10, retry_delay=3):
-        """Fetch Data With the scroll API"""
-        fetch_url = f"{host}/_search/scroll?scroll={scroll_time}&scroll_id={scroll_id}"
-        for i in range(retry_count):
+    async def stream_search(session, host, request, timeout, on_sources,
+                            policy=retry.DEFAULT):
+        """Send a search request built by the core and stream the `_source` of
+        its hits to `on_sources` as they arrive, without decoding them.
+
+        Only sending the request is retried: once sources were handed over,
+        trying again would write them twice.
+
+        Returns:
+            core.Page: what the reader needs to continue
+        """
+        attempts = retry.Attempts(policy, host, TIMEOUT_ERRORS, CONNECTION_ERRORS)
+        while True:
+            attempts.check()
             try:
-                async with session.get(fetch_url, timeout=timeout) as scroll_request:
-                    scroll_data = await scroll_request.json()
-                    await asyncio.sleep(0) # To avoid payload not completed?
-                    # Find any hits in the data and return them
-                    hits = scroll_data["hits"]["hits"]
-                    # If we're not getting any hits, we're either getting ratelimited
-                    # Or our search size is too large
-                    # TODO: Implement Adaptive Search Size
-                    if not hits:
-                        return
-
-                    return hits
+                response = await session.request(request.method, host + request.path,
+                                                 params=request.params, json=request.body,
+                                                 timeout=timeout)
+                try:
+                    retry.check_status(response.status, response.headers)
+                except retry.StatusError:
+                    response.release()
+                    raise
             except Exception as ex:
-                # If we hit an exception, and the number of retries hasn't
-                # Exceeded retry_count, then try again in retry_delay seconds.
-                if i < retry_count - 1:
-                    await asyncio.sleep(retry_delay)
-                else:
-                    # If there's been too many retries, give up.
-                    raise ex
+                await asyncio.sleep(attempts.failed(ex))
+            else:
+                attempts.succeeded()
+                break
+
+        async with response:
+            stream = passthrough.SourceStream(on_sources)
+            async for chunk in response.content.iter_chunked(passthrough.CHUNK_SIZE):
+                stream.feed(chunk)
+            return stream.close()
 
     @staticmethod
     async def export_scroll_data(fetch_hits, data_file, writer,
@@ -240,120 +332,557 @@ class ElasticAPI(object):
 
         Args:
             fetch_hits (list): list of hits we fetched
-            data_file (fileobj): context handler to our output file
+            data_file (fileobj): binary output file
+            writer (export.ExportSink): sink returned by the previous page, or None
             fieldnames (list): fieldnames to export (optional)
             export_format (str): what fileformat to export in
-        """
-        # Iterate through the hits we fetched earlier
-        for fetch_hit in fetch_hits:
-            source = fetch_hit["_source"]
-            if fieldnames:
-                # If There are fieldnames only write the ones with the data we're
-                # Interested in
-                source = {key: value for key, value in
-                        source.items() if key in fieldnames}
-            if not writer:
-                if not fieldnames:
-                    fieldnames = source.keys()
-                if export_format == 'csv':
-                    writer = csv.DictWriter(data_file,
-                                            fieldnames=fieldnames)
-                    if writeheader is True:
-                        writer.writeheader()
-                else:
-                    writer = data_file
 
-            # Write the hit data to the file
-            if export_format == 'csv':
-                writer.writerow(source)
-            else:
-                writer.write(json.dumps(source).encode('utf8') + b'\n')
+        Returns:
+            export.ExportSink: the sink, to pass back in as `writer` with the next page
+        """
+        return export.export_hits(fetch_hits, data_file, fieldnames, export_format,
+                                  writeheader, sink=writer)
 
-    async def download_index(self, host, index, timeout, filename, download_path=os.getcwd(),
-                            folder_name=None, fieldnames=None, export_format='csv'):
-        """Download an index"""
-        async with aiohttp.ClientSession() as session:
-            scroll_data = await self.fetch_scroll_id(
-                session, host, index,timeout, scroll_time="720m", search_size=self.SEARCH_SIZE)
-            scroll_id = scroll_data["_scroll_id"]
+    async def send_cleanup(self, session, host, request, timeout):
+        """Send a cleanup request (freeing a scroll or point in time), best effort.
 
-            if export_format not in ['csv', 'json']:
-                raise ValueError(f"Invalid export format: {export_format}. \
-                                Supported formats are 'csv' and 'json'")
+        The request is shielded so it still goes out when the download is
+        being cancelled.
+        """
+        if request is None:
+            return
+        try:
+            await asyncio.shield(self.send_search(session, host, request, timeout,
+                                                  retry.ONCE))
+        except Exception as ex:
+            tqdm.tqdm.write(f"Failed to release search context on {host}: {ex}")
 
-            folder_path = os.path.join(download_path,
-                                    folder_name) if folder_name else download_path
-            os.makedirs(folder_path, exist_ok=True)
+    async def open_pit(self, session, host, index, timeout):
+        """Open a point in time on the index, if the database supports it
 
-            file_path = os.path.join(folder_path, f"{filename}.{export_format}")
+        Returns:
+            str: point in time ID, or None to fall back to scrolling
+        """
+        if not core.supports_pit(self.ElasticDB):
+            return None
+        try:
+            pit_data = await self.send_search(session, host, core.open_pit_request(index),
+                                              timeout, retry.ONCE)
+        except Exception:
+            return None
+        return pit_data.get("id")
 
-            if not fieldnames:
-                fieldnames = await ElasticAPI.get_fieldnames_from_index_mapping(
-                    host, index, timeout=timeout)
+    async def read_page(self, session, host, reader, request, timeout, on_body_bytes=None):
+        """Send a reader's request and feed it the response, returns the hits
 
+        When cancelled mid-request the response is still awaited and fed to
+        the reader, as it may carry a new scroll ID that has to be released.
+        """
+        search = asyncio.ensure_future(self.send_search(session, host, request, timeout,
+                                                        on_body_bytes=on_body_bytes))
+        try:
+            return reader.feed(await asyncio.shield(search))
+        except asyncio.CancelledError:
             try:
-                if isinstance(scroll_data["hits"]["total"], int):
-                    total_hits = scroll_data["hits"]["total"]
-                else:
-                    total_hits = scroll_data["hits"]["total"]["value"]
-            except TypeError:
-                total_hits = len(scroll_data["hits"]["hits"])
+                reader.feed(await search)
+            except Exception:
+                pass
+            raise
 
-            with open(file_path, 'w', encoding='utf8', newline="") as data_file:
-                with tqdm.tqdm(total=total_hits, desc="Downloading index") as pbar:
-                    writer=None
-                    accumulated_hits = 0
+    async def download_slice(self, session, host, reader, timeout, output, pbar,
+                             raw=False, doc_filters=None, fallback_hosts=()):
+        """Read an index (or one slice of it) and write the hits
 
-                    await self.export_scroll_data(
-                        scroll_data["hits"]["hits"],data_file, writer, fieldnames,export_format, writeheader=True)
-                    
-                    accumulated_hits += len(scroll_data["hits"]["hits"])
-                    
-                    pbar.update(len(scroll_data["hits"]["hits"]))
+        The reader's search context is released when the slice is done,
+        fails or gets cancelled.
 
-                    # Keep scrolling until there are no more results
-                    while accumulated_hits <= total_hits:
-                        # Retrieve the hits from the database
-                        hits = await self.fetch_scroll_data(session, host, timeout,
-                                                            scroll_id, scroll_time="720m")
+        When `host` fails (see `retry.host_failed`), the slice carries on
+        from the next of `fallback_hosts`, other nodes of the same cluster.
+        Search contexts belong to the cluster, so the reader continues
+        where it stopped. A page whose sources were partly streamed to the
+        output can't be read again without writing them twice, and fails
+        the slice.
 
-                        if not hits:
-                            break
+        Args:
+            session (aiohttp.ClientSession()): session object
+            host (str): host to read from
+            reader (core.ScrollReader or core.PitReader): reader for this slice
+            timeout (int): timeout of every request, None for the defaults of each class
+            output (export.RotatingOutput): writer for this slice
+            pbar (tqdm.tqdm): progress bar shared by every slice
+            raw (bool, optional): stream the sources to the output undecoded
+            doc_filters (list, optional): DictFilters the written documents must pass
+            fallback_hosts (list, optional): hosts to read from once `host` fails
+        """
+        # Sources of the current page streamed to the output so far
+        streamed = []
 
-                        # Write the hits to the file
-                        await self.export_scroll_data(hits, data_file,
-                                                        writer, fieldnames, export_format)
-                        # Update the progress bar
-                        pbar.update(len(hits))
+        def write_sources(sources):
+            streamed.append(len(sources))
+            output.write_sources(sources)
 
-                        # Update the accumulated hits
-                        accumulated_hits += len(hits)
+        search_timeout = self.request_timeout(timeouts.SEARCH, timeout)
+        try:
+            request = reader.next_request()
+            while request:
+                try:
+                    if raw:
+                        streamed.clear()
+                        page = await self.stream_search(session, host, request, search_timeout,
+                                                        write_sources)
+                        reader.feed_page(page)
+                        hit_count = page.hit_count
+                    else:
+                        hit_count = await self.download_page(session, host, reader, request,
+                                                             search_timeout, output,
+                                                             doc_filters)
+                except Exception as ex:
+                    if (not fallback_hosts or streamed
+                            or not retry.host_failed(ex, TIMEOUT_ERRORS, CONNECTION_ERRORS)):
+                        raise
+                    tqdm.tqdm.write(f"Reading the slice of {host} from {fallback_hosts[0]} "
+                                    f"instead: {ex}")
+                    host, fallback_hosts = fallback_hosts[0], fallback_hosts[1:]
+                    continue
+                if reader.accumulated_hits == hit_count:
+                    # First page of this slice, add its share to the total
+                    pbar.total += reader.total_hits
+                    pbar.refresh()
+
+                pbar.update(hit_count)
+                request = reader.next_request()
+        finally:
+            await self.send_cleanup(session, host, reader.close_request(),
+                                    self.request_timeout(timeouts.METADATA, timeout))
+
+    async def download_page(self, session, host, reader, request, timeout, output,
+                            doc_filters=None):
+        """Read a page of decoded hits within the memory budget and write them
 
-                        # Get the next Scroll ID
-                        scroll_id = scroll_data["_scroll_id"]
+        Returns:
+            int: hits in the page, before filtering and deduplication
+        """
+        # The estimate may change while the page is read, give back what was taken
+        page_bytes = 0
+        body_sizes = []
+        if self.memory_budget is not None:
+            page_bytes = await self.memory_budget.acquire_page(reader.search_size)
+        try:
+            hits = await self.read_page(session, host, reader, request, timeout,
+                                        body_sizes.append)
+            hit_count = len(hits)
+            if self.memory_budget is not None:
+                self.memory_budget.observe_page(sum(body_sizes), hit_count)
+            hits = core.apply_doc_filters(hits, doc_filters)
+            if self.dedupe is not None:
+                hits = self.dedupe.unique(hits)
+            output.skip(hit_count - len(hits))
+            output.write_hits(hits)
+        finally:
+            if self.memory_budget is not None:
+                self.memory_budget.release_page(page_bytes)
+        return hit_count
+
+    async def iter_index(self, index, fields=None, batch_size=None, host=None, endpoints=None,
+                         timeout=None, doc_filters=None):
+        """Stream the hits of an index a page at a time, without touching the disk
+
+        Pages come from the same point in time/scroll readers as
+        `download_index`, including slicing across `endpoints`. Slices read
+        at most one page ahead of the consumer, so a slow consumer slows
+        the download down instead of piling pages up in memory. The search
+        contexts are released when the iteration ends, fails or is closed
+        early:
+
+        ```
+        async with ElasticAPI("http://127.0.0.1:9200") as api:
+            async with contextlib.aclosing(api.iter_index("users", fields=["name"])) as batches:
+                async for batch in batches:
+                    process([hit["_source"] for hit in batch])
+        ```
 
-                print(f"Index downloaded and saved to {file_path}")
+        Args:
+            index (str): index to read
+            fields (list, optional): only return these `_source` fields
+            batch_size (int, optional): hits per page. Defaults to SEARCH_SIZE.
+            host (str, optional): host to read from. Defaults to this host.
+            endpoints (list, optional): other nodes of the cluster. Defaults to `endpoints`.
+            timeout (int, optional): timeout of every request. Defaults to the
+                timeout of each request class.
+            doc_filters (list, optional): DictFilters the hits must pass. Defaults to `doc_filters`.
+
+        Yields:
+            list: a page of hits
+        """
+        host = host or self.host
+        search_timeout = self.request_timeout(timeouts.SEARCH, timeout)
+        metadata_timeout = self.request_timeout(timeouts.METADATA, timeout)
+        batch_size = batch_size or self.SEARCH_SIZE
+        if endpoints is None:
+            endpoints = self.endpoints
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        if self.ElasticDB is None:
+            await self.probe(fetch_indices=False)
+        query = await self.get_filters_query(host, index, timeout, doc_filters)
+
+        hosts = [host] + [endpoint for endpoint in endpoints if endpoint != host]
+        session = await self.get_session()
+        # Room for one page per slice, a slice waits for the consumer once its page is queued
+        pages = asyncio.Queue(maxsize=len(hosts))
+        done = object()
+
+        async def read_slice(slice_host, reader):
+            try:
+                request = reader.next_request()
+                while request:
+                    hits = await self.read_page(session, slice_host, reader, request,
+                                                search_timeout)
+                    hits = core.apply_doc_filters(hits, doc_filters)
+                    if hits:
+                        await pages.put(hits)
+                    request = reader.next_request()
+            finally:
+                await self.send_cleanup(session, slice_host, reader.close_request(),
+                                        metadata_timeout)
+
+        async def read_slices(tasks):
+            try:
+                await asyncio.gather(*tasks)
+            except Exception as ex:
+                await pages.put(ex)
+            else:
+                await pages.put(done)
+
+        pit_id = await self.open_pit(session, host, index, metadata_timeout)
+        readers = [core.make_reader(index, pit_id, batch_size, slice_id, len(hosts), fields,
+                                    query)
+                   for slice_id in range(len(hosts))]
+        tasks = [asyncio.ensure_future(read_slice(slice_host, readers[slice_id]))
+                 for slice_id, slice_host in enumerate(hosts)]
+        supervisor = asyncio.ensure_future(read_slices(tasks))
+        try:
+            while True:
+                page = await pages.get()
+                if page is done:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            # Stop the slices (if the consumer stopped early) so each releases its context
+            for task in tasks + [supervisor]:
+                task.cancel()
+            await asyncio.gather(*tasks, supervisor, return_exceptions=True)
+            if pit_id:
+                for latest_pit_id in {reader.pit_id for reader in readers}:
+                    await self.send_cleanup(session, host,
+                                            core.close_pit_request(latest_pit_id),
+                                            metadata_timeout)
+
+    async def download_index(self, host, index, timeout, filename, download_path=os.getcwd(),
+                            folder_name=None, fieldnames=None, export_format='csv',
+                            endpoints=None, max_file_size=None, max_docs_per_file=None,
+                            passthrough=None, doc_filters=None):
+        """Download an index
+
+        Databases that support it are read from a point in time with
+        search_after, older ones with a short-lived scroll. Either way the
+        search context is released once the download ends, fails or gets
+        cancelled, instead of pinning the database's memory until it expires.
+
+        When more than one endpoint of the same cluster is given, the index
+        is split into one slice per endpoint so the transfer is spread
+        across the nodes instead of all going through `host`. Extra nodes
+        only add capacity: the slice of a node that fails is read from the
+        others.
+
+        With `max_file_size` (bytes) or `max_docs_per_file` the export is split
+        into numbered part files. Sliced downloads then write their parts
+        concurrently.
+
+        Every download writes `{filename}.manifest.json`, which lists the
+        parts with their checksums, and the documents expected and read, to
+        tell a complete download from a truncated one.
+
+        With `passthrough`, json exports without `fieldnames` copy every
+        `_source` to disk byte for byte as it streams in, instead of
+        decoding and re-encoding each page.
+
+        With a `memory_budget`, decoded pages wait for room in the budget
+        and are made smaller when a full page wouldn't fit.
+
+        Only documents that pass `doc_filters` are written. Filters that can
+        be expressed as a query are also sent to the database, so documents
+        that can't match are never transferred. With a `dedupe`, documents
+        written before in the run are dropped as well.
+
+        Every request uses `timeout` when given, otherwise the timeout of
+        its request class (see `timeouts`).
+        """
+        metadata_timeout = self.request_timeout(timeouts.METADATA, timeout)
+        max_file_size = max_file_size or self.max_file_size
+        max_docs_per_file = max_docs_per_file or self.max_docs_per_file
+        if passthrough is None:
+            passthrough = self.passthrough
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        export.check_export_format(export_format)
+        raw = (passthrough and export.sink_class(export_format).accepts_raw
+               and not fieldnames and not doc_filters and self.dedupe is None)
+
+        folder_path = os.path.join(download_path,
+                                folder_name) if folder_name else download_path
+        os.makedirs(folder_path, exist_ok=True)
+
+        mapping_data = None
+        if not fieldnames and not raw:
+            mapping_data = await self.get_mapping(host, index, metadata_timeout)
+            fieldnames = export.sink_class(export_format).fieldnames_from_mapping(mapping_data,
+                                                                                  index)
+        query = await self.get_filters_query(host, index, timeout, doc_filters, mapping_data)
+
+        hosts = [host] + [endpoint for endpoint in endpoints or [] if endpoint != host]
+        outputs = export.slice_outputs(folder_path, filename, export_format, fieldnames,
+                                       max_file_size, max_docs_per_file, len(hosts))
+        search_size = self.SEARCH_SIZE
+        if self.memory_budget is not None and not raw:
+            search_size = self.memory_budget.page_size(search_size)
+
+        async with aiohttp.ClientSession() as session:
+            pit_id = await self.open_pit(session, host, index, metadata_timeout)
+            readers = [core.make_reader(index, pit_id, search_size, slice_id, len(hosts),
+                                        query=query)
+                       for slice_id in range(len(hosts))]
+            try:
+                with tqdm.tqdm(total=0, desc="Downloading index") as pbar:
+                    # A slice whose node fails carries on from the others, the
+                    # representative first
+                    tasks = [asyncio.ensure_future(
+                        self.download_slice(session, slice_host, readers[slice_id], timeout,
+                                            outputs[slice_id], pbar, raw, doc_filters,
+                                            [other for other in hosts if other != slice_host]))
+                        for slice_id, slice_host in enumerate(hosts)]
+                    try:
+                        await asyncio.gather(*tasks)
+                    except BaseException:
+                        # Stop the other slices so each releases its search context
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        raise
+            finally:
+                outputs = export.close_outputs(outputs)
+                totals = core.read_totals(readers, outputs)
+                manifest_path = export.write_manifest(folder_path, filename, index,
+                                                      export_format, outputs, totals)
+                if pit_id:
+                    # Slices may have been handed a newer ID than the one we opened
+                    for latest_pit_id in {reader.pit_id for reader in readers}:
+                        await self.send_cleanup(session, host,
+                                                core.close_pit_request(latest_pit_id),
+                                                metadata_timeout)
+
+        file_path = manifest_path if outputs[0].sharded else outputs[0].paths[0]
+        if totals.complete:
+            print(f"Index downloaded and saved to {file_path}")
+        else:
+            problem = export.count_problem(totals.expected_docs, totals.read_docs,
+                                           totals.skipped_docs, totals.written_docs)
+            print(f"Index download incomplete: {problem or 'the download did not finish'}, "
+                  f"see {manifest_path}")
 
 
     async def download_index_single(self, index, fieldnames=None):
         """Download Filtered Indices"""
         print(f"Downloading {index}")
-        await self.download_index(self.host, index, self.timeout, index,
-                                  self.download_path, fieldnames=fieldnames)
+        await self.download_index(self.host, index, None, index,
+                                  self.download_path, fieldnames=fieldnames,
+                                  export_format=self.export_format,
+                                  endpoints=self.endpoints)
+
+    async def measure_throughput(self, host, index, timeout):
+        """Time one page of search results from the host
+
+        Returns:
+            float: bytes per second, or None if the page couldn't be read
+        """
+        request = planner.throughput_request(index)
+        try:
+            session = await self.get_session()
+            started = time.monotonic()
+            async with session.request(request.method, host + request.path,
+                                       params=request.params, json=request.body,
+                                       timeout=self.request_timeout(timeouts.SEARCH,
+                                                                    timeout)) as response:
+                body = await response.read()
+            return len(body) / max(time.monotonic() - started, 1e-3)
+        except Exception:
+            return None
+
+    async def plan_downloads(self):
+        """Check that the filtered indices fit in `download_path` and print the plan
+
+        Returns:
+            planner.DownloadPlan: the plan, whose space is reserved until released
+        """
+        largest = max(self.filtered_indices, key=planner.store_bytes, default=None)
+        throughput = None
+        if largest is not None:
+            throughput = await self.measure_throughput(self.host, largest.index, None)
+        plan = planner.plan_downloads(self.filtered_indices, self.download_path,
+                                      self.export_format, throughput, self.disk_full,
+                                      workers=1 + len(self.endpoints))
+        print(plan.table(self.host))
+        if not plan.fits and self.disk_full == "refuse":
+            print(f"Not downloading from {self.host}: the indices don't fit in "
+                  f"{self.download_path}")
+        elif not plan.fits and self.disk_full == "trim":
+            print(f"Skipping {len(self.filtered_indices) - len(plan.selected)} indices "
+                  f"from {self.host} that don't fit in {self.download_path}")
+        return plan
 
     async def download_indices(self):
-        """Download Filtered Indices"""
-        for Index in self.filtered_indices:
-            print(f"Downloading {Index.index}")
-            await self.download_index(self.host, Index.index, self.timeout,
-                                      Index.index, self.download_path)
+        """Download Filtered Indices, skipping those that don't fit on disk
+
+        An index that fails is reported and the others are still downloaded.
+
+        Returns:
+            list: whether each selected index was downloaded
+        """
+        plan = await self.plan_downloads()
+        downloaded = []
+        try:
+            for Index in plan.selected:
+                print(f"Downloading {Index.index}")
+                try:
+                    await self.download_index(self.host, Index.index, None,
+                                              Index.index, self.download_path,
+                                              export_format=self.export_format,
+                                              endpoints=self.endpoints)
+                    downloaded.append(True)
+                except Exception as ex:
+                    print(f"Failed to download {self.host}/{Index.index}: {ex}")
+                    downloaded.append(False)
+        finally:
+            plan.release()
+        return downloaded
+
+    async def sample_index(self, host, index, size, timeout, download_path=os.getcwd(),
+                           folder_name=None, doc_filters=None):
+        """Save a random sample of an index, with stats on its fields
+
+        The sample is read with a single search, so even a large fleet of
+        indices can be triaged in seconds before deciding what to download.
+
+        Returns:
+            str: path of the sample file
+        """
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        folder_path = os.path.join(download_path,
+                                   folder_name) if folder_name else download_path
+        session = await self.get_session()
+        query = await self.get_filters_query(host, index, timeout, doc_filters)
+        # The sample is a page like any other, it waits for room in the budget
+        page_bytes = 0
+        if self.memory_budget is not None:
+            page_bytes = await self.memory_budget.acquire_page(size)
+        try:
+            search_data = await self.send_search(session, host,
+                                                 core.sample_request(index, size, query=query),
+                                                 self.request_timeout(timeouts.SEARCH, timeout),
+                                                 retry.QUICK)
+            hits = core.apply_doc_filters(search_data["hits"]["hits"], doc_filters)
+            total_hits = core.get_total_hits(search_data)
+            file_path = export.write_sample(folder_path, index, index, hits, total_hits)
+        finally:
+            if self.memory_budget is not None:
+                self.memory_budget.release_page(page_bytes)
+        print(f"Sampled {len(hits)} of {total_hits} documents from {index} to {file_path}")
+        return file_path
+
+    async def for_each_index(self, work):
+        """Run `work(index)` for every filtered index, `INDEX_CONCURRENCY` at a
+        time, or `probe_limit` of the memory budget if that is lower
+
+        Returns:
+            list: the result of every index, in order
+        """
+        limit = self.INDEX_CONCURRENCY
+        if self.memory_budget is not None:
+            limit = min(limit, self.memory_budget.probe_limit)
+        results = [None] * len(self.filtered_indices)
+        # Shared by the workers, each takes the next index once it is done
+        pending = iter(enumerate(self.filtered_indices))
+
+        async def worker():
+            for position, Index in pending:
+                results[position] = await work(Index.index)
+
+        await asyncio.gather(*[worker() for _ in range(min(limit, len(results)))])
+        return results
+
+    async def sample_indices(self):
+        """Sample the filtered indices, a few at a time (see `for_each_index`)
+
+        Returns:
+            list: path of every sample file, or None for indices that failed
+        """
+        async def sample_or_report(index):
+            try:
+                return await self.sample_index(self.host, index, self.sample, None,
+                                               self.download_path)
+            except Exception as ex:
+                print(f"Failed to sample {self.host}/{index}: {ex}")
+                return None
+
+        return await self.for_each_index(sample_or_report)
+
+    async def profile_index(self, host, index, timeout, download_path=os.getcwd(),
+                            folder_name=None, doc_filters=None):
+        """Save a profile of an index, built from aggregations over its fields
+
+        Returns:
+            str: path of the profile file
+        """
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        folder_path = os.path.join(download_path,
+                                   folder_name) if folder_name else download_path
+        session = await self.get_session()
+        mapping_data = await self.get_mapping(host, index, timeout)
+        fields = profile.profile_fields(mapping.mapping_properties(mapping_data, index))
+        query = await self.get_filters_query(host, index, timeout, doc_filters, mapping_data)
+        search_timeout = self.request_timeout(timeouts.SEARCH, timeout)
+        responses = [await self.send_search(session, host, request, search_timeout, retry.QUICK)
+                     for request in profile.profile_requests(index, fields, query)]
+        total_docs, field_stats = profile.parse_profile(fields, responses)
+        file_path = export.write_profile(folder_path, index, index, total_docs, field_stats)
+        print(f"Profiled {len(fields)} fields of {index} to {file_path}")
+        return file_path
+
+    async def profile_indices(self):
+        """Profile the filtered indices, a few at a time (see `for_each_index`)
+
+        Returns:
+            list: path of every profile file, or None for indices that failed
+        """
+        async def profile_or_report(index):
+            try:
+                return await self.profile_index(self.host, index, None, self.download_path)
+            except Exception as ex:
+                print(f"Failed to profile {self.host}/{index}: {ex}")
+                return None
+
+        return await self.for_each_index(profile_or_report)
 
     async def automate(self):
-        await self.is_elastic()
-        if self.iselastic is False:
-            return
-        await self.get_db_info()
-        await self.get_db_indicies()
+        if self.ElasticDB is None:
+            if not await self.probe():
+                return
+        elif not self.indices:
+            await self.get_db_indicies()
         await self.filter_db_indices()
 
         if self.filtered_indices:
@@ -372,5 +901,9 @@ class ElasticAPI(object):
 
             print(table)
 
-            if self.download is True:
+            if self.profile:
+                await self.profile_indices()
+            elif self.sample:
+                await self.sample_indices()
+            elif self.download is True:
                 await self.download_indices()
@@ -0,0 +1,543 @@
+# Shared Elastic API core
+"""I/O-free building blocks shared by the async and the synchronous ElasticAPI.
+
+Both APIs only differ in how they talk to the database; everything that
+parses responses or builds requests lives here (and everything that
+writes data in `export`) so the two stay in step.
+"""
+from collections import namedtuple
+from dataclasses import dataclass
+
+INDICES_URL = "/_cat/indices?format=json"
+STATS_URL = "/_stats/docs,store"
+# How long the database keeps a scroll or point in time alive between pages
+KEEP_ALIVE = "2m"
+# First version with point in time and the `_shard_doc` sort
+PIT_MIN_VERSION = (7, 12)
+# Mapping types that can't be exported as a plain field
+DISALLOWED_TYPES = ['alias', 'completion', 'aggregate_metric_double', 'dense_vector',
+                    'rank_feature', 'rank_features', 'properties']
+
+
+@dataclass
+class ElasticDatabase:
+    """
+    Elastic Database Information
+    """
+    name: str = ""
+    cluster_name: str = ""
+    cluster_uuid: str = ""
+    version_number: str = ""
+    build_flavor: str = ""
+    build_type: str = ""
+    build_hash: str = ""
+    build_date: str = ""
+    build_snapshot: bool = False
+    lucene_version: str = ""
+    minimum_wire_compatibility_version: str = ""
+    minimum_index_compatibility_version: str = ""
+    tagline: str = ""
+    distribution: str = ""
+
+
+# Exact counts and sizes of an index from `_stats`, None when not reported
+IndexStats = namedtuple("IndexStats", ["docs", "pri_store_bytes", "store_bytes"])
+
+
+@dataclass
+class ElasticIndex:
+    """
+    Elastic Index Field Names
+
+    Fields whose `_cat/indices` column wasn't requested are left empty.
+    """
+    health: str = ""
+    status: str = ""
+    index: str = ""
+    uuid: str = ""
+    pri: str = ""
+    rep: str = ""
+    docs_count: str = ""
+    docs_deleted: str = ""
+    store_size: str = ""
+    pri_store_size: str = ""
+    stats: IndexStats = None
+
+
+# `_cat/indices` column of every ElasticIndex field
+INDEX_COLUMNS = {"health": "health", "status": "status", "index": "index", "uuid": "uuid",
+                 "pri": "pri", "rep": "rep", "docs_count": "docs.count",
+                 "docs_deleted": "docs.deleted", "store_size": "store.size",
+                 "pri_store_size": "pri.store.size"}
+# Fields always requested: the name, and what is shown and planned with
+BASE_INDEX_FIELDS = ("index", "docs_count", "store_size", "pri_store_size")
+# Only the counts and sizes out of the dozens of metrics `_stats` returns
+STATS_FILTER_PATH = ",".join(f"indices.*.{path}" for path in (
+    "primaries.docs.count", "primaries.store.size_in_bytes", "total.store.size_in_bytes"))
+
+
+SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3,
+              "tb": 1024 ** 4, "pb": 1024 ** 5}
+
+
+def parse_size(size):
+    """Convert a byte size like "512mb", "1.5gb" or "1048576" to bytes
+
+    Raises:
+        ValueError: If the size can't be parsed.
+
+    Example:
+        >>> parse_size("1.5kb")
+        1536
+    """
+    size = str(size).strip().lower()
+    for unit in ("kb", "mb", "gb", "tb", "pb", "k", "m", "g", "t", "p", "b"):
+        if size.endswith(unit):
+            multiplier = SIZE_UNITS[unit if unit.endswith("b") else unit + "b"]
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(float(size))
+
+
+def format_size(size):
+    """Format a byte count the way `_cat/indices` does
+
+    Example:
+        >>> format_size(1536)
+        '1.5kb'
+    """
+    for unit in ("pb", "tb", "gb", "mb", "kb"):
+        if size >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:.1f}{unit}"
+    return f"{size}b"
+
+
+def is_root_response(json_data):
+    """Check whether a decoded `GET /` response came from an Elasticsearch node"""
+    if not isinstance(json_data, dict):
+        return False
+    version = json_data.get("version")
+    return (isinstance(version, dict) and "number" in version
+            and "cluster_name" in json_data)
+
+
+def parse_db_info(json_data):
+    """Build an ElasticDatabase from a decoded `GET /` response"""
+    version = json_data.get("version", {})
+    return ElasticDatabase(
+        name=json_data.get("name", ""),
+        cluster_name=json_data.get("cluster_name", ""),
+        cluster_uuid=json_data.get("cluster_uuid", ""),
+        version_number=version.get("number", ""),
+        build_flavor=version.get("build_flavor", ""),
+        build_type=version.get("build_type", ""),
+        build_hash=version.get("build_hash", ""),
+        build_date=version.get("build_date", ""),
+        build_snapshot=version.get("build_snapshot", False),
+        lucene_version=version.get("lucene_version", ""),
+        minimum_wire_compatibility_version=version.get(
+            "minimum_wire_compatibility_version", ""),
+        minimum_index_compatibility_version=version.get(
+            "minimum_index_compatibility_version", ""),
+        tagline=json_data.get("tagline", ""),
+        distribution=version.get("distribution", "")
+    )
+
+
+def index_fields(filters=None):
+    """The ElasticIndex fields needed to show, plan and filter indices
+
+    Returns:
+        list: the fields, or None when a filter reads fields we can't tell
+    """
+    fields = list(BASE_INDEX_FIELDS)
+    for index_filter in filters or []:
+        field_name = getattr(index_filter, "field_name", None)
+        if field_name not in INDEX_COLUMNS:
+            return None
+        if field_name not in fields:
+            fields.append(field_name)
+    return fields
+
+
+def parse_indices(json_data):
+    """Build the list of ElasticIndex from a decoded `_cat/indices` response"""
+    # Rows only hold the requested columns, and closed indices report null counts
+    columns = [(field, column) for field, column in INDEX_COLUMNS.items()
+               if json_data and column in json_data[0]]
+    return [ElasticIndex(**{field: row.get(column) or "" for field, column in columns})
+            for row in json_data]
+
+
+def parse_index_stats(json_data):
+    """Read the counts and sizes of every index from a decoded `_stats` response
+
+    Returns:
+        dict: IndexStats by index name
+    """
+    stats = {}
+    for index, index_stats in (json_data.get("indices") or {}).items():
+        primaries = index_stats.get("primaries", {})
+        stats[index] = IndexStats(primaries.get("docs", {}).get("count"),
+                                  primaries.get("store", {}).get("size_in_bytes"),
+                                  index_stats.get("total", {}).get("store", {}).get("size_in_bytes"))
+    return stats
+
+
+def attach_index_stats(indices, stats):
+    """Set the `stats` of every ElasticIndex found in `stats`"""
+    for Index in indices:
+        Index.stats = stats.get(Index.index)
+
+
+def apply_filters(indices, filters):
+    """Run indices through every filter in turn
+
+    Args:
+        indices (list): list of ElasticIndex
+        filters (list): list of Filter, or None
+
+    Returns:
+        list: the indices that passed every filter
+    """
+    if filters is None:
+        return list(indices)
+    for index_filter in filters:
+        indices = index_filter.apply(indices)
+    return list(indices)
+
+
+def apply_doc_filters(hits, doc_filters):
+    """Keep the hits whose `_source` passes every document filter
+
+    Args:
+        hits (list): a page of hits
+        doc_filters (list): list of DictFilter, or None
+
+    Returns:
+        list: the hits that passed every filter
+    """
+    if not doc_filters:
+        return hits
+    sources = [hit["_source"] for hit in hits]
+    for doc_filter in doc_filters:
+        sources = doc_filter.apply(sources)
+    kept = {id(source) for source in sources}
+    return [hit for hit in hits if id(hit["_source"]) in kept]
+
+
+def filters_query(doc_filters, fields):
+    """Translate the document filters into a query for the database
+
+    Filters that can't be translated are left to `apply_doc_filters`, which
+    runs on every page either way.
+
+    Args:
+        doc_filters (list): list of DictFilter, or None
+        fields (dict): mapping of every queryable field, by dotted path
+
+    Returns:
+        dict: the query, or None if no filter could be translated
+    """
+    clauses = [doc_filter.to_query(fields) for doc_filter in doc_filters or []]
+    clauses = [clause for clause in clauses if clause]
+    if not clauses:
+        return None
+    return {"bool": {"filter": clauses}}
+
+
+def fieldnames_from_mapping(mapping_data, index):
+    """Get the fieldnames from a decoded `{index}/_mapping` response"""
+    # Find the mapping for the index
+    index_mapping = mapping_data[index]['mappings']
+
+    # Get the fieldnames from the mapping
+    fieldnames = []
+    for mapping in index_mapping.values():
+        try:
+            for fieldname, field_mapping in mapping.items():
+                if mapping.get('properties', {}):
+                    properties = mapping.get('properties', {})
+                    for fieldname, field_mapping in properties.items():
+                        if field_mapping.get('type'):
+                            fieldnames.append(fieldname)
+                elif field_mapping.get('type') not in DISALLOWED_TYPES:
+                    fieldnames.append(fieldname)
+        except AttributeError as err:
+            print(f"Failed to get index mapping for {index}: {err}")
+            break
+    return fieldnames
+
+
+def get_total_hits(scroll_data):
+    """Read the total hit count from a search response
+
+    Searches sent with `track_total_hits` false, like the follow-up pages
+    of a point in time, have no total at all.
+    """
+    try:
+        if isinstance(scroll_data["hits"]["total"], int):
+            return scroll_data["hits"]["total"]
+        return scroll_data["hits"]["total"]["value"]
+    except (TypeError, KeyError):
+        return len(scroll_data["hits"]["hits"])
+
+
+# A request for the database, independent of the HTTP client that sends it
+SearchRequest = namedtuple("SearchRequest", ["method", "path", "params", "body"])
+# What a reader needs from a search response to continue
+Page = namedtuple("Page", ["scroll_id", "pit_id", "total_hits", "hit_count", "last_sort"])
+
+
+def page_from_response(search_data):
+    """Summarize a decoded search response as a Page"""
+    hits = search_data["hits"]["hits"]
+    return Page(scroll_id=search_data.get("_scroll_id"),
+                pit_id=search_data.get("pit_id"),
+                total_hits=get_total_hits(search_data),
+                hit_count=len(hits),
+                last_sort=hits[-1].get("sort") if hits else None)
+
+
+class ScrollReader:
+    """Reads an index (or one slice of it) with the scroll API.
+
+    The reader only decides which request comes next and what to make of
+    the response; sending it is up to the caller, so the async and the
+    synchronous API drive the exact same logic:
+
+    ```
+    reader = ScrollReader("users")
+    request = reader.next_request()
+    while request:
+        hits = reader.feed(send(request))
+        request = reader.next_request()
+    ```
+    """
+    def __init__(self, index, search_size=1000, scroll_time=KEEP_ALIVE,
+                 slice_id=None, max_slices=None, fields=None,
+                 query=None):
+        self.index = index
+        self.search_size = search_size
+        self.scroll_time = scroll_time
+        self.body = search_body(slice_id, max_slices, fields, query)
+
+        self.scroll_id = None
+        self.total_hits = None
+        self.accumulated_hits = 0
+        self.done = False
+
+    def next_request(self):
+        """Return the next request to send, or None once the index is read"""
+        if self.done:
+            return None
+        if self.scroll_id is None:
+            return SearchRequest("POST", f"/{self.index}/_search",
+                                 {"scroll": self.scroll_time, "size": self.search_size},
+                                 self.body)
+        return SearchRequest("POST", "/_search/scroll", None,
+                             {"scroll": self.scroll_time, "scroll_id": self.scroll_id})
+
+    def feed(self, scroll_data):
+        """Consume a decoded response and return its hits"""
+        self.feed_page(page_from_response(scroll_data))
+        return scroll_data["hits"]["hits"]
+
+    def feed_page(self, page):
+        """Consume the Page of a response whose hits were handled elsewhere"""
+        # The scroll ID may change between pages, always continue from the latest
+        self.scroll_id = page.scroll_id or self.scroll_id
+        if self.total_hits is None:
+            self.total_hits = page.total_hits
+
+        self.accumulated_hits += page.hit_count
+        if (not page.hit_count or self.accumulated_hits >= self.total_hits
+                or self.scroll_id is None):
+            self.done = True
+
+    def close_request(self):
+        """Return the request that frees the scroll context, or None"""
+        if self.scroll_id is None:
+            return None
+        return SearchRequest("DELETE", "/_search/scroll", None, {"scroll_id": [self.scroll_id]})
+
+
+class PitReader:
+    """Reads an index (or one slice of it) from a point in time with search_after.
+
+    Unlike a scroll, a point in time is opened once per download and shared
+    by every slice: open it with `open_pit_request`, hand its ID to the
+    readers, and close it with `close_pit_request` once they are done.
+    Pages are sorted on `_shard_doc`, the cheapest sort for a full read.
+    """
+    def __init__(self, pit_id, search_size=1000, keep_alive=KEEP_ALIVE,
+                 slice_id=None, max_slices=None, fields=None,
+                 query=None):
+        self.pit_id = pit_id
+        self.search_size = search_size
+        self.keep_alive = keep_alive
+        self.body = search_body(slice_id, max_slices, fields, query) or {}
+
+        self.search_after = None
+        self.total_hits = None
+        self.accumulated_hits = 0
+        self.done = False
+
+    def next_request(self):
+        """Return the next request to send, or None once the index is read"""
+        if self.done:
+            return None
+        body = dict(self.body, size=self.search_size,
+                    pit={"id": self.pit_id, "keep_alive": self.keep_alive},
+                    sort=[{"_shard_doc": "asc"}])
+        if self.search_after is None:
+            body["track_total_hits"] = True
+        else:
+            body["search_after"] = self.search_after
+            body["track_total_hits"] = False
+        return SearchRequest("POST", "/_search", None, body)
+
+    def feed(self, search_data):
+        """Consume a decoded response and return its hits"""
+        self.feed_page(page_from_response(search_data))
+        return search_data["hits"]["hits"]
+
+    def feed_page(self, page):
+        """Consume the Page of a response whose hits were handled elsewhere"""
+        # The point in time ID may change between pages, always continue from the latest
+        self.pit_id = page.pit_id or self.pit_id
+        if self.total_hits is None:
+            self.total_hits = page.total_hits
+
+        self.accumulated_hits += page.hit_count
+        if page.hit_count:
+            self.search_after = page.last_sort
+        if page.hit_count < self.search_size or self.accumulated_hits >= self.total_hits:
+            self.done = True
+
+    def close_request(self):
+        """Slices share the point in time, it is closed by the download instead"""
+        return None
+
+
+def make_reader(index, pit_id=None, search_size=1000, slice_id=None, max_slices=None,
+                fields=None, query=None):
+    """Reader for one slice of a download: from the point in time if one is open,
+    else with a scroll"""
+    if pit_id:
+        return PitReader(pit_id, search_size, slice_id=slice_id, max_slices=max_slices,
+                         fields=fields, query=query)
+    return ScrollReader(index, search_size, slice_id=slice_id, max_slices=max_slices,
+                        fields=fields, query=query)
+
+
+# What the readers of a download expected and read, and what the writers did
+# with it. `expected_docs` is the hit total the database gave each slice, None
+# when a slice never got a page. `skipped_docs` were dropped on purpose, by
+# document filters or deduplication.
+ReadTotals = namedtuple("ReadTotals", ["expected_docs", "read_docs", "skipped_docs",
+                                       "written_docs", "complete"])
+
+
+def read_totals(readers, outputs=None):
+    """Sum up the readers and writers of a download
+
+    A download is complete when every reader finished and read as many
+    documents as the database said its slice held, and every document
+    read was either written or skipped. Readers also stop on an empty or
+    short page, which is how a truncated read ends.
+
+    Args:
+        readers (list): ScrollReader or PitReader of every slice
+        outputs (list, optional): export.RotatingOutput the slices wrote to
+    """
+    totals = [reader.total_hits for reader in readers]
+    expected_docs = None if None in totals else sum(totals)
+    read_docs = sum(reader.accumulated_hits for reader in readers)
+    complete = all(reader.done for reader in readers) and read_docs == expected_docs
+    skipped_docs = written_docs = None
+    if outputs is not None:
+        # Slices may share a writer
+        outputs = list(dict.fromkeys(outputs))
+        skipped_docs = sum(output.skipped_docs for output in outputs)
+        written_docs = sum(output.written_docs for output in outputs)
+        complete = complete and written_docs + skipped_docs == read_docs
+    return ReadTotals(expected_docs, read_docs, skipped_docs, written_docs, complete)
+
+
+def indices_request(fields=None):
+    """Build the request listing the indices of the database, with only the
+    `_cat/indices` columns of `fields` when given (see `index_fields`)"""
+    if not fields:
+        return SearchRequest("GET", INDICES_URL, None, None)
+    columns = ",".join(INDEX_COLUMNS[field] for field in fields)
+    return SearchRequest("GET", "/_cat/indices", {"format": "json", "h": columns}, None)
+
+
+def stats_request():
+    """Build the request for the document counts and store sizes of every index"""
+    return SearchRequest("GET", STATS_URL, {"filter_path": STATS_FILTER_PATH}, None)
+
+
+def mapping_request(index):
+    """Build the request for the mapping of an index"""
+    return SearchRequest("GET", f"/{index}/_mapping", None, None)
+
+
+def open_pit_request(index, keep_alive=KEEP_ALIVE):
+    """Request that opens a point in time on an index"""
+    return SearchRequest("POST", f"/{index}/_pit", {"keep_alive": keep_alive}, None)
+
+
+def close_pit_request(pit_id):
+    """Request that closes a point in time"""
+    return SearchRequest("DELETE", "/_pit", None, {"id": pit_id})
+
+
+def version_tuple(version_number):
+    """Convert a version number like "7.17.3" to (7, 17, 3)"""
+    numbers = []
+    for part in str(version_number).split("-")[0].split("."):
+        if not part.isdigit():
+            break
+        numbers.append(int(part))
+    return tuple(numbers)
+
+
+def supports_pit(elastic_db):
+    """Whether the database can be read with a point in time sorted on `_shard_doc`"""
+    if elastic_db is None or elastic_db.distribution == "opensearch":
+        return False
+    return version_tuple(elastic_db.version_number) >= PIT_MIN_VERSION
+
+
+def sample_request(index, size, fields=None, query=None):
+    """Build the request for a random sample of an index, in a single page
+
+    `random_score` spreads the sample over every shard, instead of returning
+    the first documents of the first shard to answer.
+    """
+    body = search_body(fields=fields) or {}
+    body["size"] = size
+    body["query"] = {"function_score": {"query": query or {"match_all": {}},
+                                        "random_score": {},
+                                        "boost_mode": "replace"}}
+    return SearchRequest("POST", f"/{index}/_search", None, body)
+
+
+def slice_body(slice_id=None, max_slices=None):
+    """Build the search body for one slice of a sliced scroll"""
+    if max_slices and max_slices > 1:
+        return {"slice": {"id": slice_id, "max": max_slices}}
+    return None
+
+
+def search_body(slice_id=None, max_slices=None, fields=None, query=None):
+    """Build the search body for one slice, only returning `fields` of each
+    `_source` and documents matching `query` when given"""
+    body = slice_body(slice_id, max_slices)
+    if fields:
+        body = dict(body or {}, _source=list(fields))
+    if query:
+        body = dict(body or {}, query=query)
+    return body
+
@@ -0,0 +1,227 @@
+# Cross-index Deduplication
+"""Drop documents that were already written during this run.
+
+Aliases, rollover indices and reindexed copies hold the same documents
+under several index names, so a download of every index writes them
+several times. A `Deduplicator` shared by every download of a run drops
+a hit when its key was seen before:
+
+- `id`: the `_id` within its index group, the index name without its
+  rollover number, date or copy suffix (`logs-000002` and `logs-000001`
+  are both `logs`, `users_v2` and `users-reindexed` are `users`)
+- `content`: a hash of the `_source`, whatever the index and `_id`
+
+Keys are kept in a scalable Bloom filter, which answers "never seen" for
+nearly every new document from a few bits of memory per key. The keys
+are also spilled to an sqlite file on disk, so a "maybe seen" from the
+Bloom filter is checked exactly and no unique document is ever dropped:
+
+```
+dedupe = Deduplicator("id")
+output.write_hits(dedupe.unique(hits))
+...
+dedupe.close()
+```
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+DEDUPE_MODES = ("id", "content")
+# Suffixes that mark a rollover, a dated index or a copy of an index
+INDEX_GROUP_SUFFIX = re.compile(
+    r"([-_.](\d{6}|\d{4}([-_.]\d{2}){0,2}|v\d+|reindex(ed)?|copy|backup|old|new|tmp))+$",
+    re.IGNORECASE)
+# Bytes of every key, a BLAKE2 digest
+KEY_SIZE = 16
+# Keys inserted into the spill file per transaction
+SPILL_BATCH_SIZE = 10000
+
+
+@functools.lru_cache(maxsize=4096)
+def index_group(index):
+    """The index name without its rollover, date or copy suffixes
+
+    Example:
+        >>> index_group("logs-2023.01.02-000003")
+        'logs'
+    """
+    return INDEX_GROUP_SUFFIX.sub("", index) or index
+
+
+def hit_key(hit, mode):
+    """The key a hit is deduplicated on, as a fixed-size digest"""
+    if mode == "content":
+        data = json.dumps(hit.get("_source"), sort_keys=True, separators=(",", ":"),
+                          ensure_ascii=False)
+    else:
+        data = f"{index_group(hit.get('_index', ''))}\x00{hit.get('_id')}"
+    return hashlib.blake2b(data.encode("utf8"), digest_size=KEY_SIZE).digest()
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over KEY_SIZE byte digests.
+
+    Keys are passed as the two integer halves of their digest, which give
+    every bit position by double hashing.
+
+    Args:
+        capacity (int): keys it holds before its error rate is exceeded
+        error_rate (float): chance of a false "maybe seen" at capacity
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def contains(self, first, second):
+        bits, num_bits = self.bits, self.num_bits
+        position, step = first % num_bits, second % num_bits
+        for _ in range(self.num_hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position = (position + step) % num_bits
+        return True
+
+    def add(self, first, second):
+        """Set the bits of a key
+
+        Returns:
+            bool: whether they were all set already, i.e. the key may have been added before
+        """
+        bits, num_bits = self.bits, self.num_bits
+        position, step = first % num_bits, second % num_bits
+        present = True
+        for _ in range(self.num_hashes):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                present = False
+                bits[position >> 3] |= mask
+            position = (position + step) % num_bits
+        if not present:
+            self.count += 1
+        return present
+
+
+class ScalableBloomFilter:
+    """A Bloom filter that adds a larger, stricter layer whenever one fills up,
+    so its error rate holds however many keys it gets.
+
+    Args:
+        capacity (int, optional): keys of the first layer. Defaults to 1,000,000.
+        error_rate (float, optional): overall chance of a false "maybe seen".
+            Defaults to 0.01.
+        growth (int, optional): capacity of each layer over the one before. Defaults to 4.
+        tightening (float, optional): error rate of each layer over the one
+            before. Defaults to 0.5.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.01, growth=4, tightening=0.5):
+        self.growth = growth
+        self.tightening = tightening
+        self.layers = [BloomFilter(capacity, error_rate * (1 - tightening))]
+
+    def add(self, key):
+        """Add a key
+
+        Returns:
+            bool: whether the key may have been added before. False is always right.
+        """
+        first = int.from_bytes(key[:8], "little")
+        second = int.from_bytes(key[8:], "little") | 1
+        for layer in self.layers[:-1]:
+            if layer.contains(first, second):
+                return True
+        layer = self.layers[-1]
+        present = layer.add(first, second)
+        if layer.count >= layer.capacity:
+            self.layers.append(BloomFilter(layer.capacity * self.growth,
+                                           layer.error_rate * self.tightening))
+        return present
+
+    @property
+    def nbytes(self):
+        return sum(len(layer.bits) for layer in self.layers)
+
+
+class Deduplicator:
+    """Tells the hits of a run that weren't written before from duplicates.
+
+    Safe to share between threads and between the tasks of an event loop.
+
+    Args:
+        mode (str, optional): one of DEDUPE_MODES. Defaults to 'id'.
+        spill_path (str, optional): sqlite file of the seen keys. A temporary
+            file, removed by `close`, when None.
+        capacity (int, optional): keys of the first Bloom filter layer
+        error_rate (float, optional): Bloom filter error rate. A false "maybe seen"
+            only costs a lookup in the spill file.
+
+    Raises:
+        ValueError: If the mode is unknown.
+    """
+    def __init__(self, mode="id", spill_path=None, capacity=1000000, error_rate=0.01):
+        if mode not in DEDUPE_MODES:
+            raise ValueError(f"Invalid dedupe mode: {mode}. "
+                             f"Supported modes are {', '.join(DEDUPE_MODES)}")
+        self.mode = mode
+        self.bloom = ScalableBloomFilter(capacity, error_rate)
+        self.temporary = spill_path is None
+        if self.temporary:
+            spill_file, spill_path = tempfile.mkstemp(prefix="elastichunt-dedupe-",
+                                                      suffix=".sqlite")
+            os.close(spill_file)
+        self.spill_path = spill_path
+        self.db = sqlite3.connect(spill_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID")
+        # Keys not in the spill file yet
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.kept = 0
+        self.dropped = 0
+
+    def flush(self):
+        """Write the pending keys to the spill file"""
+        if self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)",
+                                ((key,) for key in self.pending))
+            self.db.commit()
+            self.pending.clear()
+
+    def seen_before(self, key):
+        """Whether a key was seen before, remembering it if it wasn't"""
+        # A false "maybe" only costs a lookup in the spill file
+        if self.bloom.add(key) and (key in self.pending or self.db.execute(
+                "SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone()):
+            return True
+        self.pending.add(key)
+        if len(self.pending) >= SPILL_BATCH_SIZE:
+            self.flush()
+        return False
+
+    def unique(self, hits):
+        """The hits of a page whose key wasn't seen before, in order"""
+        keys = [hit_key(hit, self.mode) for hit in hits]
+        with self.lock:
+            unique_hits = [hit for hit, key in zip(hits, keys) if not self.seen_before(key)]
+            self.kept += len(unique_hits)
+            self.dropped += len(hits) - len(unique_hits)
+        return unique_hits
+
+    def close(self):
+        """Close the spill file, removing it if it is temporary"""
+        with self.lock:
+            self.flush()
+            self.db.close()
+            if self.temporary:
+                os.remove(self.spill_path)
@@ -1,69 +1,148 @@
 # Open Elastic API
-from dataclasses import dataclass
 import os
-import re
-import csv
-import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from elastic_api import core, export, mapping, passthrough, planner, profile, retry, timeouts
+
+# Exceptions of requests for each kind of retryable failure (see `retry`)
+TIMEOUT_ERRORS = (requests.Timeout,)
+CONNECTION_ERRORS = (requests.ConnectionError, requests.exceptions.ChunkedEncodingError)
+
 
 class ElasticAPI(object):
-    
-    INDICES_URL = "/_cat/indices?format=json"
-    SEARCH_SIZE = 1000
+    """Synchronous Elastic API, for embedding Elastichunt in tools that
+    don't run an event loop.
+
+    It shares its request building, response parsing and export code with
+    the async API through `elastic_api.core`, and uses a pooled
+    `requests.Session` so every request to the host reuses a kept-alive
+    connection. Use it as a context manager to release the pool:
+
+    ```
+    with ElasticAPI("http://127.0.0.1:9200", download=True) as api:
+        api.automate()
+    ```
+    """
+
+    INDICES_URL = core.INDICES_URL
+    SEARCH_SIZE = 5700
     SEARCH_HEADERS = {"Content-Type": "application/json"}
-    
-    @dataclass
-    class ElasticDatabase:
-        """
-        Elastic Database Information
-        """
-        name: str = ""
-        cluster_name: str = ""
-        cluster_uuid: str = ""
-        version_number: str = ""
-        build_flavor: str = ""
-        build_type: str = ""
-        build_hash: str = ""
-        build_date: str = ""
-        build_snapshot: bool = False
-        lucene_version: str = ""
-        minimum_wire_compatibility_version: str = ""
-        minimum_index_compatibility_version: str = ""
-        tagline: str = ""
-
-    @dataclass
-    class ElasticIndex:
-        """
-        Elastic Index Field Names
-        """
-        health: str
-        status: str
-        index: str
-        uuid: str
-        pri: str
-        rep: str
-        docs_count: str
-        docs_deleted: str
-        store_size: str
-        pri_store_size: str
-        
-    def __init__(self, host, download_path=os.getcwd(), timeout=1, Filters=None):
+    # Connections kept open per host
+    POOL_SIZE = 16
+
+    ElasticDatabase = core.ElasticDatabase
+    ElasticIndex = core.ElasticIndex
+
+    def __init__(self, host, download_path=os.getcwd(), timeout=None, Filters=None, download=False,
+                 endpoints=None, max_workers=4, max_file_size=None, max_docs_per_file=None,
+                 export_format='csv', passthrough=False, doc_filters=None, sample=None, profile=False,
+                 disk_full='trim', rtt=None, dedupe=None):
         self.host = host
+        # Other nodes of the same cluster, used to spread download slices
+        self.endpoints = list(endpoints) if endpoints else list()
+        # Connect timeout, adapting to the round trip time to the host when None
         self.timeout = timeout
+        self.timeouts = timeouts.Timeouts(timeout, rtt)
         self.download_path = download_path
-        
+        self.download = download
+        # Number of indices downloaded in parallel
+        self.max_workers = max_workers
+        # Split exports into part files of at most this many bytes/documents
+        self.max_file_size = max_file_size
+        self.max_docs_per_file = max_docs_per_file
+        self.export_format = export_format
+        # Stream json exports to disk without decoding them (see `passthrough`)
+        self.passthrough = passthrough
+        # Save a random sample of this many documents per index instead of downloading
+        self.sample = sample
+        # Save a profile of every index instead of downloading (see `profile`)
+        self.profile = profile
+        # What to do when the filtered indices don't fit on disk (see `planner`)
+        self.disk_full = disk_full
+
         self.iselastic = None
         self.indices = list()
         self.index_schema = list() # List of Lists, where each list contains
         # the field names for each index
         self.Filters = Filters
+        # DictFilters that downloaded documents must pass
+        self.doc_filters = doc_filters
+        # dedupe.Deduplicator shared by every download of the run, if any
+        self.dedupe = dedupe
+        # Decoded `_mapping` responses by index, so an index mapping is fetched once
+        self.mappings = dict()
         self.ElasticDB = None
         self.filtered_indices = list()
-        
+        self.probe_rtt = None
+
+        self.session = requests.Session()
+        self.session.headers.update(ElasticAPI.SEARCH_HEADERS)
+        adapter = HTTPAdapter(pool_connections=ElasticAPI.POOL_SIZE,
+                              pool_maxsize=ElasticAPI.POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request_timeout(self, request_class, timeout=None):
+        """The timeout of a class of request (see `timeouts`), unless `timeout` is given
+
+        Returns:
+            tuple: connect and read timeouts, requests has no limit on whole requests
+        """
+        if timeout is not None:
+            return timeout
+        settings = self.timeouts.settings(request_class)
+        return (settings.connect, settings.read)
+
+    def close(self):
+        """Close the pooled session"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def probe(self, fetch_indices=True):
+        """Probe the host with as few round trips as possible.
+
+        A single `GET /` both detects Elasticsearch and fills `ElasticDB`.
+        Only confirmed clusters go on to request their indices.
+
+        Args:
+            fetch_indices (bool, optional): Also retrieve the indices. Defaults to True.
+
+        Returns:
+            bool: True if the host is an Elasticsearch database
+        """
+        try:
+            started = time.monotonic()
+            json_data = self.session.get(self.host,
+                                         timeout=self.request_timeout(timeouts.PROBE)).json()
+            self.probe_rtt = time.monotonic() - started
+            self.timeouts.observe(self.probe_rtt)
+        except Exception:
+            json_data = None
+
+        self.iselastic = core.is_root_response(json_data)
+        if not self.iselastic:
+            return False
+
+        self.ElasticDB = core.parse_db_info(json_data)
+        if fetch_indices:
+            self.get_db_indicies()
+        return True
+
     def is_elastic(self):
         """Check if the Host is an elasticsearch database"""
         try:
-            rtext = requests.get(f"{self.host}/_cat", timeout=self.timeout)
+            rtext = self.session.get(f"{self.host}/_cat",
+                                     timeout=self.request_timeout(timeouts.PROBE))
             if "=^.^=" in rtext.text:
                 self.iselastic = True
             else:
@@ -73,106 +152,494 @@ class ElasticAPI(object):
 
     def get_db_info(self):
         """Retrieve the Elastic Database Information"""
+        json_data = self.session.get(self.host,
+                                     timeout=self.request_timeout(timeouts.PROBE)).json()
+        self.ElasticDB = core.parse_db_info(json_data)
+
+    def get_index_stats(self):
+        """Get the exact counts and sizes of every index with a single `_stats` request
+
+        Returns:
+            dict: core.IndexStats by index name, empty if `_stats` isn't available
+        """
+        try:
+            json_data = self.send_search(self.host, core.stats_request(),
+                                         self.request_timeout(timeouts.METADATA), retry.QUICK)
+            return core.parse_index_stats(json_data)
+        except Exception:
+            return {}
 
-        data = requests.get(self.host, timeout=self.timeout)
-        json_data = json.loads(data.text)
-
-        self.ElasticDB = ElasticAPI.ElasticDatabase(
-            name=json_data.get("name", ""),
-            cluster_name=json_data.get("cluster_name", ""),
-            cluster_uuid=json_data.get("cluster_uuid", ""),
-            version_number=json_data.get("version", {}).get("number", ""),
-            build_flavor=json_data.get("version", {}).get("build_flavor", ""),
-            build_type=json_data.get("version", {}).get("build_type", ""),
-            build_hash=json_data.get("version", {}).get("build_hash", ""),
-            build_date=json_data.get("version", {}).get("build_date", ""),
-            build_snapshot=json_data.get("version", {}).get("build_snapshot", False),
-            lucene_version=json_data.get("version", {}).get("lucene_version", ""),
-            minimum_wire_compatibility_version=json_data.get(
-                "version", {}).get("minimum_wire_compatibility_version", ""),
-            minimum_index_compatibility_version=json_data.get(
-                "version", {}).get("minimum_index_compatibility_version", ""),
-            tagline=json_data.get("tagline", "")
-        )
-        
     def get_db_indicies(self):
-        """Retrieve the elastic DB Indicies"""
-        data = requests.get(self.host + ElasticAPI.INDICES_URL, timeout=self.timeout)
-        json_data = json.loads(data.text)
-        
-        for index in json_data:
-            elastic_index = ElasticAPI.ElasticIndex(
-                health=index.get("health", ""),
-                status=index.get("status", ""),
-                index=index.get("index", ""),
-                uuid=index.get("uuid", ""),
-                pri=index.get("pri", ""),
-                rep=index.get("rep", ""),
-                docs_count=index.get("docs.count", ""),
-                docs_deleted=index.get("docs.deleted", ""),
-                store_size=index.get("store.size", ""),
-                pri_store_size=index.get("pri.store.size", "")
-            )
-            self.indices.append(elastic_index)
+        """Retrieve the elastic DB Indicies
+
+        Only the `_cat/indices` columns the filters need are requested, and
+        the exact sizes come from one `_stats` request.
+        """
+        json_data = self.send_search(self.host,
+                                     core.indices_request(core.index_fields(self.Filters)),
+                                     self.request_timeout(timeouts.METADATA), retry.QUICK)
+        indices = core.parse_indices(json_data)
+        core.attach_index_stats(indices, self.get_index_stats())
+        self.indices.extend(indices)
 
     def filter_db_indices(self):
         """Filter Database Indicies"""
-        if self.Filters is None:
-            self.filter_db_indices = self.indices
+        self.filtered_indices = core.apply_filters(self.indices, self.Filters)
+
+    def get_index_mapping(self, host, index, timeout):
+        """Get the decoded mapping of an Elasticsearch index"""
+        return self.send_search(host, core.mapping_request(index), timeout)
+
+    def get_fieldnames_from_index_mapping(self, host, index, timeout):
+        """Get the fieldnames from an Elasticsearch index mapping"""
+        return core.fieldnames_from_mapping(self.get_index_mapping(host, index, timeout), index)
+
+    def get_mapping(self, host, index, timeout=None):
+        """Get the decoded mapping of an index, from the cache when it was fetched before"""
+        if index not in self.mappings:
+            self.mappings[index] = self.get_index_mapping(
+                host, index, self.request_timeout(timeouts.METADATA, timeout))
+        return self.mappings[index]
+
+    def get_filters_query(self, host, index, timeout, doc_filters, mapping_data=None):
+        """Translate document filters into a query for the index, using its mapping
+
+        Returns:
+            dict: the query, or None when no filter could be translated
+        """
+        if not doc_filters:
+            return None
+        if mapping_data is None:
+            mapping_data = self.get_mapping(host, index, timeout)
+        fields = mapping.queryable_fields(mapping.mapping_properties(mapping_data, index))
+        return core.filters_query(doc_filters, fields)
+
+    def send_search(self, host, request, timeout, policy=retry.DEFAULT):
+        """Send a request built by the core and return the decoded response
+
+        Failures are retried following `policy` (see `retry`).
+
+        Args:
+            host (str): host
+            request (core.SearchRequest): request to send
+            timeout (int): request timeout
+            policy (retry.RetryPolicy, optional): Defaults to retry.DEFAULT.
+
+        Raises:
+            retry.HostUnavailable: If the host's circuit breaker is open.
+
+        Returns:
+            dict: decoded response
+        """
+        attempts = retry.Attempts(policy, host, TIMEOUT_ERRORS, CONNECTION_ERRORS)
+        while True:
+            attempts.check()
+            try:
+                response = self.session.request(request.method, host + request.path,
+                                                params=request.params, json=request.body,
+                                                timeout=timeout)
+                retry.check_status(response.status_code, response.headers)
+                json_data = response.json()
+            except Exception as ex:
+                time.sleep(attempts.failed(ex))
+            else:
+                attempts.succeeded()
+                return json_data
+
+    def stream_search(self, host, request, timeout, on_sources, policy=retry.DEFAULT):
+        """Send a search request built by the core and stream the `_source` of
+        its hits to `on_sources` as they arrive, without decoding them.
+
+        Only sending the request is retried: once sources were handed over,
+        trying again would write them twice.
+
+        Returns:
+            core.Page: what the reader needs to continue
+        """
+        attempts = retry.Attempts(policy, host, TIMEOUT_ERRORS, CONNECTION_ERRORS)
+        while True:
+            attempts.check()
+            try:
+                response = self.session.request(request.method, host + request.path,
+                                                params=request.params, json=request.body,
+                                                timeout=timeout, stream=True)
+                try:
+                    retry.check_status(response.status_code, response.headers)
+                except retry.StatusError:
+                    response.close()
+                    raise
+            except Exception as ex:
+                time.sleep(attempts.failed(ex))
+            else:
+                attempts.succeeded()
+                break
+
+        with response:
+            stream = passthrough.SourceStream(on_sources)
+            for chunk in response.iter_content(passthrough.CHUNK_SIZE):
+                stream.feed(chunk)
+            return stream.close()
+
+    def send_cleanup(self, host, request, timeout):
+        """Send a cleanup request (freeing a scroll or point in time), best effort"""
+        if request is None:
             return
-        for Filter in self.Filters:
-            f_indices = Filter.apply(self.indices)
-            self.filtered_indices.extend(f_indices)
-            
-    @staticmethod
-    def download_index(host, index, timeout, filename, download_path=os.getcwd()):
-        """Download an index"""
-        scroll_url = f"{host}/{index}/_search?scroll=180m&size={ElasticAPI.SEARCH_SIZE}"
-        scroll_request = requests.post(scroll_url, headers=ElasticAPI.SEARCH_HEADERS, timeout=timeout)
-
-        scroll_data = json.loads(scroll_request.text)
-        scroll_id = scroll_data["_scroll_id"]
-
-        with open(os.path.join(download_path, f"{filename}.csv"), "w", encoding='utf8', newline="") as csv_file:
-            writer = None
-
-            # Keep scrolling until there are no more results
-            while True:
-                # Get the next scroll batch
-                url = f"{host}/_search/scroll?scroll=180m&scroll_id={scroll_id}"
-                scroll_request = requests.post(url)
-                scroll_data = json.loads(scroll_request.text)
-
-                # Find any hits
-                hits = scroll_data["hits"]["hits"]
-                if not hits:
-                    break
-
-                # Write each hit to the CSV file
-                for hit in hits:
-                    # Get the fields from the hit and set up the CSV writer if necessary
-                    source = hit["_source"]
-                    if not writer:
-                        fieldnames = source.keys()
-                        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                        writer.writeheader()
-
-                    
-                # Get the next Scroll ID
-                scroll_id = scroll_data["_scroll_id"]
-                
+        try:
+            self.send_search(host, request, timeout, retry.ONCE)
+        except Exception as ex:
+            print(f"Failed to release search context on {host}: {ex}")
+
+    def open_pit(self, host, index, timeout):
+        """Open a point in time on the index, if the database supports it
+
+        Returns:
+            str: point in time ID, or None to fall back to scrolling
+        """
+        if not core.supports_pit(self.ElasticDB):
+            return None
+        try:
+            pit_data = self.send_search(host, core.open_pit_request(index), timeout,
+                                        retry.ONCE)
+        except Exception:
+            return None
+        return pit_data.get("id")
+
+    def download_slice(self, host, reader, timeout, output, output_lock, raw=False,
+                       doc_filters=None, fallback_hosts=()):
+        """Read an index (or one slice of it) and write the hits
+
+        The reader's search context is released when the slice is done or fails.
+
+        When `host` fails (see `retry.host_failed`), the slice carries on
+        from the next of `fallback_hosts`, other nodes of the same cluster.
+        A page whose sources were partly streamed to the output fails the
+        slice instead, as reading it again would write them twice.
+
+        Args:
+            host (str): host to read from
+            reader (core.ScrollReader or core.PitReader): reader for this slice
+            timeout (int): timeout of every request, None for the defaults of each class
+            output (export.RotatingOutput): writer for this slice
+            output_lock (threading.Lock): guards writes to the output
+            raw (bool, optional): stream the sources to the output undecoded
+            doc_filters (list, optional): DictFilters the written documents must pass
+            fallback_hosts (list, optional): hosts to read from once `host` fails
+
+        Returns:
+            int: number of hits written
+        """
+        # Sources of the current page streamed to the output so far
+        streamed = []
+
+        def write_sources(sources):
+            streamed.append(len(sources))
+            with output_lock:
+                output.write_sources(sources)
+
+        search_timeout = self.request_timeout(timeouts.SEARCH, timeout)
+        try:
+            request = reader.next_request()
+            while request:
+                try:
+                    if raw:
+                        streamed.clear()
+                        reader.feed_page(self.stream_search(host, request, search_timeout,
+                                                            write_sources))
+                    else:
+                        hits = reader.feed(self.send_search(host, request, search_timeout))
+                        hit_count = len(hits)
+                        hits = core.apply_doc_filters(hits, doc_filters)
+                        if self.dedupe is not None:
+                            hits = self.dedupe.unique(hits)
+                        # Pages are written as they arrive, so memory never holds more than one
+                        with output_lock:
+                            output.skip(hit_count - len(hits))
+                            output.write_hits(hits)
+                except Exception as ex:
+                    if (not fallback_hosts or streamed
+                            or not retry.host_failed(ex, TIMEOUT_ERRORS, CONNECTION_ERRORS)):
+                        raise
+                    print(f"Reading the slice of {host} from {fallback_hosts[0]} instead: {ex}")
+                    host, fallback_hosts = fallback_hosts[0], fallback_hosts[1:]
+                    continue
+                request = reader.next_request()
+        finally:
+            self.send_cleanup(host, reader.close_request(),
+                              self.request_timeout(timeouts.METADATA, timeout))
+        return reader.accumulated_hits
+
+    def download_index(self, host, index, timeout, filename, download_path=os.getcwd(),
+                       folder_name=None, fieldnames=None, export_format='csv', endpoints=None,
+                       max_file_size=None, max_docs_per_file=None, passthrough=None,
+                       doc_filters=None):
+        """Download an index
+
+        Databases that support it are read from a point in time with
+        search_after, older ones with a short-lived scroll. Either way the
+        search context is released once the download ends or fails.
+
+        When more than one endpoint of the same cluster is given, the index
+        is split into one slice per endpoint, each read by its own thread.
+        The slice of a node that fails is read from the others.
+
+        With `max_file_size` (bytes) or `max_docs_per_file` the export is split
+        into numbered part files.
+
+        Every download writes `{filename}.manifest.json`, which lists the
+        parts with their checksums, and the documents expected and read, to
+        tell a complete download from a truncated one.
+
+        With `passthrough`, json exports without `fieldnames` copy every
+        `_source` to disk byte for byte as it streams in, instead of
+        decoding and re-encoding each page.
+
+        Only documents that pass `doc_filters` are written. Filters that can
+        be expressed as a query are also sent to the database, so documents
+        that can't match are never transferred. With a `dedupe`, documents
+        written before in the run are dropped as well.
+
+        Every request uses `timeout` when given, otherwise the timeout of
+        its request class (see `timeouts`).
+
+        Returns:
+            str: path of the written file (or manifest)
+        """
+        export.check_export_format(export_format)
+        metadata_timeout = self.request_timeout(timeouts.METADATA, timeout)
+        max_file_size = max_file_size or self.max_file_size
+        max_docs_per_file = max_docs_per_file or self.max_docs_per_file
+        if passthrough is None:
+            passthrough = self.passthrough
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        raw = (passthrough and export.sink_class(export_format).accepts_raw
+               and not fieldnames and not doc_filters and self.dedupe is None)
+
+        folder_path = os.path.join(download_path,
+                                   folder_name) if folder_name else download_path
+        os.makedirs(folder_path, exist_ok=True)
+
+        mapping_data = None
+        if not fieldnames and not raw:
+            mapping_data = self.get_mapping(host, index, metadata_timeout)
+            fieldnames = export.sink_class(export_format).fieldnames_from_mapping(mapping_data,
+                                                                                  index)
+        query = self.get_filters_query(host, index, timeout, doc_filters, mapping_data)
+
+        hosts = [host] + [endpoint for endpoint in endpoints or [] if endpoint != host]
+        outputs = export.slice_outputs(folder_path, filename, export_format, fieldnames,
+                                       max_file_size, max_docs_per_file, len(hosts))
+        output_locks = {output: threading.Lock() for output in outputs}
+
+        pit_id = self.open_pit(host, index, metadata_timeout)
+        readers = [core.make_reader(index, pit_id, self.SEARCH_SIZE, slice_id, len(hosts),
+                                    query=query)
+                   for slice_id in range(len(hosts))]
+        try:
+            if len(hosts) == 1:
+                self.download_slice(host, readers[0], timeout, outputs[0],
+                                    output_locks[outputs[0]], raw, doc_filters)
+            else:
+                # A slice whose node fails carries on from the others, the
+                # representative first
+                with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+                    futures = [executor.submit(self.download_slice, slice_host, readers[slice_id],
+                                               timeout, outputs[slice_id],
+                                               output_locks[outputs[slice_id]], raw,
+                                               doc_filters,
+                                               [other for other in hosts if other != slice_host])
+                               for slice_id, slice_host in enumerate(hosts)]
+                    for future in futures:
+                        future.result()
+        finally:
+            outputs = export.close_outputs(outputs)
+            totals = core.read_totals(readers, outputs)
+            manifest_path = export.write_manifest(folder_path, filename, index,
+                                                  export_format, outputs, totals)
+            if pit_id:
+                # Slices may have been handed a newer ID than the one we opened
+                for latest_pit_id in {reader.pit_id for reader in readers}:
+                    self.send_cleanup(host, core.close_pit_request(latest_pit_id),
+                                      metadata_timeout)
+
+        file_path = manifest_path if outputs[0].sharded else outputs[0].paths[0]
+        if totals.complete:
+            print(f"Index downloaded and saved to {file_path}")
+        else:
+            problem = export.count_problem(totals.expected_docs, totals.read_docs,
+                                           totals.skipped_docs, totals.written_docs)
+            print(f"Index download incomplete: {problem or 'the download did not finish'}, "
+                  f"see {manifest_path}")
+        return file_path
+
+    def download_index_single(self, index, fieldnames=None):
+        """Download a single index"""
+        print(f"Downloading {index}")
+        return self.download_index(self.host, index, None, index,
+                                   self.download_path, fieldnames=fieldnames,
+                                   export_format=self.export_format,
+                                   endpoints=self.endpoints)
+
+    def measure_throughput(self, host, index, timeout):
+        """Time one page of search results from the host
+
+        Returns:
+            float: bytes per second, or None if the page couldn't be read
+        """
+        request = planner.throughput_request(index)
+        try:
+            started = time.monotonic()
+            response = self.session.request(request.method, host + request.path,
+                                            params=request.params, json=request.body,
+                                            timeout=self.request_timeout(timeouts.SEARCH,
+                                                                         timeout))
+            return len(response.content) / max(time.monotonic() - started, 1e-3)
+        except Exception:
+            return None
+
+    def plan_downloads(self):
+        """Check that the filtered indices fit in `download_path` and print the plan
+
+        Returns:
+            planner.DownloadPlan: the plan, whose space is reserved until released
+        """
+        largest = max(self.filtered_indices, key=planner.store_bytes, default=None)
+        throughput = None
+        if largest is not None:
+            throughput = self.measure_throughput(self.host, largest.index, None)
+        plan = planner.plan_downloads(self.filtered_indices, self.download_path,
+                                      self.export_format, throughput, self.disk_full,
+                                      workers=self.max_workers * (1 + len(self.endpoints)))
+        print(plan.table(self.host))
+        if not plan.fits and self.disk_full == "refuse":
+            print(f"Not downloading from {self.host}: the indices don't fit in "
+                  f"{self.download_path}")
+        elif not plan.fits and self.disk_full == "trim":
+            print(f"Skipping {len(self.filtered_indices) - len(plan.selected)} indices "
+                  f"from {self.host} that don't fit in {self.download_path}")
+        return plan
+
     def download_indices(self):
-        """Download Filtered Indices"""
-        for Index in self.filtered_indices:
-            print(f"Downloading {Index.index}")
-            self.download_index(self.host, Index.index, self.timeout, Index.index, self.download_path)
-            
+        """Download Filtered Indices, `max_workers` at a time, skipping those
+        that don't fit on disk
+
+        An index that fails is reported and the others are still downloaded.
+
+        Returns:
+            list: whether each selected index was downloaded
+        """
+        def download_or_report(index):
+            try:
+                self.download_index_single(index)
+                return True
+            except Exception as ex:
+                print(f"Failed to download {self.host}/{index}: {ex}")
+                return False
+
+        plan = self.plan_downloads()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(download_or_report,
+                                         [Index.index for Index in plan.selected]))
+        finally:
+            plan.release()
+
+    def sample_index(self, host, index, size, timeout, download_path=os.getcwd(),
+                     folder_name=None, doc_filters=None):
+        """Save a random sample of an index, with stats on its fields
+
+        The sample is read with a single search, so even a large fleet of
+        indices can be triaged in seconds before deciding what to download.
+
+        Returns:
+            str: path of the sample file
+        """
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        folder_path = os.path.join(download_path,
+                                   folder_name) if folder_name else download_path
+        query = self.get_filters_query(host, index, timeout, doc_filters)
+        search_data = self.send_search(host, core.sample_request(index, size, query=query),
+                                       self.request_timeout(timeouts.SEARCH, timeout),
+                                       retry.QUICK)
+        hits = core.apply_doc_filters(search_data["hits"]["hits"], doc_filters)
+        total_hits = core.get_total_hits(search_data)
+        file_path = export.write_sample(folder_path, index, index, hits, total_hits)
+        print(f"Sampled {len(hits)} of {total_hits} documents from {index} to {file_path}")
+        return file_path
+
+    def sample_indices(self):
+        """Sample the filtered indices, `POOL_SIZE` at a time
+
+        Returns:
+            list: path of every sample file, or None for indices that failed
+        """
+        def sample_or_report(index):
+            try:
+                return self.sample_index(self.host, index, self.sample, None,
+                                         self.download_path)
+            except Exception as ex:
+                print(f"Failed to sample {self.host}/{index}: {ex}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=ElasticAPI.POOL_SIZE) as executor:
+            return list(executor.map(sample_or_report,
+                                     [Index.index for Index in self.filtered_indices]))
+
+    def profile_index(self, host, index, timeout, download_path=os.getcwd(),
+                      folder_name=None, doc_filters=None):
+        """Save a profile of an index, built from aggregations over its fields
+
+        Returns:
+            str: path of the profile file
+        """
+        if doc_filters is None:
+            doc_filters = self.doc_filters
+        folder_path = os.path.join(download_path,
+                                   folder_name) if folder_name else download_path
+        mapping_data = self.get_mapping(host, index, timeout)
+        fields = profile.profile_fields(mapping.mapping_properties(mapping_data, index))
+        query = self.get_filters_query(host, index, timeout, doc_filters, mapping_data)
+        search_timeout = self.request_timeout(timeouts.SEARCH, timeout)
+        responses = [self.send_search(host, request, search_timeout, retry.QUICK)
+                     for request in profile.profile_requests(index, fields, query)]
+        total_docs, field_stats = profile.parse_profile(fields, responses)
+        file_path = export.write_profile(folder_path, index, index, total_docs, field_stats)
+        print(f"Profiled {len(fields)} fields of {index} to {file_path}")
+        return file_path
+
+    def profile_indices(self):
+        """Profile the filtered indices, `POOL_SIZE` at a time
+
+        Returns:
+            list: path of every profile file, or None for indices that failed
+        """
+        def profile_or_report(index):
+            try:
+                return self.profile_index(self.host, index, None, self.download_path)
+            except Exception as ex:
+                print(f"Failed to profile {self.host}/{index}: {ex}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=ElasticAPI.POOL_SIZE) as executor:
+            return list(executor.map(profile_or_report,
+                                     [Index.index for Index in self.filtered_indices]))
+
     def automate(self):
-        self.is_elastic()
-        if self.iselastic is False:
-            return
-        self.get_db_info()
-        self.get_db_indicies()
+        if self.ElasticDB is None:
+            if not self.probe():
+                return
+        elif not self.indices:
+            self.get_db_indicies()
         self.filter_db_indices()
         print(f"{self.ElasticDB.name}")
-        print(f"{self.indices}")
\ No newline at end of file
+        for index in self.filtered_indices:
+            print(f"{index.index} | {index.docs_count} | {index.store_size} | "
+                  f"{self.host}/{index.index}/_search")
+
+        if self.profile:
+            self.profile_indices()
+        elif self.sample:
+            self.sample_indices()
+        elif self.download is True:
+            self.download_indices()
@@ -0,0 +1,567 @@
+# Export Writers
+"""Output files for downloaded indices.
+
+An export is written by one or more `RotatingOutput` writers. Without
+limits a writer produces the familiar `{filename}.{format}` file. With
+`max_file_size` or `max_docs_per_file` it produces numbered part files.
+
+Every download also gets a `{filename}.manifest.json` from
+`write_manifest`. It lists every part, so downstream jobs can load the
+parts in parallel. It also records:
+
+- the BLAKE2 checksum of every part, computed while the part is written;
+- how many documents the database said the index holds;
+- how many documents were read, so a truncated export doesn't pass for a
+  finished one.
+
+`verify_manifest` re-checks an export against its manifest without
+downloading it again.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+from abc import ABC, abstractmethod
+
+from elastic_api import core, mapping
+
+
+# Checksum of every part file
+CHECKSUM = "blake2b"
+# Bytes read at a time when checksumming a part file again
+CHECKSUM_CHUNK_SIZE = 1 << 20
+
+
+class CountingFile:
+    """Binary file that counts and checksums the bytes written to it"""
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.bytes = 0
+        self.hash = hashlib.new(CHECKSUM)
+
+    def write(self, data):
+        """Write bytes (or a memoryview of them) as they are"""
+        self.file.write(data)
+        self.hash.update(data)
+        self.bytes += len(data)
+
+    @property
+    def checksum(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+
+def select_fields(source, fieldnames):
+    """Only keep the fields we're interested in"""
+    if not fieldnames:
+        return source
+    return {key: value for key, value in source.items() if key in fieldnames}
+
+
+class ExportSink(ABC):
+    """Abstract base class for export formats.
+
+    A sink is created once per export writer and keeps its state (columns,
+    encoders, buffers) across pages. `encode` turns a page of documents into
+    one record per document; for every part file the sink is opened, handed
+    whole batches of records and closed:
+
+    ```
+    sink = sink_class('csv')(fieldnames)
+    records = sink.encode(sources)
+    sink.open(part_file)
+    sink.write_batch(records)
+    sink.close()
+    ```
+
+    Subclasses set `name`, which is both the export format and the file
+    extension, and are made available through `register_sink`.
+
+    Args:
+        fieldnames (list, optional): fields to export
+    """
+    name = None
+    # Whether raw `_source` spans from `passthrough.SourceStream` can be written as they are
+    accepts_raw = False
+    # Rough output bytes per byte of primary store, used by `planner` to check disk space
+    size_ratio = 1.0
+
+    def __init__(self, fieldnames=None):
+        self.fieldnames = fieldnames
+        self.file = None
+
+    @classmethod
+    def fieldnames_from_mapping(cls, mapping_data, index):
+        """Fieldnames to export an index with, from its decoded mapping"""
+        return core.fieldnames_from_mapping(mapping_data, index)
+
+    @abstractmethod
+    def encode(self, sources):
+        """Turn a page of `_source` dicts into records, one per document"""
+        pass
+
+    def encode_raw(self, sources):
+        """Turn raw `_source` spans into records, one per document"""
+        raise ValueError(f"The {self.name} format can't write raw documents")
+
+    def record_sizes(self, records):
+        """Bytes every record takes in a part file, so parts can rotate before
+        crossing `max_file_size`. None if only known once written, parts then
+        rotate on an estimate and may end up slightly larger."""
+        return None
+
+    def open(self, part_file):
+        """Start writing to a new part file"""
+        self.file = part_file
+
+    @abstractmethod
+    def write_batch(self, records):
+        """Write a batch of records to the open part file"""
+        pass
+
+    def close(self):
+        """Finish the part file, which the caller closes"""
+        self.file = None
+
+
+SINKS = {}
+
+
+def register_sink(sink):
+    """Make an ExportSink subclass available under its name, usable as a decorator"""
+    SINKS[sink.name] = sink
+    return sink
+
+
+def sink_class(export_format):
+    """Look up the ExportSink subclass for an export format
+
+    Raises:
+        ValueError: If no sink is registered for the format.
+    """
+    try:
+        return SINKS[export_format]
+    except KeyError:
+        raise ValueError(f"Invalid export format: {export_format}. "
+                         f"Supported formats are {', '.join(SINKS)}") from None
+
+
+def check_export_format(export_format):
+    """Raise ValueError for unsupported export formats"""
+    sink_class(export_format)
+
+
+@register_sink
+class CsvSink(ExportSink):
+    """Comma separated values, nested fields flattened into dotted columns
+    (see `mapping`). Every part starts with its own header so it can be
+    loaded on its own."""
+    name = 'csv'
+
+    def __init__(self, fieldnames=None):
+        super().__init__(fieldnames)
+        self.plan = mapping.FlatteningPlan(fieldnames) if fieldnames else None
+        # Rows are formatted into this buffer, then written to the part at once
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    @classmethod
+    def fieldnames_from_mapping(cls, mapping_data, index):
+        return mapping.plan_columns(mapping.mapping_properties(mapping_data, index))
+
+    def encode(self, sources):
+        if not sources:
+            return []
+        if self.plan is None:
+            # Without fieldnames the columns come from the first document
+            self.plan = mapping.FlatteningPlan(mapping.columns_from_source(sources[0]))
+        return self.plan.rows(sources)
+
+    def flush(self):
+        """Move the formatted rows from the buffer to the part file"""
+        self.file.write(self.buffer.getvalue().encode('utf8'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def open(self, part_file):
+        super().open(part_file)
+        self.writer.writerow(self.plan.columns if self.plan else [])
+        self.flush()
+
+    def write_batch(self, records):
+        self.writer.writerows(records)
+        self.flush()
+
+    def record_sizes(self, records):
+        # Rows are formatted twice, only paid for by exports with a size limit
+        sizes = []
+        for row in records:
+            self.writer.writerow(row)
+            sizes.append(len(self.buffer.getvalue().encode('utf8')))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        return sizes
+
+
+@register_sink
+class NdjsonSink(ExportSink):
+    """One JSON document per line"""
+    name = 'json'
+    accepts_raw = True
+    size_ratio = 1.2
+
+    def encode(self, sources):
+        fieldnames = self.fieldnames
+        return [json.dumps(select_fields(source, fieldnames)).encode('utf8')
+                for source in sources]
+
+    def encode_raw(self, sources):
+        return sources
+
+    def write_batch(self, records):
+        self.file.write(b'\n'.join(records) + b'\n')
+
+    def record_sizes(self, records):
+        return [len(record) + 1 for record in records]
+
+
+class RotatingOutput:
+    """Writes hits to an export file, rotating to a new part file when it is full.
+
+    Several writers can write parts of the same export concurrently, as long
+    as each has its own `series` (e.g. one per download slice).
+
+    Args:
+        folder_path (str): folder to write to
+        filename (str): base name of the export
+        export_format (str, optional): name of a registered ExportSink. Defaults to 'csv'.
+        fieldnames (list, optional): fields to export. For CSV these are the
+            (dotted) columns, by default the leaves of the first document.
+        max_file_size (int, optional): bytes per part file
+        max_docs_per_file (int, optional): documents per part file
+        series (int, optional): identifies this writer among concurrent writers
+    """
+    def __init__(self, folder_path, filename, export_format='csv', fieldnames=None,
+                 max_file_size=None, max_docs_per_file=None, series=None):
+        self.folder_path = folder_path
+        self.filename = filename
+        self.export_format = export_format
+        self.fieldnames = fieldnames
+        self.max_file_size = max_file_size
+        self.max_docs_per_file = max_docs_per_file
+        self.series = series
+        self.sink = sink_class(export_format)(fieldnames)
+
+        self.parts = []
+        self.part_file = None
+        self.part_docs = 0
+        # Documents read but dropped on purpose, see `skip`
+        self.skipped_docs = 0
+
+    @property
+    def sharded(self):
+        """Whether the export is split into part files"""
+        return bool(self.max_file_size or self.max_docs_per_file)
+
+    def part_path(self, part_number):
+        """Path of a part file"""
+        name = self.filename
+        if self.series is not None:
+            name += f".s{self.series:03d}"
+        if self.sharded:
+            name += f".part{part_number:04d}"
+        return os.path.join(self.folder_path, f"{name}.{self.sink.name}")
+
+    @property
+    def written_docs(self):
+        """Documents written so far"""
+        written = sum(part["docs"] for part in self.parts)
+        if self.part_file is not None:
+            # The current part records its documents when it is closed
+            written += self.part_docs
+        return written
+
+    @property
+    def paths(self):
+        """Paths of every part written so far"""
+        return [os.path.join(self.folder_path, part["file"]) for part in self.parts]
+
+    def part_full(self):
+        """Whether the current part reached one of its limits"""
+        if self.max_docs_per_file and self.part_docs >= self.max_docs_per_file:
+            return True
+        return bool(self.max_file_size and self.part_file.bytes >= self.max_file_size)
+
+    def open_part(self):
+        """Close the current part and start the next one"""
+        self.close_part()
+        path = self.part_path(len(self.parts) + 1)
+        self.part_file = CountingFile(path)
+        self.part_docs = 0
+        self.parts.append({"file": os.path.basename(path), "docs": 0, "bytes": 0,
+                           CHECKSUM: None})
+        self.sink.open(self.part_file)
+
+    def close_part(self):
+        """Close the current part and record its size"""
+        if self.part_file is None:
+            return
+        self.sink.close()
+        self.part_file.close()
+        self.parts[-1]["docs"] = self.part_docs
+        self.parts[-1]["bytes"] = self.part_file.bytes
+        self.parts[-1][CHECKSUM] = self.part_file.checksum
+        self.part_file = None
+
+    def fitting_docs(self, remaining, sizes=None, start=0):
+        """How many of the remaining documents go into the current part
+
+        With the `sizes` of the records (from `start` on) they are counted
+        exactly, 0 when the next one would cross `max_file_size`. A part
+        always takes at least one document, however large.
+        """
+        count = remaining
+        if self.max_docs_per_file:
+            count = min(count, self.max_docs_per_file - self.part_docs)
+        if self.max_file_size and sizes is not None:
+            room = self.max_file_size - self.part_file.bytes
+            fitting = 0
+            while fitting < count and sizes[start + fitting] <= room:
+                room -= sizes[start + fitting]
+                fitting += 1
+            return fitting if fitting or self.part_docs else min(count, 1)
+        if self.max_file_size:
+            if not self.part_docs:
+                # Write a single document first to learn how large documents are
+                return min(count, 1)
+            # Estimate from the documents written so far, re-checked after the write
+            doc_bytes = max(self.part_file.bytes // self.part_docs, 1)
+            count = min(count, max((self.max_file_size - self.part_file.bytes) // doc_bytes, 1))
+        return count
+
+    def write_records(self, records):
+        """Write encoded records, rotating part files as needed"""
+        sizes = self.sink.record_sizes(records) if self.max_file_size else None
+        start = 0
+        while start < len(records):
+            if self.part_file is None or self.part_full():
+                self.open_part()
+            count = self.fitting_docs(len(records) - start, sizes, start)
+            if not count:
+                # The next record would cross the size limit, it starts the next part
+                self.open_part()
+                continue
+            end = start + count
+            self.sink.write_batch(records[start:end])
+            self.part_docs += end - start
+            start = end
+
+    def write_hits(self, hits):
+        """Write a page of hits, rotating part files as needed"""
+        self.write_records(self.sink.encode([hit["_source"] for hit in hits]))
+
+    def write_sources(self, sources):
+        """Write raw `_source` spans (see `passthrough.SourceStream`) as they are,
+        rotating part files as needed"""
+        self.write_records(self.sink.encode_raw(sources))
+
+    def skip(self, count):
+        """Count documents that were read but left out of the export, by
+        document filters or deduplication"""
+        self.skipped_docs += count
+
+    def close(self):
+        """Close the export, returns the list of parts"""
+        if not self.parts:
+            # Nothing was written, still leave an (empty) export behind
+            self.open_part()
+        self.close_part()
+        return self.parts
+
+
+def export_hits(fetch_hits, data_file, fieldnames=None, export_format='csv', writeheader=False,
+                sink=None):
+    """Export Scroll Data
+
+    Args:
+        fetch_hits (list): list of hits we fetched
+        data_file (fileobj): binary file to write to
+        fieldnames (list): fieldnames (dotted CSV columns) to export (optional)
+        export_format (str): what fileformat to export in
+        writeheader (bool): write the CSV header before the hits
+        sink (ExportSink, optional): sink to reuse across pages
+
+    Returns:
+        ExportSink: the sink, to pass back in with the next page
+    """
+    if sink is None:
+        sink = sink_class(export_format)(fieldnames)
+    records = sink.encode([fetch_hit["_source"] for fetch_hit in fetch_hits])
+    if writeheader is True or sink.file is not data_file:
+        sink.open(data_file)
+    if records:
+        sink.write_batch(records)
+    return sink
+
+
+def write_manifest(folder_path, filename, index, export_format, outputs, totals=None):
+    """Write `{filename}.manifest.json`, listing the parts of every writer
+
+    Args:
+        totals (core.ReadTotals, optional): what the readers of the download
+            expected and read, and what the writers did with it
+
+    Returns:
+        str: path of the manifest
+    """
+    parts = [part for output in outputs for part in output.parts]
+    manifest = {
+        "index": index,
+        "format": export_format,
+        "docs": sum(part["docs"] for part in parts),
+        "bytes": sum(part["bytes"] for part in parts),
+    }
+    if totals is not None:
+        manifest.update(totals._asdict())
+    manifest["parts"] = parts
+    manifest_path = os.path.join(folder_path, f"{filename}.manifest.json")
+    with open(manifest_path, 'w', encoding='utf8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest_path
+
+
+def file_checksum(path):
+    """The CHECKSUM of a file, read a chunk at a time"""
+    file_hash = hashlib.new(CHECKSUM)
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(CHECKSUM_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def count_problem(expected_docs, read_docs, skipped_docs, written_docs):
+    """What is wrong with the document counts of a download
+
+    Returns:
+        str: the problem, None if every document the database expected was
+        read and then written or skipped
+    """
+    if expected_docs is None or read_docs is None:
+        return "no document counts recorded"
+    if read_docs != expected_docs:
+        return f"read {read_docs} of {expected_docs} documents"
+    if written_docs + (skipped_docs or 0) != read_docs:
+        return f"wrote {written_docs} of {read_docs - (skipped_docs or 0)} documents"
+    return None
+
+
+def verify_manifest(manifest_path):
+    """Check an export against its manifest, without the database
+
+    The export must have read every document the database expected, its
+    parts must hold every one of them that wasn't skipped, and every part
+    must still have its recorded size and checksum.
+
+    Returns:
+        list: what is wrong with the export, empty if nothing is
+    """
+    with open(manifest_path, encoding='utf8') as manifest_file:
+        manifest = json.load(manifest_file)
+    problems = []
+    # The documents on disk, as counted by the parts whose checksums are checked below
+    problem = count_problem(manifest.get("expected_docs"), manifest.get("read_docs"),
+                            manifest.get("skipped_docs"),
+                            sum(part["docs"] for part in manifest.get("parts", [])))
+    if problem:
+        problems.append(problem)
+    elif not manifest.get("complete"):
+        problems.append("the download didn't finish")
+    folder_path = os.path.dirname(manifest_path)
+    for part in manifest.get("parts", []):
+        path = os.path.join(folder_path, part["file"])
+        if not os.path.exists(path):
+            problems.append(f"{part['file']} is missing")
+        elif os.path.getsize(path) != part["bytes"]:
+            problems.append(f"{part['file']} is {os.path.getsize(path)} bytes, "
+                            f"expected {part['bytes']}")
+        elif not part.get(CHECKSUM):
+            problems.append(f"{part['file']} has no checksum recorded")
+        elif file_checksum(path) != part[CHECKSUM]:
+            problems.append(f"{part['file']} doesn't match its checksum")
+    return problems
+
+
+def find_manifests(folder_path):
+    """Paths of every manifest under a folder, sorted"""
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(folder_path)
+                  for name in names if name.endswith(".manifest.json"))
+
+
+def write_sample(folder_path, filename, index, hits, total_hits):
+    """Write `{filename}.sample.json`, with the field stats and documents of a sample
+
+    Returns:
+        str: path of the sample file
+    """
+    sources = [hit["_source"] for hit in hits]
+    sample = {
+        "index": index,
+        "total_docs": total_hits,
+        "sample_docs": len(sources),
+        "fields": mapping.field_stats(sources),
+        "docs": sources,
+    }
+    os.makedirs(folder_path, exist_ok=True)
+    sample_path = os.path.join(folder_path, f"{filename}.sample.json")
+    with open(sample_path, 'w', encoding='utf8') as sample_file:
+        json.dump(sample, sample_file, ensure_ascii=False, separators=(",", ":"))
+    return sample_path
+
+
+def write_profile(folder_path, filename, index, total_docs, fields):
+    """Write `{filename}.profile.json`, with the stats of every field of an index
+
+    Returns:
+        str: path of the profile file
+    """
+    index_profile = {
+        "index": index,
+        "total_docs": total_docs,
+        "fields": fields,
+    }
+    os.makedirs(folder_path, exist_ok=True)
+    profile_path = os.path.join(folder_path, f"{filename}.profile.json")
+    with open(profile_path, 'w', encoding='utf8') as profile_file:
+        json.dump(index_profile, profile_file, ensure_ascii=False, separators=(",", ":"))
+    return profile_path
+
+
+def slice_outputs(folder_path, filename, export_format='csv', fieldnames=None,
+                  max_file_size=None, max_docs_per_file=None, max_slices=1):
+    """Writers for each slice of a download
+
+    Sharded exports give every slice its own series of part files, so the
+    slices write concurrently. Otherwise every slice shares one writer.
+
+    Returns:
+        list: the writer of every slice
+    """
+    if (max_file_size or max_docs_per_file) and max_slices > 1:
+        return [RotatingOutput(folder_path, filename, export_format, fieldnames,
+                               max_file_size, max_docs_per_file, series=slice_id)
+                for slice_id in range(max_slices)]
+    output = RotatingOutput(folder_path, filename, export_format, fieldnames,
+                            max_file_size, max_docs_per_file)
+    return [output] * max_slices
+
+
+def close_outputs(outputs):
+    """Close every distinct writer, returns them"""
+    outputs = list(dict.fromkeys(outputs))
+    for output in outputs:
+        output.close()
+    return outputs
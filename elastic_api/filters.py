@@ -4,8 +4,14 @@ import re
 
 from typing import List
 from datetime import datetime
+from elastic_api import mapping
 from elastic_api.abstract_filters import Filter, DictFilter
 
+# Mapping types a regexp query matches on the value exactly as it was indexed
+EXACT_KEYWORD_TYPES = ('keyword', 'constant_keyword', 'wildcard')
+# Patterns that mean the same to Python's re and to Elasticsearch's regexp
+LITERAL_PATTERN = re.compile(r'[A-Za-z0-9]+')
+
 class RegexFilter(Filter):
     def __init__(self, field_name):
         super().__init__()
@@ -73,37 +79,75 @@ class DateRangeFilter(Filter):
         return filtered_items
     
 class RegexDictFilter(DictFilter):
-    def __init__(self, field_name, pattern):
+    """A filter that keeps documents whose field matches any of its patterns.
+
+    Patterns are added with `add_filter` and matched case-insensitively, like
+    RegexFilter. They are compiled into a single regex the first time the
+    filter runs, so each page is filtered in one pass. Array values match when
+    any of their values does.
+    """
+    def __init__(self, field_name, pattern=None):
         super().__init__()
         self.field_name = field_name
-        self.pattern = re.compile(pattern)
+        # Dotted path of the field, as the database knows it
+        self.path = field_name
+        self.pattern = None
+        if pattern is not None:
+            self.add_filter(pattern)
 
-    def apply(self, items: List[dict]):
-        filtered_items = []
-        for item in items:
-            value = item.get(self.field_name)
-            if value and self.pattern.search(value):
-                filtered_items.append(item)
-        return filtered_items
-    
-class NestedRegexDictFilter(DictFilter):
-    def __init__(self, field_name, pattern):
-        super().__init__()
-        self.field_name = field_name.split('.')
-        self.pattern = re.compile(pattern)
+    def add_filter(self, f):
+        super().add_filter(f)
+        self.pattern = None
+
+    def compile(self):
+        """Compile the patterns into a single regex"""
+        if self.pattern is None:
+            # Without patterns nothing matches, like RegexFilter
+            self.pattern = re.compile('|'.join(f'(?:{f})' for f in self.filters) or '(?!)',
+                                      flags=re.IGNORECASE)
+        return self.pattern
+
+    def get_value(self, item):
+        return item.get(self.field_name)
 
     def apply(self, items: List[dict]):
-        filtered_items = []
-        for item in items:
-            value = self.get_nested_value(item, self.field_name)
-            if value and self.pattern.search(value):
-                filtered_items.append(item)
-        return filtered_items
+        search = self.compile().search
+        get_value = self.get_value
+
+        def matches(value):
+            if value is None:
+                return False
+            if isinstance(value, list):
+                return any(matches(element) for element in value)
+            return search(value if isinstance(value, str) else str(value)) is not None
+
+        return [item for item in items if matches(get_value(item))]
+
+    def to_query(self, fields: dict):
+        """Translate into a `regexp` query when that matches exactly what the
+        regex does: the patterns are plain letters and digits, and the field
+        is a keyword field that stores values as they are"""
+        field = fields.get(self.path)
+        if (not field or field.get("type") not in EXACT_KEYWORD_TYPES
+                or field.get("normalizer") or "ignore_above" in field):
+            return None
+        if not self.filters or not all(LITERAL_PATTERN.fullmatch(f) for f in self.filters):
+            return None
+        # Spelled out case-insensitively, which every version supports
+        alternatives = '|'.join(''.join(f"[{char.lower()}{char.upper()}]" if char.isalpha()
+                                        else char for char in f)
+                                for f in self.filters)
+        return {"regexp": {self.path: {"value": f".*({alternatives}).*"}}}
+
+class NestedRegexDictFilter(RegexDictFilter):
+    """A RegexDictFilter on a nested field, e.g. `address.city`.
+
+    The dotted path is split once; values inside arrays of objects are
+    all matched.
+    """
+    def __init__(self, field_name, pattern=None):
+        super().__init__(field_name, pattern)
+        self.field_name = tuple(field_name.split('.'))
 
-    def get_nested_value(self, item, field_name):
-        for field in field_name:
-            if isinstance(item, dict):
-                item = item.get(field)
-            else:
-                return None
-        return item
+    def get_value(self, item):
+        return mapping.resolve(item, self.field_name)
@@ -0,0 +1,186 @@
+# Mapping-driven flattening
+"""Turn nested documents into flat CSV rows.
+
+A CSV export needs a fixed set of columns, but documents nest objects and
+arrays. `plan_columns` compiles an index mapping into one column per leaf
+field, named by its dotted path (`address.geo.lat`), and `FlatteningPlan`
+precompiles one accessor per column so a page becomes rows in a single
+pass, without looking at the keys of every document:
+
+```
+plan = FlatteningPlan(plan_columns(mapping_properties(mapping_data, "users")))
+writer.writerow(plan.columns)
+writer.writerows(plan.rows(hit["_source"] for hit in hits))
+```
+"""
+import json
+
+from elastic_api import core
+
+# Values that don't fit in a single CSV cell and are written as JSON
+CONTAINERS = (dict, list)
+# JSON type of the values found in `_source`
+JSON_TYPES = {str: "string", int: "number", float: "number", bool: "boolean",
+              type(None): "null", list: "array", dict: "object"}
+# Longest example kept by `field_stats`
+EXAMPLE_LENGTH = 80
+
+
+def mapping_properties(mapping_data, index):
+    """Get the top-level properties from a decoded `{index}/_mapping` response"""
+    mappings = mapping_data[index]["mappings"]
+    if "properties" in mappings:
+        return mappings["properties"]
+    # Before 7.0 the properties are grouped by document type
+    properties = {}
+    for type_mapping in mappings.values():
+        if isinstance(type_mapping, dict):
+            properties.update(type_mapping.get("properties", {}))
+    return properties
+
+
+def plan_columns(properties, prefix=""):
+    """Dotted path of every exportable leaf field of a mapping
+
+    Objects and nested fields are flattened into their sub-fields. Multi-fields
+    (`name.keyword`) are left out as they are not part of `_source`.
+
+    Example:
+        >>> plan_columns({"name": {"type": "text"},
+        ...               "address": {"properties": {"city": {"type": "keyword"}}}})
+        ['name', 'address.city']
+    """
+    columns = []
+    for name, field_mapping in properties.items():
+        path = prefix + name
+        if field_mapping.get("properties"):
+            columns.extend(plan_columns(field_mapping["properties"], path + "."))
+        elif field_mapping.get("type") not in core.DISALLOWED_TYPES:
+            columns.append(path)
+    return columns
+
+
+def queryable_fields(properties, prefix=""):
+    """Mapping of every leaf field a top-level query can address, by dotted path
+
+    Fields inside `nested` objects are left out, they need a nested query.
+    """
+    fields = {}
+    for name, field_mapping in properties.items():
+        path = prefix + name
+        if field_mapping.get("properties"):
+            if field_mapping.get("type") != "nested":
+                fields.update(queryable_fields(field_mapping["properties"], path + "."))
+        else:
+            fields[path] = field_mapping
+    return fields
+
+
+def columns_from_source(source, prefix=""):
+    """Dotted path of every leaf of a document, for exports without a mapping"""
+    columns = []
+    for name, value in source.items():
+        if isinstance(value, dict) and value:
+            columns.extend(columns_from_source(value, prefix + name + "."))
+        else:
+            columns.append(prefix + name)
+    return columns
+
+
+def leaf_values(source, prefix=""):
+    """Dotted path and value of every leaf of a document"""
+    for name, value in source.items():
+        if isinstance(value, dict) and value:
+            yield from leaf_values(value, prefix + name + ".")
+        else:
+            yield prefix + name, value
+
+
+def field_stats(sources):
+    """Summarize the fields of a sample of documents, by dotted path
+
+    Every field records how many documents have it, the JSON types of its
+    values and one non-empty example, so a sample shows what an index
+    holds without reading the documents.
+    """
+    stats = {}
+    for source in sources:
+        for path, value in leaf_values(source):
+            field = stats.get(path)
+            if field is None:
+                field = stats[path] = {"docs": 0, "types": [], "example": None}
+            field["docs"] += 1
+            type_name = JSON_TYPES.get(type(value), "object")
+            if type_name not in field["types"]:
+                field["types"].append(type_name)
+            if field["example"] is None and value not in (None, "", [], {}):
+                example = cell(value)
+                if isinstance(example, str) and len(example) > EXAMPLE_LENGTH:
+                    example = example[:EXAMPLE_LENGTH] + "..."
+                field["example"] = example
+    return stats
+
+
+def cell(value):
+    """Format a value for a CSV cell"""
+    if isinstance(value, CONTAINERS):
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+    return value
+
+
+def resolve(value, parts):
+    """Follow a path through nested objects, collecting values across arrays of objects"""
+    for part in parts:
+        if type(value) is dict:
+            value = value.get(part)
+        elif type(value) is list:
+            collected = []
+            for item in value:
+                item = resolve(item, (part,))
+                if type(item) is list:
+                    collected.extend(item)
+                elif item is not None:
+                    collected.append(item)
+            value = collected or None
+        else:
+            return None
+    return value
+
+
+def compile_accessor(column):
+    """Build the function that reads a column's cell from a document"""
+    if "." not in column:
+        def accessor(source):
+            value = source.get(column)
+            return cell(value) if type(value) in CONTAINERS else value
+        return accessor
+
+    parts = tuple(column.split("."))
+
+    def dotted_accessor(source):
+        value = resolve(source, parts)
+        if value is None:
+            # Documents may also be indexed with the dotted name as a plain key
+            value = source.get(column)
+        return cell(value) if type(value) in CONTAINERS else value
+    return dotted_accessor
+
+
+class FlatteningPlan:
+    """Fixed columns and the precompiled accessors that fill them.
+
+    Args:
+        columns (list): dotted paths of the columns, in order
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.accessors = [compile_accessor(column) for column in self.columns]
+
+    def row(self, source):
+        """Flatten a single document"""
+        return [accessor(source) for accessor in self.accessors]
+
+    def rows(self, sources):
+        """Flatten a page of documents"""
+        accessors = self.accessors
+        return [[accessor(source) for accessor in accessors] for source in sources]
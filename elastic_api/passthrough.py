@@ -0,0 +1,282 @@
+# Raw Passthrough
+"""Stream the documents of a search response to disk without decoding them.
+
+A full read spends most of its time turning every page into Python
+objects only to serialize each `_source` straight back to JSON. For
+NDJSON exports without field filtering `SourceStream` skips that work:
+it is fed the response body chunk by chunk, finds the `hits.hits[*]._source`
+spans with an incremental tokenizer and hands them over as memoryview
+slices, byte for byte as the database sent them. Only the handful of
+values the readers need to continue (scroll/point in time ID, total hits
+and the last sort values) are decoded.
+
+```
+stream = SourceStream(output.write_sources)
+async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+    stream.feed(chunk)
+page = stream.close()
+```
+"""
+import json
+import re
+
+from elastic_api import core
+
+# Bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+# A structural character, a string or a bare literal (number, true, false, null)
+TOKEN = re.compile(rb'([{}\[\]:,])|"([^"\\]*(?:\\.[^"\\]*)*)("?)|([^\s{}\[\]:,"]+)', re.S)
+# Everything up to the next bracket or incomplete string, complete strings included
+SKIP = re.compile(rb'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.S)
+WHITESPACE = re.compile(rb'\s*')
+
+STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+SCALAR = rb'(?:' + STRING + rb'|[^\s{}\[\]:,"]+)'
+FLAT_ARRAY = rb'\[\s*(?:' + SCALAR + rb'\s*(?:,\s*' + SCALAR + rb'\s*)*)?\]'
+FIELD_VALUE = rb'\s*:\s*(?:' + SCALAR + rb'|' + FLAT_ARRAY + rb')'
+# Text between brackets, complete strings included
+PLAIN = rb'[^"{}\[\]]*(?:' + STRING + rb'[^"{}\[\]]*)*'
+# A complete `_source` nested at most SOURCE_NESTING levels deep. Unrolled so
+# a failed match (the source continues in the next chunk) stays linear.
+SOURCE_NESTING = 4
+NESTED = rb'[{\[]' + PLAIN + rb'[}\]]'
+for _ in range(SOURCE_NESTING - 1):
+    NESTED = rb'[{\[]' + PLAIN + rb'(?:' + NESTED + PLAIN + rb')*[}\]]'
+SOURCE = rb'\{' + PLAIN + rb'(?:' + NESTED + PLAIN + rb')*\}'
+
+# Fast paths for the usual shape of a hit, where the fields around `_source`
+# are scalars or flat arrays. HIT reads a whole hit at once; HIT_HEAD reads up
+# to and including the opening brace of the `_source`, and HIT_TAIL from its
+# end to the end of the hit. Anything else goes through the tokenizer.
+HIT_FIELDS = rb'\s*,?\s*\{\s*(?:' + STRING + FIELD_VALUE + rb'\s*,\s*)*"_source"\s*:\s*'
+HIT_TAIL_FIELDS = (rb'(?:\s*,\s*(?:"sort"\s*:\s*(' + FLAT_ARRAY + rb')|' + STRING + FIELD_VALUE
+                   + rb'))*\s*\}')
+HIT = re.compile(HIT_FIELDS + rb'(' + SOURCE + rb')' + HIT_TAIL_FIELDS, re.S)
+HIT_HEAD = re.compile(HIT_FIELDS + rb'\{', re.S)
+HIT_TAIL = re.compile(HIT_TAIL_FIELDS, re.S)
+
+OPENING = b'{['
+CLOSING = b'}]'
+
+
+class SourceStream:
+    """Incremental scanner that extracts the `_source` of every hit from a search response.
+
+    Every complete `_source` is passed to `on_sources` as a list of
+    memoryview slices; the views are only valid during the call. Sources
+    split across chunks are the only bytes kept between chunks, so memory
+    is bounded by the chunk and document size instead of the page size.
+
+    Args:
+        on_sources (callable): called with the list of sources completed by each chunk
+    """
+    def __init__(self, on_sources):
+        self.on_sources = on_sources
+        self.data = bytearray()
+        self.pos = 0
+
+        # One [is_object, key, index] entry per open container of the envelope
+        self.stack = []
+        # Depth inside the `_source` being copied, 0 outside of one
+        self.source_depth = 0
+        self.source_start = None
+        # Start and stack depth of the value being captured, if any
+        self.capture_start = None
+        self.capture_depth = None
+        self.capture_key = None
+
+        self.values = {}
+        self.hit_count = 0
+        self.has_hits = False
+        # Raw sort values of the last hit, only decoded once the response ends
+        self.last_sort = None
+
+    def value_key(self):
+        """Name of the value starting at the current position, if it is one we want
+
+        Returns:
+            bytes: b'_source', one of the captured keys, or None
+        """
+        stack = self.stack
+        depth = len(stack)
+        if not depth or not stack[-1][0]:
+            return None
+        key = stack[-1][1]
+        if depth == 1:
+            if key in (b'_scroll_id', b'pit_id'):
+                return key
+            if key == b'hits':
+                self.has_hits = True
+        elif depth == 2:
+            if key == b'total' and stack[0][1] == b'hits':
+                return key
+        elif depth == 4:
+            if ((key == b'_source' or key == b'sort') and stack[0][1] == b'hits'
+                    and stack[1][1] == b'hits' and not stack[2][0]):
+                return key
+        return None
+
+    def is_hit(self):
+        """Whether the container on top of the stack is a hit"""
+        stack = self.stack
+        return (len(stack) == 4 and stack[3][0] and not stack[2][0]
+                and stack[0][1] == b'hits' and stack[1][1] == b'hits')
+
+    def in_hits(self):
+        """Whether the container on top of the stack is the `hits.hits` array"""
+        stack = self.stack
+        return (len(stack) == 3 and not stack[2][0]
+                and stack[0][1] == b'hits' and stack[1][1] == b'hits')
+
+    def end_value(self, end):
+        """A value of the envelope ended at `end`"""
+        if self.capture_start is not None and len(self.stack) == self.capture_depth:
+            value = bytes(self.data[self.capture_start:end])
+            if self.capture_key == b'sort':
+                self.last_sort = value
+            else:
+                self.values[self.capture_key] = json.loads(value)
+            self.capture_start = None
+
+    def copy_source(self, view, sources):
+        """Scan the `_source` being copied, returns False when more data is needed"""
+        data = self.data
+        while True:
+            self.pos = SKIP.match(data, self.pos).end()
+            if self.pos == len(data) or data[self.pos] == 0x22:
+                # Out of data, or a string that continues in the next chunk
+                return False
+            if data[self.pos] in OPENING:
+                self.source_depth += 1
+            else:
+                self.source_depth -= 1
+            self.pos += 1
+            if not self.source_depth:
+                sources.append(view[self.source_start:self.pos])
+                self.source_start = None
+                return True
+
+    def scan(self, view, sources, final):
+        """Tokenize as much of the buffered data as possible"""
+        data = self.data
+        stack = self.stack
+        while True:
+            if self.source_depth:
+                if not self.copy_source(view, sources):
+                    return
+                match = HIT_TAIL.match(data, self.pos) if self.is_hit() else None
+                if match:
+                    if match.group(1) is not None:
+                        self.last_sort = match.group(1)
+                    self.hit_count += 1
+                    stack.pop()
+                    self.pos = match.end()
+            if self.in_hits():
+                match = HIT.match(data, self.pos)
+                while match:
+                    sources.append(view[match.start(1):match.end(1)])
+                    if match.group(2) is not None:
+                        self.last_sort = match.group(2)
+                    self.hit_count += 1
+                    self.pos = match.end()
+                    match = HIT.match(data, self.pos)
+                match = HIT_HEAD.match(data, self.pos)
+                if match:
+                    stack.append([True, b'_source', 0])
+                    self.pos = match.end()
+                    self.source_start = self.pos - 1
+                    self.source_depth = 1
+                    continue
+            start = self.pos = WHITESPACE.match(data, self.pos).end()
+            if start == len(data):
+                return
+            match = TOKEN.match(data, start)
+            char, string, closing_quote, literal = match.groups()
+            if (string is not None and not closing_quote) or (
+                    literal is not None and match.end() == len(data) and not final):
+                # The token continues in the next chunk
+                return
+            self.pos = match.end()
+
+            if char is not None:
+                if char in OPENING:
+                    key = self.value_key()
+                    if key == b'_source':
+                        self.source_start = start
+                        self.source_depth = 1
+                        continue
+                    if key is not None and self.capture_start is None:
+                        self.capture_start = start
+                        self.capture_depth = len(stack)
+                        self.capture_key = key
+                    stack.append([char == b'{', None, 0])
+                elif char in CLOSING:
+                    if self.is_hit():
+                        self.hit_count += 1
+                    stack.pop()
+                    self.end_value(self.pos)
+                elif char == b',':
+                    if stack[-1][0]:
+                        stack[-1][1] = None
+                    else:
+                        stack[-1][2] += 1
+                continue
+
+            if string is not None and stack and stack[-1][0] and stack[-1][1] is None:
+                stack[-1][1] = string
+                continue
+            # A scalar value
+            key = self.value_key()
+            if key is not None and self.capture_start is None:
+                self.values[key] = json.loads(bytes(data[start:self.pos]))
+
+    def feed(self, chunk, final=False):
+        """Consume the next chunk of the response body"""
+        self.data += chunk
+        sources = []
+        with memoryview(self.data) as view:
+            self.scan(view, sources, final)
+            if sources:
+                self.on_sources(sources)
+            for source in sources:
+                source.release()
+
+        # Drop what was consumed, keeping any partial token, source or captured value
+        keep = self.pos
+        for start in (self.source_start, self.capture_start):
+            if start is not None:
+                keep = min(keep, start)
+        if keep:
+            del self.data[:keep]
+            self.pos -= keep
+            if self.source_start is not None:
+                self.source_start -= keep
+            if self.capture_start is not None:
+                self.capture_start -= keep
+
+    def close(self):
+        """Finish the response
+
+        Returns:
+            core.Page: what the reader needs to continue
+
+        Raises:
+            ValueError: If the response was cut short or carries no hits.
+        """
+        self.feed(b'', final=True)
+        if self.stack or self.source_depth or self.data.strip():
+            raise ValueError("Search response ended unexpectedly")
+        if not self.has_hits:
+            raise ValueError(f"Search response has no hits: {self.values}")
+
+        total_hits = self.values.get(b'total')
+        if isinstance(total_hits, dict):
+            total_hits = total_hits.get("value")
+        if not isinstance(total_hits, int):
+            total_hits = self.hit_count
+        return core.Page(scroll_id=self.values.get(b'_scroll_id'),
+                         pit_id=self.values.get(b'pit_id'),
+                         total_hits=total_hits,
+                         hit_count=self.hit_count,
+                         last_sort=json.loads(self.last_sort) if self.last_sort else None)
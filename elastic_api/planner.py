@@ -0,0 +1,225 @@
+# Download Planner
+"""Check that a download fits on disk before any data is transferred.
+
+`plan_downloads` estimates how much every filtered index takes once
+exported, from the primary store size reported by `_cat/indices` and the
+`size_ratio` of the export format, and compares the total with the free
+space of the download path. Indices that don't fit are either skipped
+(`trim`) or the whole download is called off (`refuse`):
+
+```
+plan = plan_downloads(api.filtered_indices, download_path, "csv", throughput)
+print(plan.table())
+for Index in plan.selected:
+    ...
+plan.release()
+```
+
+Plans running at the same time (one per cluster) reserve the space they
+selected, so they don't all count on the same free bytes.
+"""
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+
+import prettytable
+
+from elastic_api import core, export
+
+# What to do when the filtered indices don't all fit
+DISK_FULL_POLICIES = ("trim", "refuse", "ignore")
+# Free space left untouched, as a fraction of the whole disk
+DISK_HEADROOM = 0.02
+# Bytes of search response per byte of primary store, for duration estimates
+TRANSFER_RATIO = 1.3
+# Documents read to measure the throughput of a host
+THROUGHPUT_SAMPLE_SIZE = 500
+
+_reserved = {}
+_reserved_lock = threading.RLock()
+
+
+@dataclass
+class PlannedIndex:
+    """
+    Estimates for downloading one index
+    """
+    index: core.ElasticIndex
+    store_bytes: int
+    output_bytes: int
+    seconds: float = None
+    selected: bool = True
+
+
+def existing_parent(path):
+    """The path itself or its closest parent that exists"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def store_bytes(index):
+    """Primary store size of an index in bytes, 0 if it is unknown
+
+    The exact size from `_stats` is used when there is one, `_cat/indices`
+    rounds its sizes.
+    """
+    if index.stats is not None:
+        for size in (index.stats.pri_store_bytes, index.stats.store_bytes):
+            if size is not None:
+                return size
+    for size in (index.pri_store_size, index.store_size):
+        try:
+            return core.parse_size(size)
+        except ValueError:
+            continue
+    return 0
+
+
+def format_duration(seconds):
+    """Format a duration in seconds like "1h 05m", "3m 20s" or "12s" """
+    if seconds is None:
+        return "?"
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def throughput_request(index):
+    """Build the search used to measure how fast a host sends documents"""
+    return core.SearchRequest("POST", f"/{index}/_search", None,
+                              {"size": THROUGHPUT_SAMPLE_SIZE})
+
+
+class DownloadPlan:
+    """The estimates for a set of indices, and which of them will be downloaded.
+
+    Args:
+        entries (list): PlannedIndex of every index, in download order
+        download_path (str): where the indices are written
+        free_bytes (int): space available to this plan
+        policy (str): one of DISK_FULL_POLICIES
+        workers (int, optional): indices downloaded in parallel. Defaults to 1.
+    """
+    def __init__(self, entries, download_path, free_bytes, policy, workers=1):
+        self.entries = entries
+        self.download_path = download_path
+        self.free_bytes = free_bytes
+        self.policy = policy
+        self.workers = max(workers, 1)
+        self.device = os.stat(existing_parent(download_path)).st_dev
+        self.reserved_bytes = 0
+
+        planned = 0
+        for entry in entries:
+            entry.selected = policy == "ignore" or planned + entry.output_bytes <= free_bytes
+            if entry.selected:
+                planned += entry.output_bytes
+        self.fits = all(entry.selected for entry in entries)
+        if policy == "refuse" and not self.fits:
+            for entry in entries:
+                entry.selected = False
+
+    @property
+    def selected(self):
+        """The ElasticIndex of every index that will be downloaded"""
+        return [entry.index for entry in self.entries if entry.selected]
+
+    @property
+    def output_bytes(self):
+        """Estimated size of the selected indices once exported"""
+        return sum(entry.output_bytes for entry in self.entries if entry.selected)
+
+    @property
+    def seconds(self):
+        """Estimated duration of the selected downloads, None if unknown"""
+        durations = [entry.seconds for entry in self.entries if entry.selected]
+        if any(seconds is None for seconds in durations):
+            return None
+        return sum(durations) / self.workers
+
+    def reserve(self):
+        """Hold the space of the selected indices against other plans"""
+        with _reserved_lock:
+            _reserved[self.device] = _reserved.get(self.device, 0) + self.output_bytes
+            self.reserved_bytes = self.output_bytes
+
+    def release(self):
+        """Give the reserved space back, once the downloads are done"""
+        with _reserved_lock:
+            _reserved[self.device] = _reserved.get(self.device, 0) - self.reserved_bytes
+            self.reserved_bytes = 0
+
+    def table(self, title=None):
+        """Render the plan for review
+
+        Returns:
+            prettytable.PrettyTable: one row per index, with the totals as title
+        """
+        table = prettytable.PrettyTable()
+        table.field_names = ["Index", "Docs Count", "Store Size", "Est. Output",
+                             "Est. Duration", "Action"]
+        table.align["Index"] = "l"
+        for field_name in table.field_names[1:5]:
+            table.align[field_name] = "r"
+        for entry in self.entries:
+            table.add_row([entry.index.index, entry.index.docs_count,
+                           core.format_size(entry.store_bytes),
+                           core.format_size(entry.output_bytes),
+                           format_duration(entry.seconds),
+                           "download" if entry.selected else "skip"])
+        needed_bytes = sum(entry.output_bytes for entry in self.entries)
+        summary = (f"{core.format_size(self.output_bytes)} of {core.format_size(needed_bytes)} "
+                   f"planned, {core.format_size(self.free_bytes)} free in "
+                   f"{self.download_path}, about {format_duration(self.seconds)}")
+        table.title = f"{title} | {summary}" if title else summary
+        return table
+
+
+def plan_downloads(indices, download_path, export_format='csv', throughput=None,
+                   policy='trim', workers=1, reserve=True):
+    """Plan the download of `indices` into `download_path`
+
+    Args:
+        indices (list): ElasticIndex to download, in order
+        download_path (str): where the indices are written
+        export_format (str, optional): export format. Defaults to 'csv'.
+        throughput (float, optional): observed bytes per second from the host,
+            for duration estimates
+        policy (str, optional): what to do when they don't all fit, one of
+            DISK_FULL_POLICIES. Defaults to 'trim'.
+        workers (int, optional): indices downloaded in parallel. Defaults to 1.
+        reserve (bool, optional): reserve the selected space against other plans
+
+    Raises:
+        ValueError: If the policy is unknown.
+
+    Returns:
+        DownloadPlan: the plan
+    """
+    if policy not in DISK_FULL_POLICIES:
+        raise ValueError(f"Invalid disk full policy: {policy}. "
+                         f"Supported policies are {', '.join(DISK_FULL_POLICIES)}")
+    size_ratio = export.sink_class(export_format).size_ratio
+    entries = []
+    for index in indices:
+        index_bytes = store_bytes(index)
+        seconds = index_bytes * TRANSFER_RATIO / throughput if throughput else None
+        entries.append(PlannedIndex(index, index_bytes, int(index_bytes * size_ratio), seconds))
+
+    usage = shutil.disk_usage(existing_parent(download_path))
+    device = os.stat(existing_parent(download_path)).st_dev
+    with _reserved_lock:
+        free_bytes = usage.free - _reserved.get(device, 0) - int(usage.total * DISK_HEADROOM)
+        plan = DownloadPlan(entries, download_path, max(free_bytes, 0), policy, workers)
+        if reserve:
+            plan.reserve()
+    return plan
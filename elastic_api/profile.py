@@ -0,0 +1,144 @@
+# Index Profiles
+"""Describe what an index holds with aggregations instead of a download.
+
+A profile answers "what is in this index" from the database's own
+aggregations: for every field of the mapping, how many documents lack
+it, how many distinct values it has, its most common values, and the
+range of numbers and dates. It costs a few small searches per index,
+whatever the size of the index:
+
+```
+fields = profile_fields(mapping_properties(mapping_data, index))
+responses = [send(request) for request in profile_requests(index, fields)]
+total_docs, stats = parse_profile(fields, responses)
+```
+
+Fields are aggregated in batches of `BATCH_SIZE`, so wide mappings don't
+run into the bucket or request size limits of the database.
+"""
+from collections import namedtuple
+
+from elastic_api import core, mapping
+
+# Fields aggregated by one search
+BATCH_SIZE = 25
+# Most common values kept per field
+TOP_VALUES = 10
+# Fields with values worth listing
+TERMS_TYPES = {"keyword", "constant_keyword", "wildcard", "ip", "boolean", "version"}
+# Fields with a meaningful min and max
+RANGE_TYPES = {"long", "integer", "short", "byte", "double", "float", "half_float",
+               "scaled_float", "unsigned_long", "date", "date_nanos"}
+# Fields that can't be profiled at all
+UNPROFILED_TYPES = set(core.DISALLOWED_TYPES) | {"binary", "object", "nested"}
+
+# A field of the mapping and how to aggregate it. `agg_field` is the field the
+# aggregations run on (e.g. `name.keyword` for a text field `name`), None when
+# only its presence can be counted.
+ProfileField = namedtuple("ProfileField", ["path", "type", "agg_field"])
+
+
+def keyword_subfield(path, field_mapping):
+    """The keyword multi-field of a text field, if it has one"""
+    for name, subfield in field_mapping.get("fields", {}).items():
+        if subfield.get("type") == "keyword":
+            return f"{path}.{name}"
+    return None
+
+
+def profile_fields(properties):
+    """Every field of a mapping that can be profiled, in mapping order"""
+    fields = []
+    for path, field_mapping in mapping.queryable_fields(properties).items():
+        field_type = field_mapping.get("type")
+        if field_type is None or field_type in UNPROFILED_TYPES:
+            continue
+        if field_type in TERMS_TYPES or field_type in RANGE_TYPES:
+            agg_field = path
+        elif field_type == "text":
+            agg_field = keyword_subfield(path, field_mapping)
+        else:
+            agg_field = None
+        fields.append(ProfileField(path, field_type, agg_field))
+    return fields
+
+
+def field_aggs(number, field):
+    """The aggregations of one field, named after its position in the batch"""
+    name = f"f{number}"
+    if field.agg_field is None:
+        return {f"{name}_missing": {"filter": {"bool": {"must_not": [
+            {"exists": {"field": field.path}}]}}}}
+    aggs = {
+        f"{name}_missing": {"missing": {"field": field.agg_field}},
+        f"{name}_cardinality": {"cardinality": {"field": field.agg_field}},
+    }
+    if field.type in RANGE_TYPES:
+        aggs[f"{name}_min"] = {"min": {"field": field.agg_field}}
+        aggs[f"{name}_max"] = {"max": {"field": field.agg_field}}
+    else:
+        aggs[f"{name}_top"] = {"terms": {"field": field.agg_field, "size": TOP_VALUES}}
+    return aggs
+
+
+def batches(fields, batch_size=BATCH_SIZE):
+    return [fields[start:start + batch_size] for start in range(0, len(fields), batch_size)]
+
+
+def profile_requests(index, fields, query=None, batch_size=BATCH_SIZE):
+    """Build the searches that profile `fields` of an index, one per batch
+
+    Every search also counts the documents it ran over. Before 7.0 the hit
+    total is exact, after it is capped unless asked for, and a `filter`
+    aggregation counts exactly on every version.
+    """
+    requests = []
+    for batch in batches(fields, batch_size) or [[]]:
+        aggs = {"docs": {"filter": {"match_all": {}}}}
+        for number, field in enumerate(batch):
+            aggs.update(field_aggs(number, field))
+        body = {"size": 0, "aggs": aggs}
+        if query:
+            body["query"] = query
+        requests.append(core.SearchRequest("POST", f"/{index}/_search", None, body))
+    return requests
+
+
+def metric_value(aggregation):
+    """The value of a min/max aggregation, formatted for dates"""
+    if aggregation is None:
+        return None
+    return aggregation.get("value_as_string", aggregation.get("value"))
+
+
+def parse_profile(fields, responses, batch_size=BATCH_SIZE):
+    """Read the profile of every field from the responses to `profile_requests`
+
+    Returns:
+        tuple: the number of documents profiled and `{path: stats}` of every field
+    """
+    total_docs = None
+    profile = {}
+    for batch, response in zip(batches(fields, batch_size) or [[]], responses):
+        aggregations = response.get("aggregations", {})
+        if total_docs is None and "docs" in aggregations:
+            total_docs = aggregations["docs"]["doc_count"]
+        for number, field in enumerate(batch):
+            name = f"f{number}"
+            stats = {"type": field.type}
+            if field.agg_field != field.path:
+                stats["agg_field"] = field.agg_field
+            missing = aggregations.get(f"{name}_missing")
+            stats["missing"] = missing["doc_count"] if missing else None
+            if field.agg_field is not None:
+                cardinality = aggregations.get(f"{name}_cardinality")
+                stats["cardinality"] = cardinality["value"] if cardinality else None
+                if field.type in RANGE_TYPES:
+                    stats["min"] = metric_value(aggregations.get(f"{name}_min"))
+                    stats["max"] = metric_value(aggregations.get(f"{name}_max"))
+                else:
+                    buckets = aggregations.get(f"{name}_top", {}).get("buckets", [])
+                    stats["top"] = [[bucket.get("key_as_string", bucket["key"]),
+                                     bucket["doc_count"]] for bucket in buckets]
+            profile[field.path] = stats
+    return total_docs, profile
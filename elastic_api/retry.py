@@ -0,0 +1,281 @@
+# Retry Policy
+"""When to send a failed request again, and how long to wait first.
+
+Failures are sorted into kinds: the host asking us to slow down (429),
+the host failing (500/502/503/504), the connection failing, and timeouts.
+Other errors (a 404, a response that isn't JSON) won't fix themselves
+and are raised at once, error statuses as `StatusError`. Retries back
+off exponentially with full jitter, so slices that failed together
+don't come back together.
+
+Every host has a `CircuitBreaker`, shared by all requests to it. Once a
+host failed `failure_threshold` times in a row its requests fail fast
+with `HostUnavailable` instead of each waiting out its own retries,
+until `reset_timeout` has passed. Then a single trial request is let
+through to test the host, while the others keep failing fast until it
+succeeds or fails.
+
+Both APIs run the same loop, they only differ in how they sleep and in
+the exceptions their HTTP client raises:
+
+```
+attempts = retry.Attempts(policy, host, TIMEOUT_ERRORS, CONNECTION_ERRORS)
+while True:
+    attempts.check()
+    try:
+        response = send(request)
+        retry.check_status(response.status, response.headers)
+    except Exception as ex:
+        sleep(attempts.failed(ex))
+    else:
+        attempts.succeeded()
+        return response
+```
+"""
+import random
+import threading
+import time
+
+THROTTLED = "throttled"
+SERVER = "server"
+CONNECTION = "connection"
+TIMEOUT = "timeout"
+FATAL = "fatal"
+
+# Response statuses worth trying again, by kind
+RETRY_STATUSES = {429: THROTTLED, 500: SERVER, 502: SERVER, 503: SERVER, 504: SERVER}
+# Kinds of failure that count against a host's circuit breaker. A throttling
+# host is alive, it only wants us to wait.
+BREAKER_KINDS = (SERVER, CONNECTION, TIMEOUT)
+
+
+class StatusError(Exception):
+    """The database answered with an error status"""
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+class ResponseError(StatusError):
+    """The database answered with a status worth trying again"""
+    def __init__(self, status, retry_after=None):
+        super().__init__(status)
+        # Seconds the database asked us to wait, if it did
+        self.retry_after = retry_after
+
+
+class HostUnavailable(Exception):
+    """The host's circuit breaker is open, so the request wasn't sent"""
+
+
+def check_status(status, headers=None):
+    """Raise for error statuses, instead of handing their body over as a result
+
+    Raises:
+        ResponseError: For statuses worth trying again.
+        StatusError: For other 4xx and 5xx statuses.
+    """
+    if status < 400:
+        return
+    if status not in RETRY_STATUSES:
+        raise StatusError(status)
+    retry_after = (headers or {}).get("Retry-After")
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        # An HTTP date, rare enough to fall back to our own backoff
+        retry_after = None
+    raise ResponseError(status, retry_after)
+
+
+def classify(error, timeout_errors=(), connection_errors=()):
+    """Sort an exception into one of the kinds of failure
+
+    Args:
+        error (Exception): what sending the request raised
+        timeout_errors (tuple): exception types of the HTTP client for timeouts
+        connection_errors (tuple): exception types of the HTTP client for connection failures
+
+    Returns:
+        str: THROTTLED, SERVER, CONNECTION, TIMEOUT or FATAL
+    """
+    if isinstance(error, ResponseError):
+        return RETRY_STATUSES[error.status]
+    # Connect timeouts are often both, and are timeouts first
+    if isinstance(error, timeout_errors):
+        return TIMEOUT
+    if isinstance(error, connection_errors):
+        return CONNECTION
+    return FATAL
+
+
+def host_failed(error, timeout_errors=(), connection_errors=()):
+    """Whether an error means the host itself is failing, so another node of
+    the same cluster may serve the request instead"""
+    return (isinstance(error, HostUnavailable)
+            or classify(error, timeout_errors, connection_errors) in BREAKER_KINDS)
+
+
+class RetryPolicy:
+    """How many times to try a request and how long to wait in between.
+
+    Args:
+        attempts (int): tries in total, 1 to never retry
+        base_delay (float, optional): longest wait after the first failure, doubled
+            after every further one. Defaults to 0.5.
+        max_delay (float, optional): longest wait between two tries. Defaults to 30.
+    """
+    def __init__(self, attempts, base_delay=0.5, max_delay=30.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, failures, retry_after=None):
+        """Seconds to wait after the given number of failed tries
+
+        Full jitter: anywhere between 0 and the exponential backoff. A
+        `Retry-After` from the database is waited out in any case.
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        delay = random.uniform(0, backoff)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+# Searches, which a download can't do without
+DEFAULT = RetryPolicy(attempts=8)
+# Requests that have a fallback, or whose result is only nice to have
+QUICK = RetryPolicy(attempts=2, base_delay=0.5, max_delay=2.0)
+# Best effort requests, e.g. freeing search contexts
+ONCE = RetryPolicy(attempts=1)
+
+
+class CircuitBreaker:
+    """Tracks the consecutive failures of a host and stops requests to it
+    while it is clearly down.
+
+    Once open for `reset_timeout` the circuit is half open: a single trial
+    request is let through, and every other request keeps failing fast
+    until the trial succeeds (closing the circuit) or fails (opening it
+    again). A trial that never reports back, e.g. because it was
+    cancelled, is replaced by a new one after another `reset_timeout`.
+
+    Args:
+        failure_threshold (int, optional): consecutive failures that open the
+            circuit. Defaults to 5.
+        reset_timeout (float, optional): seconds before an open circuit lets a
+            trial request through. Defaults to 30.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        # When the trial request of a half open circuit was let through
+        self.trial_at = None
+        # The synchronous API checks from several threads
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Whether the circuit is open and not yet due for a trial"""
+        return (self.opened_at is not None
+                and self.clock() - self.opened_at < self.reset_timeout)
+
+    @property
+    def is_half_open(self):
+        """Whether the circuit is due for a trial, or waiting on one"""
+        return self.opened_at is not None and not self.is_open
+
+    def check(self, host=None):
+        """Raise HostUnavailable unless requests to the host may be sent,
+        letting a single trial request through when the circuit is half open"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            now = self.clock()
+            if now - self.opened_at < self.reset_timeout:
+                raise HostUnavailable(f"{host or 'Host'} failed {self.failures} times in a row, "
+                                      f"not sending requests for "
+                                      f"{self.reset_timeout - (now - self.opened_at):.0f}s")
+            if self.trial_at is not None and now - self.trial_at < self.reset_timeout:
+                raise HostUnavailable(f"{host or 'Host'} failed {self.failures} times in a row, "
+                                      f"waiting on a trial request")
+            self.trial_at = now
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_at = None
+
+    def record_failure(self):
+        # Once the threshold was reached, a failed trial request opens it again
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self.trial_at = None
+
+
+_breakers = {}
+
+
+def breaker(host):
+    """The circuit breaker of a host, shared by every API talking to it"""
+    host_breaker = _breakers.get(host)
+    if host_breaker is None:
+        host_breaker = _breakers.setdefault(host, CircuitBreaker())
+    return host_breaker
+
+
+class Attempts:
+    """The tries of a single request under a RetryPolicy.
+
+    Args:
+        policy (RetryPolicy): policy to follow
+        host (str): host the request goes to
+        timeout_errors (tuple, optional): exception types of the HTTP client for timeouts
+        connection_errors (tuple, optional): exception types of the HTTP client for
+            connection failures
+    """
+    def __init__(self, policy, host, timeout_errors=(), connection_errors=()):
+        self.policy = policy
+        self.host = host
+        self.breaker = breaker(host)
+        self.timeout_errors = timeout_errors
+        self.connection_errors = connection_errors
+        self.failures = 0
+
+    def check(self):
+        """Raise HostUnavailable if the request shouldn't be sent"""
+        self.breaker.check(self.host)
+
+    def succeeded(self):
+        self.breaker.record_success()
+
+    def failed(self, error):
+        """Record a failed try
+
+        Raises:
+            Exception: `error` itself when it isn't worth trying again or the
+                attempts are used up, HostUnavailable when the host's circuit
+                opened.
+
+        Returns:
+            float: seconds to wait before the next try
+        """
+        kind = classify(error, self.timeout_errors, self.connection_errors)
+        self.failures += 1
+        if kind in BREAKER_KINDS:
+            self.breaker.record_failure()
+        elif isinstance(error, StatusError):
+            # The host answered, which settles a trial as well as a success would
+            self.breaker.record_success()
+        if kind == FATAL or self.failures >= self.policy.attempts:
+            raise error
+        if self.breaker.is_open:
+            raise HostUnavailable(f"{self.host} is not responding") from error
+        return self.policy.delay(self.failures, getattr(error, "retry_after", None))
@@ -0,0 +1,82 @@
+# Request Timeouts
+"""How long to wait on a host, per class of request.
+
+A single timeout can't suit both a probe and a full page of documents:
+a probe should give up quickly, while a page may take the database a
+while to gather before its first byte. `Timeouts` gives every request
+class its own connect, read and total limits, scaled by the round trip
+time to the host:
+
+- `PROBE`: `GET /` and `/_cat`, when finding out what a host is
+- `METADATA`: index listings, mappings, opening and closing search contexts
+- `SEARCH`: pages of documents
+
+The round trip time starts out as the connect time measured by the
+scanner, and is refined by every probe. Far-away hosts get proportionally
+more time, nearby hosts are given up on sooner.
+"""
+from collections import namedtuple
+
+PROBE = "probe"
+METADATA = "metadata"
+SEARCH = "search"
+
+# Round trip time assumed until one is observed, in seconds
+DEFAULT_RTT = 0.25
+# Connect timeout, in round trips, and its bounds in seconds
+CONNECT_RTTS = 4
+MIN_CONNECT = 0.5
+MAX_CONNECT = 10.0
+# Time to wait between two reads of a response: in round trips, and its bounds in seconds
+READ_LIMITS = {
+    PROBE: (8, 1.0, 10.0),
+    METADATA: (40, 5.0, 60.0),
+    SEARCH: (200, 60.0, 300.0),
+}
+# Whole requests are only capped for classes whose responses are small. A page
+# can take long to transfer without anything being wrong.
+TOTAL_READS = {PROBE: 2, METADATA: 3, SEARCH: None}
+
+# Limits of one request, in seconds. `total` is None when unlimited.
+TimeoutSettings = namedtuple("TimeoutSettings", ["connect", "read", "total"])
+
+
+def clamp(value, lowest, highest):
+    return max(lowest, min(value, highest))
+
+
+class Timeouts:
+    """Timeout settings for every request class to one host.
+
+    Args:
+        connect (float, optional): fixed connect timeout in seconds, which is
+            also the least any read is given. Adapts to the round trip time if None.
+        rtt (float, optional): round trip time to the host in seconds, if known
+    """
+    def __init__(self, connect=None, rtt=None):
+        self.connect = connect
+        self.rtt = rtt
+
+    def observe(self, rtt):
+        """Take a newly measured round trip time into account
+
+        The slowest time seen wins, as one fast sample doesn't make a link fast.
+        """
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else max(self.rtt, rtt)
+
+    def settings(self, request_class):
+        """The limits of one class of request
+
+        Returns:
+            TimeoutSettings: connect, read and total limits in seconds
+        """
+        rtt = self.rtt if self.rtt is not None else DEFAULT_RTT
+        connect = self.connect
+        if connect is None:
+            connect = clamp(rtt * CONNECT_RTTS, MIN_CONNECT, MAX_CONNECT)
+        rtts, lowest, highest = READ_LIMITS[request_class]
+        read = max(clamp(rtt * rtts, lowest, highest), connect)
+        total_reads = TOTAL_READS[request_class]
+        total = connect + read * total_reads if total_reads else None
+        return TimeoutSettings(connect, read, total)
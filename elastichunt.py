@@ -1,18 +1,27 @@
+from __future__ import annotations
+
 import argparse
-import asyncio
+import itertools
 import json
 import os
-from typing import List
-
-import tqdm
+from typing import Dict, List, Tuple
 
-import elastic_api.abstract_filters as abstract_filters
-import elastic_api.async_elastic_api as elastic_api
-import elastic_api.filters as filters
-import utils.async_scanner as async_scanner
+import elastic_api.core as core
+import elastic_api.export as export
 import utils.cli_helper as cli_helper
 import utils.ip_utils as ip_utils
-import utils.parser as util_parser
+import utils.liveness_cache as liveness_cache
+
+# Only loaded once a command needs them, so `--help` and cron runs start fast
+asyncio = cli_helper.lazy_import("asyncio")
+tqdm = cli_helper.lazy_import("tqdm")
+elastic_api = cli_helper.lazy_import("elastic_api.async_elastic_api")
+filters = cli_helper.lazy_import("elastic_api.filters")
+abstract_filters = cli_helper.lazy_import("elastic_api.abstract_filters")
+async_scanner = cli_helper.lazy_import("utils.async_scanner")
+dedupe = cli_helper.lazy_import("elastic_api.dedupe")
+memory_budget = cli_helper.lazy_import("utils.memory_budget")
+util_parser = cli_helper.lazy_import("utils.parser")
 
 
 def load_filters_from_file(filename: str) -> List[abstract_filters.Filter]:
@@ -42,6 +51,10 @@ def load_filters_from_file(filename: str) -> List[abstract_filters.Filter]:
                 new_filter = filters.RegexDictFilter(field_name)
                 for item in filter_items:
                     new_filter.add_filter(item)
+            elif filter_type == "nested_regex_dict":
+                new_filter = filters.NestedRegexDictFilter(field_name)
+                for item in filter_items:
+                    new_filter.add_filter(item)
             elif filter_type == "regex":
                 new_filter = filters.RegexFilter(field_name)
                 for item in filter_items:
@@ -53,6 +66,22 @@ def load_filters_from_file(filename: str) -> List[abstract_filters.Filter]:
 
     return data_filters
 
+
+def split_filters(data_filters: List) -> Tuple[List[abstract_filters.Filter],
+                                               List[abstract_filters.DictFilter]]:
+    """
+    Split loaded filters into index filters and document filters.
+
+    Args:
+        data_filters: Filters returned by `load_filters_from_file`.
+
+    Returns:
+        The index filters and the document filters, each None when there are none.
+    """
+    index_filters = [f for f in data_filters if isinstance(f, abstract_filters.Filter)]
+    doc_filters = [f for f in data_filters if isinstance(f, abstract_filters.DictFilter)]
+    return index_filters or None, doc_filters or None
+
 class AsyncCLI:
     """
     Command-line interface for AsyncScanner and ElasticAPI classes.
@@ -77,9 +106,9 @@ class AsyncCLI:
         None
     
     Methods:
-        scan_db(db: str, args: argparse.Namespace) -> Coroutine:
-            Checks if a given IP address is an Elasticsearch database and downloads
-            data from it if it is.
+        scan_potential_dbs(potential_dbs: List[str], args: argparse.Namespace) -> Coroutine:
+            Checks which hosts are Elasticsearch databases, groups them by cluster
+            and enumerates (and downloads) each cluster once.
         
         run(args: argparse.Namespace) -> Coroutine:
             Parses command-line arguments and runs the specified command (scanner or elastic).
@@ -115,12 +144,42 @@ class AsyncCLI:
         self.parser = argparse.ArgumentParser(description="AsyncScanner/ElasticAPI CLI", 
                                               formatter_class=argparse.RawTextHelpFormatter)
 
-        self.parser.add_argument("ipaddr", type=str, help="IP address or range to scan")
-        self.parser.add_argument("port", type=int, default=9200, 
-                                 help="Port to scan, defaults to 9200")
+        self.parser.add_argument("ipaddr", type=str, nargs="?",
+                                 help="IP address or range to scan. Optional with --targets-file")
+        self.parser.add_argument("port", type=ip_utils.parse_port_spec, nargs="?", default=[9200],
+                                 help="Port(s) to scan, e.g. 9200 or 9200-9205,19200.\n"
+                                      "Defaults to 9200")
+        self.parser.add_argument("-p", "--ports", type=ip_utils.parse_port_spec,
+                                 help="Port list or ranges to scan, e.g. 9200-9205,19200.\n"
+                                      "Overrides the port argument")
 
         # AsyncScanner parser
         scanner_parser = self.parser.add_argument_group("scanner options")
+        scanner_parser.add_argument(
+            "-tF",
+            "--targets-file",
+            action="append",
+            help="File of IP addresses, CIDR ranges and dashed ranges to scan, one per line.\n"
+                 "Use - for stdin. Can be given more than once"
+        )
+        scanner_parser.add_argument(
+            "-xF",
+            "--exclude-file",
+            action="append",
+            help="File of addresses and ranges never to scan, in the same format.\n"
+                 "Can be given more than once"
+        )
+        scanner_parser.add_argument(
+            "--cache-ttl",
+            type=liveness_cache.parse_duration,
+            help="Keep a liveness cache of scanned targets: skip targets seen closed within\n"
+                 "this long (e.g. 12h, 7d) and connect to targets seen open first"
+        )
+        scanner_parser.add_argument(
+            "--cache-file",
+            default=liveness_cache.DEFAULT_CACHE_FILE,
+            help=f"Liveness cache file for --cache-ttl. Defaults to {liveness_cache.DEFAULT_CACHE_FILE}"
+        )
         scanner_parser.add_argument(
             "-sG", "--staged", action="store_true", help="Perform the scan in stages"
         )
@@ -147,7 +206,9 @@ class AsyncCLI:
         # ElasticAPI parser
         elastic_parser = self.parser.add_argument_group("ElasticAPI Options")
         elastic_parser.add_argument(
-            "-eT", "--elastictimeout", type=float, default=1.0, help="Elasticsearch timeout"
+            "-eT", "--elastictimeout", type=float, default=None,
+            help="Elasticsearch connect timeout in seconds. By default it adapts to the\n"
+                 "round trip time to each host, measured while scanning"
         )
         elastic_parser.add_argument(
             "-dp",
@@ -163,6 +224,76 @@ class AsyncCLI:
             help="Filters to apply to Elasticsearch data (JSON File)",
         )
 
+        elastic_parser.add_argument(
+            "--max-file-size",
+            type=core.parse_size,
+            help="Split each downloaded index into part files of at most this size\n"
+                 "(e.g. 512mb, 2gb). A document larger than that gets a part of its own"
+        )
+        elastic_parser.add_argument(
+            "--max-docs-per-file",
+            type=int,
+            help="Split each downloaded index into part files of at most this many documents"
+        )
+        elastic_parser.add_argument(
+            "--format",
+            choices=list(export.SINKS),
+            default="csv",
+            help="Export format for downloaded indices. Defaults to csv"
+        )
+        elastic_parser.add_argument(
+            "--passthrough",
+            action="store_true",
+            default=False,
+            help="With --format json, write each document exactly as the database\n"
+                 "sent it instead of decoding and re-encoding it. Not used with --fieldname"
+        )
+        elastic_parser.add_argument(
+            "--disk-full",
+            choices=["trim", "refuse", "ignore"],
+            default="trim",
+            help="What to do when the filtered indices don't all fit in the download path:\n"
+                 "skip those that don't fit (trim, the default), download nothing (refuse)\n"
+                 "or download anyway (ignore)"
+        )
+        elastic_parser.add_argument(
+            "--memory-budget",
+            type=core.parse_size,
+            help="Keep the run within about this much memory (e.g. 2gb) by capping the\n"
+                 "pages being downloaded, probes and connects in flight, and slowing down\n"
+                 "when the process gets near it"
+        )
+        elastic_parser.add_argument(
+            "--dedupe",
+            choices=["id", "content"],
+            help="Drop documents already downloaded during this run, across indices:\n"
+                 "by _id within an index group, the index name without its rollover,\n"
+                 "date or copy suffix (id), or by the content of the document (content)"
+        )
+        elastic_parser.add_argument(
+            "--sample",
+            type=int,
+            metavar="N",
+            help="Instead of downloading, save N random documents of every filtered index\n"
+                 "with stats on their fields ({index}.sample.json)"
+        )
+        elastic_parser.add_argument(
+            "--profile-index",
+            action="store_true",
+            default=False,
+            help="Instead of downloading, profile every filtered index (or --index with\n"
+                 "--single) with aggregations: missing values, cardinality, top values\n"
+                 "and min/max of every field ({index}.profile.json)"
+        )
+        elastic_parser.add_argument(
+            "--verify",
+            action="store_true",
+            default=False,
+            help="Instead of scanning, check every export under the download path\n"
+                 "against its manifest: that every document was read and that no part\n"
+                 "changed since it was written"
+        )
+
         single_downloader = self.parser.add_argument_group("Single DB Download Options")
         # We don't need to specify host or port because they're global
         single_downloader.add_argument(
@@ -206,8 +337,9 @@ class AsyncCLI:
         self.parser.add_argument(
             '-t',
             '--timeout',
-            type=int,
-            help='Timeout for both the scanner and the Elasticsearch API in seconds.')
+            type=float,
+            help='Timeout for both the scanner and the Elasticsearch API in seconds.\n'
+                 'Overrides --scannertimeout and --elastictimeout.')
 
         self.parser.add_argument(
             "--download",
@@ -216,6 +348,12 @@ class AsyncCLI:
             default=False,
             help="Download Indices Automatically"
         )
+        self.parser.add_argument(
+            "--no-banner",
+            action="store_true",
+            default=False,
+            help="Don't print the banner. It is also skipped when the output is not a terminal"
+        )
         self.parser.add_argument(
             "--single",
             "-s",
@@ -228,8 +366,7 @@ class AsyncCLI:
                                elastic_api_obj: elastic_api.ElasticAPI):
         # Create a temporary parser for the folder format
         if not elastic_api_obj.ElasticDB:
-            await elastic_api_obj.get_db_info()
-            await elastic_api_obj.get_db_indicies()
+            await elastic_api_obj.probe()
         temp_parser=util_parser.PercentParser(self.FOLDER_SUBSTITUTIONS, elastic_api_obj.ElasticDB)
         temp_parser.add_repl('Ha', str(elastic_api_obj.clean_host))
         return temp_parser.parse_string(args.folderformat)
@@ -240,12 +377,22 @@ class AsyncCLI:
         Args:
             args (argparse.Namespace): CLI Args
         """
-        host = f"http://{args.ipaddr}:{args.port}"
+        host = f"http://{args.ipaddr}:{args.ports[0]}"
+        doc_filters = None
+        if args.filters:
+            _, doc_filters = split_filters(load_filters_from_file(args.filters))
         db_api = elastic_api.ElasticAPI(
             host=host,
             timeout=args.elastictimeout,
             download=True,
-            Filters=None
+            Filters=None,
+            max_file_size=args.max_file_size,
+            max_docs_per_file=args.max_docs_per_file,
+            export_format=args.format,
+            passthrough=args.passthrough,
+            doc_filters=doc_filters,
+            dedupe=args.deduplicator,
+            memory_budget=args.budget,
         )
 
         if args.folderformat:
@@ -256,36 +403,187 @@ class AsyncCLI:
             download_path = args.downloadpath
 
         output_filename = args.output if args.output else args.index
-        await db_api.get_db_info()
-        await db_api.get_db_indicies()
-        await db_api.download_index(
-            host=host,
-            index=args.index,
-            timeout=args.timeout,
-            filename=output_filename,
-            download_path=download_path,
-            folder_name=None,
-            fieldnames=args.fieldname
-            )
+        async with db_api:
+            if not db_api.ElasticDB:
+                await db_api.probe()
+            if args.profile_index:
+                await db_api.profile_index(host, args.index, None, download_path)
+                return
+            await db_api.download_index(
+                host=host,
+                index=args.index,
+                timeout=None,
+                filename=output_filename,
+                download_path=download_path,
+                folder_name=None,
+                fieldnames=args.fieldname,
+                export_format=args.format,
+                endpoints=db_api.endpoints,
+                )
+
+    def verify_exports(self, args: argparse.Namespace):
+        """Check the exports under the download path against their manifests
+
+        Args:
+            args (argparse.Namespace): CLI Args
+        """
+        manifests = export.find_manifests(args.downloadpath)
+        if not manifests:
+            self.parser.error(f"No manifests found under {args.downloadpath}")
+        failed = 0
+        for manifest_path in manifests:
+            problems = export.verify_manifest(manifest_path)
+            if problems:
+                failed += 1
+                print(f"FAILED {manifest_path}: {'; '.join(problems)}")
+            else:
+                print(f"OK     {manifest_path}")
+        print(f"Verified {len(manifests) - failed} of {len(manifests)} exports")
+        if failed:
+            self.parser.exit(1)
 
-    async def scan_db(self, db: str, args: argparse.Namespace):
-        """Scan Host for databases
+    async def probe_db(self, db: str, args: argparse.Namespace,
+                       elastic_filters: List[abstract_filters.Filter] = None,
+                       doc_filters: List[abstract_filters.DictFilter] = None,
+                       rtt: float = None):
+        """Probe a host for its database information
 
         Args:
             db (str): host IP/Port
             args (argparse.Namespace): CLI Args
+            elastic_filters (List[abstract_filters.Filter], optional): index filters
+            doc_filters (List[abstract_filters.DictFilter], optional): document filters
+            rtt (float, optional): round trip time to the host seen by the scanner
+
+        Returns:
+            elastic_api.ElasticAPI: API object for the host, or None if it is not elastic.
+                Its session stays open, so the indices are listed over the keep-alive
+                connection of the probe; `scan_db` closes it.
         """
-        elastic_filters = None
-        if args.filters:
-            elastic_filters = load_filters_from_file(args.filters)
         eapi = elastic_api.ElasticAPI(
             db,
             timeout=args.elastictimeout,
             download_path=args.downloadpath,
             download=args.download,
             Filters=elastic_filters,
+            max_file_size=args.max_file_size,
+            max_docs_per_file=args.max_docs_per_file,
+            export_format=args.format,
+            passthrough=args.passthrough,
+            doc_filters=doc_filters,
+            sample=args.sample,
+            profile=args.profile_index,
+            disk_full=args.disk_full,
+            rtt=rtt,
+            dedupe=args.deduplicator,
+            memory_budget=args.budget,
         )
-        await eapi.automate()
+        is_elastic = False
+        try:
+            is_elastic = await eapi.probe(fetch_indices=False)
+        finally:
+            if not is_elastic:
+                await eapi.close()
+        return eapi if is_elastic else None
+
+    @staticmethod
+    def group_clusters(nodes: List[elastic_api.ElasticAPI]) -> List[List[elastic_api.ElasticAPI]]:
+        """Group probed nodes by the cluster they belong to
+
+        Nodes that have not joined a cluster report no (or a "_na_") cluster_uuid,
+        and are kept as clusters of their own.
+
+        Args:
+            nodes (List[elastic_api.ElasticAPI]): probed nodes
+
+        Returns:
+            List[List[elastic_api.ElasticAPI]]: nodes of each cluster, fastest node first
+        """
+        clusters = {}
+        for node in nodes:
+            cluster_uuid = node.ElasticDB.cluster_uuid
+            if not cluster_uuid or cluster_uuid == "_na_":
+                cluster_uuid = node.host
+            clusters.setdefault(cluster_uuid, []).append(node)
+        return [sorted(cluster_nodes, key=lambda node: (node.probe_rtt, node.host))
+                for cluster_nodes in clusters.values()]
+
+    async def scan_db(self, nodes: List[elastic_api.ElasticAPI], args: argparse.Namespace):
+        """Enumerate (and download) a cluster through its representative node
+
+        Args:
+            nodes (List[elastic_api.ElasticAPI]): nodes of the cluster, representative first
+            args (argparse.Namespace): CLI Args
+        """
+        representative = nodes[0]
+        # The other nodes only serve as extra endpoints for download slices, which
+        # open connections of their own
+        representative.endpoints = [node.host for node in nodes[1:]]
+        for node in nodes[1:]:
+            await node.close()
+        async with representative:
+            await representative.automate()
+
+    async def scan_potential_dbs(self, potential_dbs: List[str], args: argparse.Namespace,
+                                 connect_rtts: Dict[str, float] = None):
+        """Probe every potential database, then enumerate each cluster once
+
+        Args:
+            potential_dbs (List[str]): hosts with an open port
+            connect_rtts (Dict[str, float], optional): connect time of each host
+            args (argparse.Namespace): CLI Args
+        """
+        elastic_filters = doc_filters = None
+        if args.filters:
+            elastic_filters, doc_filters = split_filters(load_filters_from_file(args.filters))
+        connect_rtts = connect_rtts or {}
+        # Probe workers, one per host unless a memory budget caps them. Each
+        # takes the next host once its probe is done, so only the probes in
+        # flight exist at any time.
+        num_workers = len(potential_dbs)
+        if args.budget:
+            num_workers = min(num_workers, args.budget.probe_limit)
+        pending = iter(potential_dbs)
+        nodes = []
+
+        async def probe_worker():
+            for potential_database in pending:
+                node = await self.probe_db(potential_database, args, elastic_filters,
+                                           doc_filters, connect_rtts.get(potential_database))
+                if node is not None:
+                    nodes.append(node)
+
+        await asyncio.gather(*[probe_worker() for _ in range(num_workers)])
+        clusters = self.group_clusters(nodes)
+        tasks: List[asyncio.Task] = []
+        for cluster_nodes in clusters:
+            tasks.append(asyncio.create_task(self.scan_db(cluster_nodes, args)))
+        # A failing cluster is reported without abandoning the healthy ones
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for cluster_nodes, result in zip(clusters, results):
+            if isinstance(result, Exception):
+                tqdm.tqdm.write(f"Failed to scan {cluster_nodes[0].host}: {result}")
+
+    @staticmethod
+    def load_targets(args: argparse.Namespace) -> ip_utils.IntervalSet:
+        """Merge the ipaddr argument and target files, minus the excluded ranges
+
+        Args:
+            args (argparse.Namespace): CLI Args
+
+        Returns:
+            ip_utils.IntervalSet: the addresses to scan
+        """
+        def intervals(paths):
+            for path in paths or []:
+                yield from ip_utils.iter_target_file(path)
+
+        targets = ip_utils.IntervalSet.from_intervals(itertools.chain(
+            ip_utils.iter_target_lines([args.ipaddr] if args.ipaddr else [], "ipaddr"),
+            intervals(args.targets_file)))
+        if args.exclude_file:
+            targets -= ip_utils.IntervalSet.from_intervals(intervals(args.exclude_file))
+        return targets
 
     async def run_scanner(self, args: argparse.Namespace):
         """Run the scanner
@@ -294,21 +592,19 @@ class AsyncCLI:
             args (argparse.Namespace): CLI Args
         """
         scanner = async_scanner.AsyncScanner(
-            args.ipaddr,
-            args.port,
+            args.targets,
+            args.ports,
             timeout=args.scannertimeout,
             num_workers=args.numworkers,
             max_subnets=args.maxsubnets,
             max_hosts_per_subnet=args.maxhosts,
+            cache=args.cache,
+            memory_budget=args.budget,
         )
         tqdm.tqdm.write("Scanning for hosts... (This may take a few minutes)")
         await scanner.run_scan()
-        tasks: List[asyncio.Task] = []
-        potential_dbs = scanner.potential_dbs
         tqdm.tqdm.write("Checking IPs...")
-        for potential_database in potential_dbs:
-            tasks.append(asyncio.create_task(self.scan_db(potential_database, args)))
-        await asyncio.gather(*tasks)
+        await self.scan_potential_dbs(scanner.potential_dbs, args, scanner.connect_rtts)
 
     async def run_scan_staged(self, args: argparse.Namespace):
         """Run the staged scanner
@@ -316,26 +612,28 @@ class AsyncCLI:
         Args:
             args (argparse.Namespace): CLI Args
         """
-        ip_addrs = ip_utils.split_subnet_into_subnets(args.ipaddr, args.numstages)
+        stage_size = 2 ** (32 - args.numstages)
+        ip_addrs = list(args.targets.chunks(stage_size))
         tqdm.tqdm.write(f"Prepared {len(ip_addrs)} Stages for Scanning...")
         potential_databases = []
+        connect_rtts = {}
         tqdm.tqdm.write("Scanning for hosts... (This may take a few minutes)")
         for ip_addr_range in tqdm.tqdm(ip_addrs, position=1, desc="IP Ranges"):
             scanner = async_scanner.AsyncScanner(
                 ip_addr_range,
-                args.port,
+                args.ports,
                 timeout=args.scannertimeout,
                 num_workers=args.numworkers,
                 max_subnets=args.maxsubnets,
                 max_hosts_per_subnet=args.maxhosts,
+                cache=args.cache,
+                memory_budget=args.budget,
             )
             await scanner.run_scan()
             potential_databases.extend(scanner.potential_dbs)
+            connect_rtts.update(scanner.connect_rtts)
             #tqdm.tqdm.write(f"Found {len(scanner.potential_dbs)} Potential Databases")
-        tasks: List[asyncio.Task] = []
-        for potential_database in potential_databases:
-            tasks.append(asyncio.create_task(self.scan_db(potential_database, args)))
-        await asyncio.gather(*tasks)
+        await self.scan_potential_dbs(potential_databases, args, connect_rtts)
 
     async def run_cli(self, args: argparse.Namespace):
         """Run the CLI
@@ -343,16 +641,52 @@ class AsyncCLI:
         Args:
             args (argparse.Namespace): CLI Args
         """
-        cli_helper.print_banner()
+        args.ports = args.ports or args.port
+        if args.timeout is not None:
+            args.scannertimeout = args.elastictimeout = args.timeout
+        if not args.no_banner:
+            cli_helper.print_banner()
+        if args.verify:
+            self.verify_exports(args)
+            return
+        args.budget = memory_budget.MemoryBudget(args.memory_budget) if args.memory_budget else None
+        args.cache = None
         if args.single is True:
-            await self.download_single_index(args)
-        elif args.staged is True:
-            await self.run_scan_staged(args)
+            if not args.ipaddr:
+                self.parser.error("--single needs the ipaddr of the database")
         else:
-            await self.run_scanner(args)
-
-# Now Run The CLI
-loop = asyncio.new_event_loop()
-cli = AsyncCLI()
-args = cli.parser.parse_args()
-loop.run_until_complete(cli.run_cli(args))
+            args.targets = self.load_targets(args)
+            if not args.targets:
+                self.parser.error("Nothing to scan, give an ipaddr or --targets-file")
+            if args.cache_ttl is not None:
+                try:
+                    args.cache = liveness_cache.LivenessCache(args.cache_file, args.cache_ttl)
+                except ValueError as ex:
+                    self.parser.error(str(ex))
+        args.deduplicator = dedupe.Deduplicator(args.dedupe) if args.dedupe else None
+        try:
+            if args.single is True:
+                await self.download_single_index(args)
+            elif args.staged is True:
+                await self.run_scan_staged(args)
+            else:
+                await self.run_scanner(args)
+        finally:
+            if args.cache is not None:
+                # Scanners only checkpoint the cache, the rest is saved once
+                args.cache.save()
+            if args.deduplicator is not None:
+                args.deduplicator.close()
+                print(f"Dropped {args.deduplicator.dropped} duplicate documents, "
+                      f"kept {args.deduplicator.kept}")
+
+def main():
+    """Run The CLI"""
+    cli = AsyncCLI()
+    args = cli.parser.parse_args()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(cli.run_cli(args))
+
+
+if __name__ == "__main__":
+    main()
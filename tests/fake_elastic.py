@@ -0,0 +1,218 @@
+"""A small in-process Elasticsearch for tests of the async API.
+
+Serves the root, `_cat/indices`, `_stats`, mappings, points in time and
+scrolls (both sliced) for a fixed set of documents, on one or more ports
+that act as the nodes of a single cluster:
+
+```
+cluster = FakeCluster({"users": [{"name": "ann"}, {"name": "bob"}]})
+hosts = await cluster.start(nodes=2)
+...
+await cluster.stop()
+```
+
+`fail` decides, per request, a status to answer with instead, and every
+request is logged in `requests`. Tests of the synchronous API serve the
+cluster from a thread of its own with `start_thread` and `stop_thread`.
+"""
+import asyncio
+import itertools
+import socket
+import threading
+
+from aiohttp import web
+
+
+def dead_host():
+    """URL of a port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+async def read_body(request):
+    """The decoded body of a request, None without one. aiohttp caches the
+    body, so handlers read it again for free after the middleware."""
+    return await request.json() if request.body_exists else None
+
+
+class FakeCluster:
+    def __init__(self, indices, version="8.6.2", cluster_uuid="fake-uuid"):
+        self.indices = indices
+        self.version = version
+        self.cluster_uuid = cluster_uuid
+        # Called with the aiohttp request and its decoded body, returns a status or None
+        self.fail = None
+        self.requests = []
+        self.pits = {}
+        self.closed_pits = []
+        self.scrolls = {}
+        self.cleared_scrolls = []
+        self.ids = itertools.count(1)
+        self.runner = None
+        self.loop = self.thread = None
+
+    async def start(self, nodes=1):
+        """Serve the cluster on `nodes` ports
+
+        Returns:
+            list: the URL of every node
+        """
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/", self.root)
+        app.router.add_get("/_cat/indices", self.cat_indices)
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_get("/_stats/{metrics}", self.stats)
+        app.router.add_post("/_search", self.pit_search)
+        app.router.add_post("/_search/scroll", self.scroll_next)
+        app.router.add_delete("/_search/scroll", self.scroll_clear)
+        app.router.add_delete("/_pit", self.pit_close)
+        app.router.add_get("/{index}/_mapping", self.mapping)
+        app.router.add_post("/{index}/_pit", self.pit_open)
+        app.router.add_post("/{index}/_search", self.index_search)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        hosts = []
+        for _ in range(nodes):
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            await site.start()
+            hosts.append(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+        return hosts
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def start_thread(self, nodes=1):
+        """Serve the cluster from an event loop in another thread
+
+        Returns:
+            list: the URL of every node
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(nodes), self.loop).result()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        body = await read_body(request)
+        self.requests.append((request.host, request.method, request.path, body))
+        status = self.fail(request, body) if self.fail else None
+        if status:
+            return web.json_response({"error": {"type": "fake_failure"}, "status": status},
+                                     status=status)
+        return await handler(request)
+
+    async def root(self, request):
+        return web.json_response({
+            "name": request.host,
+            "cluster_name": "fake",
+            "cluster_uuid": self.cluster_uuid,
+            "version": {"number": self.version, "build_flavor": "default",
+                        "lucene_version": "9.4.2"},
+            "tagline": "You Know, for Search",
+        })
+
+    async def cat_indices(self, request):
+        rows = [{"health": "green", "status": "open", "index": index,
+                 "docs.count": str(len(docs)), "store.size": f"{len(docs)}kb"}
+                for index, docs in self.indices.items()]
+        columns = request.query.get("h")
+        if columns:
+            rows = [{column: row.get(column) for column in columns.split(",")} for row in rows]
+        return web.json_response(rows)
+
+    async def stats(self, request):
+        return web.json_response({"indices": {
+            index: {"primaries": {"docs": {"count": len(docs)},
+                                  "store": {"size_in_bytes": 1000 * len(docs)}},
+                    "total": {"store": {"size_in_bytes": 2000 * len(docs)}}}
+            for index, docs in self.indices.items()}})
+
+    async def mapping(self, request):
+        index = request.match_info["index"]
+        if index not in self.indices:
+            return web.json_response({"error": "index_not_found"}, status=404)
+        properties = {}
+        for source in self.indices[index]:
+            for field, value in source.items():
+                properties[field] = {"type": "long" if isinstance(value, int) else "keyword"}
+        return web.json_response({index: {"mappings": {"properties": properties}}})
+
+    def slice_docs(self, index, body):
+        """Numbers of the documents of an index in the slice of a search body"""
+        numbers = range(len(self.indices[index]))
+        search_slice = (body or {}).get("slice")
+        if search_slice:
+            numbers = [number for number in numbers
+                       if number % search_slice["max"] == search_slice["id"]]
+        return list(numbers)
+
+    def hits(self, index, numbers):
+        return [{"_index": index, "_id": str(number), "_score": None,
+                 "_source": self.indices[index][number], "sort": [number]}
+                for number in numbers]
+
+    async def pit_open(self, request):
+        index = request.match_info["index"]
+        if index not in self.indices:
+            return web.json_response({"error": "index_not_found"}, status=404)
+        pit_id = f"pit-{next(self.ids)}"
+        self.pits[pit_id] = index
+        return web.json_response({"id": pit_id})
+
+    async def pit_close(self, request):
+        pit_id = (await read_body(request))["id"]
+        self.closed_pits.append(pit_id)
+        return web.json_response({"succeeded": self.pits.pop(pit_id, None) is not None})
+
+    async def pit_search(self, request):
+        body = await read_body(request)
+        pit_id = body["pit"]["id"]
+        if pit_id not in self.pits:
+            return web.json_response({"error": "search_context_missing"}, status=404)
+        index = self.pits[pit_id]
+        numbers = self.slice_docs(index, body)
+        total = len(numbers)
+        if "search_after" in body:
+            numbers = [number for number in numbers if number > body["search_after"][0]]
+        response = {"pit_id": pit_id,
+                    "hits": {"hits": self.hits(index, numbers[:body.get("size", 10)])}}
+        if body.get("track_total_hits"):
+            response["hits"]["total"] = {"value": total, "relation": "eq"}
+        return web.json_response(response)
+
+    def scroll_page(self, scroll_id):
+        index, numbers, size, total = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (index, numbers[size:], size, total)
+        return web.json_response({"_scroll_id": scroll_id,
+                                  "hits": {"total": {"value": total, "relation": "eq"},
+                                           "hits": self.hits(index, numbers[:size])}})
+
+    async def index_search(self, request):
+        index = request.match_info["index"]
+        if index not in self.indices:
+            return web.json_response({"error": "index_not_found"}, status=404)
+        scroll_id = f"scroll-{next(self.ids)}"
+        numbers = self.slice_docs(index, await read_body(request))
+        self.scrolls[scroll_id] = (index, numbers, int(request.query.get("size", 10)),
+                                   len(numbers))
+        return self.scroll_page(scroll_id)
+
+    async def scroll_next(self, request):
+        scroll_id = (await read_body(request))["scroll_id"]
+        if scroll_id not in self.scrolls:
+            return web.json_response({"error": "search_context_missing"}, status=404)
+        return self.scroll_page(scroll_id)
+
+    async def scroll_clear(self, request):
+        for scroll_id in (await read_body(request))["scroll_id"]:
+            self.cleared_scrolls.append(scroll_id)
+            self.scrolls.pop(scroll_id, None)
+        return web.json_response({"succeeded": True})
@@ -0,0 +1,270 @@
+import asyncio
+import json
+
+import pytest
+
+from elastic_api import core, export, retry
+from elastic_api.async_elastic_api import ElasticAPI
+from elastic_api.filters import RegexDictFilter
+from fake_elastic import FakeCluster, dead_host
+from utils.memory_budget import MemoryBudget
+
+USERS = [{"name": f"user{number}", "age": number} for number in range(50)]
+ORDERS = [{"item": f"item{number}", "price": number} for number in range(30)]
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    # Every test starts with closed circuits, and retries without waiting
+    monkeypatch.setattr(retry, "_breakers", {})
+    for policy in (retry.DEFAULT, retry.QUICK):
+        monkeypatch.setattr(policy, "base_delay", 0)
+        monkeypatch.setattr(policy, "max_delay", 0)
+
+
+def serve(indices, test, nodes=1, **cluster_args):
+    """Run `test(cluster, hosts)` against a fake cluster"""
+    async def run():
+        cluster = FakeCluster(indices, **cluster_args)
+        hosts = await cluster.start(nodes)
+        try:
+            return await test(cluster, hosts)
+        finally:
+            await cluster.stop()
+
+    return asyncio.run(run())
+
+
+def read_json_export(path):
+    with open(path, encoding="utf8") as export_file:
+        return [json.loads(line) for line in export_file]
+
+
+def test_failing_index_doesnt_stop_the_others(tmp_path):
+    async def test(cluster, hosts):
+        cluster.fail = lambda request, body: 404 if request.path.startswith("/orders/") else None
+        async with ElasticAPI(hosts[0], download_path=str(tmp_path), download=True,
+                              export_format="json") as api:
+            await api.probe()
+            await api.filter_db_indices()
+            return await api.download_indices()
+
+    assert serve({"orders": ORDERS, "users": USERS}, test) == [False, True]
+    assert read_json_export(tmp_path / "users.json") == USERS
+
+
+def exported_docs(folder, filename):
+    """Every document of an export, from the parts its manifest lists"""
+    with open(folder / f"{filename}.manifest.json", encoding="utf8") as manifest_file:
+        manifest = json.load(manifest_file)
+    docs = [doc for part in manifest["parts"] for doc in read_json_export(folder / part["file"])]
+    return manifest, docs
+
+
+def download_from(tmp_path, cluster_hosts, endpoints, **download_args):
+    async def download(api):
+        await api.probe(fetch_indices=False)
+        await api.download_index(cluster_hosts[0], "users", None, "users", str(tmp_path),
+                                 export_format="json", endpoints=endpoints, **download_args)
+
+    return download
+
+
+@pytest.mark.parametrize("version", ["8.6.2", "6.8.23"])
+def test_dead_endpoint_slice_is_read_from_the_others(tmp_path, version):
+    async def test(cluster, hosts):
+        async with ElasticAPI(hosts[0]) as api:
+            api.SEARCH_SIZE = 7
+            await download_from(tmp_path, hosts, [hosts[1], dead_host()])(api)
+        return cluster
+
+    cluster = serve({"users": USERS}, test, nodes=2, version=version)
+    manifest, docs = exported_docs(tmp_path, "users")
+    assert manifest["complete"] and manifest["read_docs"] == len(USERS)
+    assert sorted(docs, key=lambda doc: doc["age"]) == USERS
+    # Search contexts are still released, from the nodes that are alive
+    assert not cluster.pits and not cluster.scrolls
+
+
+def test_endpoint_failing_mid_slice_hands_over_where_it_stopped(tmp_path):
+    async def test(cluster, hosts):
+        def fail(request, body):
+            if request.host == hosts[1][7:] and body and "search_after" in body:
+                return 503
+            return None
+
+        cluster.fail = fail
+        async with ElasticAPI(hosts[0]) as api:
+            api.SEARCH_SIZE = 5
+            await download_from(tmp_path, hosts, [hosts[1]])(api)
+        return hosts
+
+    hosts = serve({"users": USERS}, test, nodes=2)
+    manifest, docs = exported_docs(tmp_path, "users")
+    assert manifest["complete"]
+    assert sorted(docs, key=lambda doc: doc["age"]) == USERS
+
+
+def test_errors_that_arent_the_hosts_fault_still_fail(tmp_path):
+    async def test(cluster, hosts):
+        cluster.fail = lambda request, body: 400 if request.host == hosts[1][7:] else None
+        async with ElasticAPI(hosts[0]) as api:
+            with pytest.raises(retry.StatusError):
+                await download_from(tmp_path, hosts, [hosts[1]])(api)
+
+    serve({"users": USERS}, test, nodes=2)
+
+
+def iter_users(hosts, endpoints=(), pages=None, **iter_args):
+    """Read users with iter_index, only the first `pages` pages if given"""
+    async def read():
+        batches = []
+        async with ElasticAPI(hosts[0]) as api:
+            iterator = api.iter_index("users", batch_size=7, endpoints=list(endpoints),
+                                      **iter_args)
+            try:
+                async for batch in iterator:
+                    batches.append([hit["_source"] for hit in batch])
+                    if len(batches) == pages:
+                        break
+            finally:
+                await iterator.aclose()
+        return batches
+
+    return read()
+
+
+@pytest.mark.parametrize("version", ["8.6.2", "6.8.23"])
+def test_iter_index_yields_every_page_in_order(version):
+    async def test(cluster, hosts):
+        batches = await iter_users(hosts)
+        return cluster, batches
+
+    cluster, batches = serve({"users": USERS}, test, version=version)
+    assert [len(batch) for batch in batches] == [7] * 7 + [1]
+    assert [doc for batch in batches for doc in batch] == USERS
+    # Every search context is released once the iteration ends
+    assert not cluster.pits and not cluster.scrolls
+
+
+def test_iter_index_reads_a_slice_from_every_endpoint():
+    async def test(cluster, hosts):
+        batches = await iter_users(hosts, endpoints=hosts[1:])
+        return cluster, hosts, batches
+
+    cluster, hosts, batches = serve({"users": USERS}, test, nodes=2)
+    assert sorted((doc for batch in batches for doc in batch),
+                  key=lambda doc: doc["age"]) == USERS
+    searched = {host for host, method, path, body in cluster.requests if path == "/_search"}
+    assert searched == {host[7:] for host in hosts}
+    assert not cluster.pits
+
+
+def test_iter_index_applies_doc_filters():
+    async def test(cluster, hosts):
+        return await iter_users(hosts, doc_filters=[RegexDictFilter("name", "^user1")])
+
+    batches = serve({"users": USERS}, test)
+    assert [doc["age"] for batch in batches for doc in batch] == [1] + list(range(10, 20))
+
+
+@pytest.mark.parametrize("version", ["8.6.2", "6.8.23"])
+def test_iter_index_closed_early_releases_its_search_contexts(version):
+    async def test(cluster, hosts):
+        batches = await iter_users(hosts, endpoints=hosts[1:], pages=1)
+        return cluster, batches
+
+    cluster, batches = serve({"users": USERS}, test, nodes=2, version=version)
+    assert len(batches) == 1
+    assert not cluster.pits and not cluster.scrolls
+    assert cluster.closed_pits or cluster.cleared_scrolls
+
+
+def test_indices_come_with_the_requested_columns_and_exact_sizes():
+    async def test(cluster, hosts):
+        async with ElasticAPI(hosts[0]) as api:
+            await api.probe()
+            return cluster, api.indices
+
+    cluster, indices = serve({"users": USERS, "orders": ORDERS}, test)
+    listed = [request for request in cluster.requests if request[2] == "/_cat/indices"]
+    assert len(listed) == 1
+    assert {Index.index: Index.stats for Index in indices} == {
+        "users": core.IndexStats(50, 50_000, 100_000),
+        "orders": core.IndexStats(30, 30_000, 60_000)}
+    # Columns that weren't requested stay empty
+    assert {Index.health for Index in indices} == {""}
+    assert [Index.docs_count for Index in indices] == ["50", "30"]
+
+
+def test_indices_are_sampled_within_the_probe_limit():
+    budget = MemoryBudget(core.parse_size("1gb"))
+    budget.probe_limit = 2
+    api = ElasticAPI("http://127.0.0.1:9200", memory_budget=budget)
+    api.filtered_indices = [core.ElasticIndex(index=f"index-{number}") for number in range(7)]
+    running = []
+    most = 0
+
+    async def work(index):
+        nonlocal most
+        running.append(index)
+        most = max(most, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(index)
+        return index
+
+    assert asyncio.run(api.for_each_index(work)) == [Index.index for Index in api.filtered_indices]
+    assert most == 2
+
+
+def test_sample_indices_writes_a_sample_per_index(tmp_path):
+    async def test(cluster, hosts):
+        async with ElasticAPI(hosts[0], download_path=str(tmp_path), sample=5,
+                              memory_budget=MemoryBudget(core.parse_size("64mb"))) as api:
+            await api.probe()
+            await api.filter_db_indices()
+            paths = await api.sample_indices()
+            return paths, api.memory_budget.pages.in_flight
+
+    paths, in_flight = serve({"users": USERS, "orders": ORDERS}, test)
+    assert len(paths) == 2 and all(paths)
+    # Every sample gave its page back
+    assert in_flight == 0
+
+
+def test_documents_dropped_by_filters_still_make_a_complete_download(tmp_path):
+    async def test(cluster, hosts):
+        async with ElasticAPI(hosts[0], doc_filters=[RegexDictFilter("name", "^user1")]) as api:
+            await download_from(tmp_path, hosts, [])(api)
+
+    serve({"users": USERS}, test)
+    manifest, docs = exported_docs(tmp_path, "users")
+    assert len(docs) == 11
+    assert (manifest["read_docs"], manifest["skipped_docs"], manifest["written_docs"]) == \
+        (50, 39, 11)
+    assert manifest["complete"]
+    assert export.verify_manifest(tmp_path / "users.manifest.json") == []
+
+
+def test_failed_write_after_the_last_read_is_incomplete(tmp_path, monkeypatch):
+    write_hits = export.RotatingOutput.write_hits
+
+    def fail_on_last_user(output, hits):
+        if any(hit["_source"]["age"] == 49 for hit in hits):
+            raise OSError("No space left on device")
+        write_hits(output, hits)
+
+    monkeypatch.setattr(export.RotatingOutput, "write_hits", fail_on_last_user)
+
+    async def test(cluster, hosts):
+        async with ElasticAPI(hosts[0]) as api:
+            api.SEARCH_SIZE = 25
+            with pytest.raises(OSError):
+                await download_from(tmp_path, hosts, [])(api)
+
+    serve({"users": USERS}, test)
+    manifest, docs = exported_docs(tmp_path, "users")
+    assert manifest["read_docs"] == manifest["expected_docs"] == 50
+    assert not manifest["complete"]
+    assert export.verify_manifest(tmp_path / "users.manifest.json") == [
+        "wrote 25 of 50 documents"]
@@ -0,0 +1,239 @@
+from elastic_api import core, export
+from elastic_api.filters import RegexFilter
+
+ROOT_RESPONSE = {
+    "name": "node-1",
+    "cluster_name": "prod",
+    "cluster_uuid": "abc",
+    "version": {"number": "8.6.2", "build_flavor": "default", "lucene_version": "9.4.2"},
+    "tagline": "You Know, for Search",
+}
+
+
+def search_response(hit_count, total, scroll_id=None, total_as_int=False):
+    hits = [{"_id": str(number), "_source": {"n": number}, "sort": [number]}
+            for number in range(hit_count)]
+    response = {"hits": {"total": total if total_as_int else {"value": total, "relation": "eq"},
+                         "hits": hits}}
+    if scroll_id is not None:
+        response["_scroll_id"] = scroll_id
+    return response
+
+
+def test_is_root_response():
+    assert core.is_root_response(ROOT_RESPONSE)
+    assert not core.is_root_response({"error": "unauthorized"})
+    assert not core.is_root_response({"version": "8.6.2", "cluster_name": "prod"})
+    assert not core.is_root_response(None)
+    assert not core.is_root_response([ROOT_RESPONSE])
+
+
+def test_parse_db_info():
+    database = core.parse_db_info(ROOT_RESPONSE)
+    assert database.name == "node-1"
+    assert database.cluster_uuid == "abc"
+    assert database.version_number == "8.6.2"
+    assert database.lucene_version == "9.4.2"
+    assert database.build_type == ""
+
+
+def test_get_total_hits():
+    assert core.get_total_hits(search_response(0, 42)) == 42
+    assert core.get_total_hits(search_response(0, 42, total_as_int=True)) == 42
+    # Without a total (e.g. track_total_hits false) the page is all we know
+    assert core.get_total_hits({"hits": {"total": None, "hits": [{}, {}]}}) == 2
+    assert core.get_total_hits({"hits": {"hits": [{}]}}) == 1
+
+
+def test_scroll_reader_reads_every_page():
+    reader = core.ScrollReader("users", search_size=2)
+    first = reader.next_request()
+    assert first.path == "/users/_search"
+    assert first.params == {"scroll": core.KEEP_ALIVE, "size": 2}
+
+    assert len(reader.feed(search_response(2, 5, "s1"))) == 2
+    second = reader.next_request()
+    assert second.path == "/_search/scroll"
+    assert second.body["scroll_id"] == "s1"
+
+    # The scroll ID may change, the latest one is used and released
+    reader.feed(search_response(2, 5, "s2"))
+    assert reader.next_request().body["scroll_id"] == "s2"
+    reader.feed(search_response(1, 5, "s3"))
+    assert reader.done
+    assert reader.next_request() is None
+    assert reader.accumulated_hits == 5
+    assert reader.close_request().body == {"scroll_id": ["s3"]}
+
+
+def test_scroll_reader_stops_on_empty_page():
+    reader = core.ScrollReader("users", search_size=2)
+    reader.feed(search_response(2, 10, "s1"))
+    reader.feed(search_response(0, 10, "s1"))
+    assert reader.done
+    assert reader.accumulated_hits == 2
+
+
+def test_scroll_reader_of_empty_index():
+    reader = core.ScrollReader("users")
+    reader.feed(search_response(0, 0, "s1"))
+    assert reader.done
+    assert reader.close_request() is not None
+
+
+def test_scroll_reader_slices():
+    reader = core.ScrollReader("users", slice_id=1, max_slices=3)
+    assert reader.next_request().body == {"slice": {"id": 1, "max": 3}}
+    assert core.ScrollReader("users", slice_id=0, max_slices=1).next_request().body is None
+
+
+def test_parse_indices_and_filters():
+    indices = core.parse_indices([
+        {"index": "users", "docs.count": "10", "store.size": "1kb"},
+        {"index": ".security", "docs.count": None, "store.size": "2kb"},
+    ])
+    assert [index.index for index in indices] == ["users", ".security"]
+    # Closed indices report null counts
+    assert indices[1].docs_count == ""
+    assert indices[0].health == ""
+    assert core.apply_filters(indices, None) == indices
+    name_filter = RegexFilter("index")
+    name_filter.add_filter("^user")
+    assert [index.index for index in core.apply_filters(indices, [name_filter])] == ["users"]
+
+
+def test_pit_reader_pages_with_search_after():
+    reader = core.PitReader("pit-1", search_size=2, slice_id=0, max_slices=2,
+                            query={"match_all": {}})
+    first = reader.next_request()
+    assert first.path == "/_search"
+    assert first.body["pit"] == {"id": "pit-1", "keep_alive": core.KEEP_ALIVE}
+    assert first.body["sort"] == [{"_shard_doc": "asc"}]
+    assert first.body["track_total_hits"] is True
+    assert first.body["slice"] == {"id": 0, "max": 2}
+    assert first.body["query"] == {"match_all": {}}
+    assert "search_after" not in first.body
+
+    page = search_response(2, 5)
+    page["pit_id"] = "pit-2"
+    reader.feed(page)
+    second = reader.next_request()
+    assert second.body["search_after"] == [1]
+    assert second.body["track_total_hits"] is False
+    # The point in time ID may change, the latest one is used and closed
+    assert second.body["pit"]["id"] == "pit-2"
+    assert reader.pit_id == "pit-2"
+
+
+def test_pit_reader_stops_on_total_or_short_page():
+    reader = core.PitReader("pit", search_size=2)
+    reader.feed(search_response(2, 4))
+    reader.feed(search_response(2, 4))
+    assert reader.done and reader.accumulated_hits == 4
+
+    reader = core.PitReader("pit", search_size=2)
+    reader.feed(search_response(2, 10))
+    reader.feed(search_response(1, 10))
+    assert reader.done and reader.accumulated_hits == 3
+    # Slices share the point in time, which the download closes
+    assert reader.close_request() is None
+
+
+def test_make_reader():
+    assert isinstance(core.make_reader("users", "pit"), core.PitReader)
+    assert isinstance(core.make_reader("users", None), core.ScrollReader)
+
+
+def test_supports_pit():
+    database = core.parse_db_info(ROOT_RESPONSE)
+    assert core.supports_pit(database)
+    database.version_number = "7.11.2"
+    assert not core.supports_pit(database)
+    database.version_number = "7.12.0-SNAPSHOT"
+    assert core.supports_pit(database)
+    database.distribution = "opensearch"
+    assert not core.supports_pit(database)
+    assert not core.supports_pit(None)
+
+
+def test_pit_requests():
+    assert core.open_pit_request("users").path == "/users/_pit"
+    assert core.close_pit_request("pit").body == {"id": "pit"}
+
+
+def test_read_totals():
+    readers = [core.ScrollReader("users", slice_id=number, max_slices=2) for number in range(2)]
+    readers[0].feed(search_response(2, 2, "s1"))
+    readers[0].feed(search_response(0, 2, "s1"))
+    # A slice not read from yet doesn't know its total
+    assert core.read_totals(readers) == core.ReadTotals(None, 2, None, None, False)
+    readers[1].feed(search_response(3, 3, "s2"))
+    assert core.read_totals(readers) == core.ReadTotals(5, 5, None, None, True)
+
+
+def test_read_totals_count_what_was_written(tmp_path):
+    reader = core.ScrollReader("users")
+    hits = reader.feed(search_response(5, 5, "s1"))
+    reader.feed(search_response(0, 5, "s1"))
+    output = export.RotatingOutput(str(tmp_path), "users", "json")
+    output.skip(2)
+    output.write_hits(hits[:3])
+    # Slices sharing a writer count it once
+    assert core.read_totals([reader], [output, output]) == core.ReadTotals(5, 5, 2, 3, True)
+    output.close()
+    assert core.read_totals([reader], [output]) == core.ReadTotals(5, 5, 2, 3, True)
+
+
+def test_read_totals_of_a_failed_write(tmp_path):
+    reader = core.ScrollReader("users")
+    hits = reader.feed(search_response(5, 5, "s1"))
+    reader.feed(search_response(0, 5, "s1"))
+    output = export.RotatingOutput(str(tmp_path), "users", "json")
+    output.write_hits(hits[:2])
+    # Every document was read, but the rest never made it to disk
+    assert core.read_totals([reader], [output]) == core.ReadTotals(5, 5, 0, 2, False)
+
+
+def test_read_totals_of_a_truncated_read():
+    reader = core.ScrollReader("users", search_size=2)
+    reader.feed(search_response(2, 5, "s1"))
+    reader.feed(search_response(0, 5, "s1"))
+    assert reader.done
+    assert core.read_totals([reader]) == core.ReadTotals(5, 2, None, None, False)
+
+
+def test_index_fields_adds_the_columns_filters_read():
+    assert core.index_fields() == list(core.BASE_INDEX_FIELDS)
+    health_filter = RegexFilter("health")
+    name_filter = RegexFilter("index")
+    assert core.index_fields([health_filter, name_filter]) == \
+        list(core.BASE_INDEX_FIELDS) + ["health"]
+    # Filters on fields `_cat/indices` doesn't know need every column
+    assert core.index_fields([RegexFilter("stats")]) is None
+
+
+def test_indices_request_selects_columns():
+    request = core.indices_request(["index", "docs_count", "pri_store_size", "health"])
+    assert (request.method, request.path) == ("GET", "/_cat/indices")
+    assert request.params == {"format": "json", "h": "index,docs.count,pri.store.size,health"}
+    assert core.indices_request(None).path == core.INDICES_URL
+    assert core.indices_request(None).params is None
+
+
+def test_parse_index_stats_and_attach():
+    stats = core.parse_index_stats({"indices": {
+        "users": {"primaries": {"docs": {"count": 10}, "store": {"size_in_bytes": 2048}},
+                  "total": {"store": {"size_in_bytes": 4096}}},
+        # Closed indices have no metrics
+        "closed": {},
+    }})
+    assert stats == {"users": core.IndexStats(10, 2048, 4096),
+                     "closed": core.IndexStats(None, None, None)}
+    # filter_path leaves out `indices` when nothing matches
+    assert core.parse_index_stats({}) == {}
+
+    indices = core.parse_indices([{"index": "users", "pri.store.size": "2kb"},
+                                  {"index": "logs", "pri.store.size": "1kb"}])
+    core.attach_index_stats(indices, stats)
+    assert indices[0].stats.pri_store_bytes == 2048
+    assert indices[1].stats is None
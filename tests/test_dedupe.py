@@ -0,0 +1,116 @@
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from elastic_api import dedupe
+
+
+@pytest.mark.parametrize("index, group", [
+    ("logs-000002", "logs"),
+    ("logs-2023.01.02-000003", "logs"),
+    ("users_v2", "users"),
+    ("users-reindexed", "users"),
+    ("orders.backup", "orders"),
+    ("metrics-2024-05", "metrics"),
+    ("users", "users"),
+    ("2023.01.02", "2023.01.02"),
+    ("v2", "v2"),
+])
+def test_index_group(index, group):
+    assert dedupe.index_group(index) == group
+
+
+def test_hit_key():
+    hit = {"_index": "users-000001", "_id": "7", "_source": {"a": 1, "b": [1, 2]}}
+    alias = {"_index": "users_v2", "_id": "7", "_source": {"b": [1, 2], "a": 1}}
+    other = {"_index": "orders", "_id": "7", "_source": {"a": 1, "b": [1, 2]}}
+    assert len(dedupe.hit_key(hit, "id")) == dedupe.KEY_SIZE
+    assert dedupe.hit_key(hit, "id") == dedupe.hit_key(alias, "id")
+    assert dedupe.hit_key(hit, "id") != dedupe.hit_key(other, "id")
+    # Content keys ignore the index, the ID and the order of fields
+    assert dedupe.hit_key(hit, "content") == dedupe.hit_key(alias, "content")
+    assert dedupe.hit_key(hit, "content") == dedupe.hit_key(other, "content")
+    assert dedupe.hit_key(hit, "content") != dedupe.hit_key({"_source": {"a": 2}}, "content")
+
+
+def key(number):
+    return hashlib.blake2b(str(number).encode(), digest_size=dedupe.KEY_SIZE).digest()
+
+
+def test_bloom_filter_never_misses_a_key():
+    bloom = dedupe.ScalableBloomFilter(capacity=1000, error_rate=0.01)
+    assert sum(bloom.add(key(number)) for number in range(1000)) < 20
+    assert all(bloom.add(key(number)) for number in range(1000))
+    false_positives = sum(bloom.add(key(number)) for number in range(1000, 11000))
+    assert false_positives < 200
+
+
+def test_bloom_filter_adds_layers_as_it_fills():
+    bloom = dedupe.ScalableBloomFilter(capacity=100, error_rate=0.01, growth=4)
+    for number in range(3000):
+        bloom.add(key(number))
+    assert [layer.capacity for layer in bloom.layers] == [100, 400, 1600, 6400]
+    assert bloom.layers[1].error_rate < bloom.layers[0].error_rate
+    assert bloom.nbytes == sum(len(layer.bits) for layer in bloom.layers)
+    assert all(bloom.add(key(number)) for number in range(3000))
+
+
+def hits(numbers, index="users"):
+    return [{"_index": index, "_id": str(number), "_source": {"n": number}}
+            for number in numbers]
+
+
+def test_deduplicator_by_id():
+    deduplicator = dedupe.Deduplicator("id")
+    assert deduplicator.unique(hits(range(5), "users-000001")) == hits(range(5), "users-000001")
+    assert deduplicator.unique(hits([3, 4, 5, 5], "users-000002")) == hits([5], "users-000002")
+    assert deduplicator.unique(hits([3], "orders")) == hits([3], "orders")
+    assert (deduplicator.kept, deduplicator.dropped) == (7, 3)
+    deduplicator.close()
+
+
+def test_deduplicator_by_content():
+    deduplicator = dedupe.Deduplicator("content")
+    first, second = hits([1, 2]), hits([2, 3], "orders")
+    assert deduplicator.unique(first) == first
+    assert deduplicator.unique(second) == second[1:]
+    deduplicator.close()
+
+
+def test_false_positives_never_drop_unique_hits():
+    # A filter this small says "maybe seen" for nearly every key
+    deduplicator = dedupe.Deduplicator("id", capacity=8, error_rate=0.5)
+    deduplicator.bloom.growth = 1
+    deduplicator.bloom.tightening = 1
+    assert len(deduplicator.unique(hits(range(3000)))) == 3000
+    assert deduplicator.unique(hits(range(3000))) == []
+    deduplicator.close()
+
+
+def test_keys_spill_to_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedupe, "SPILL_BATCH_SIZE", 10)
+    spill_path = str(tmp_path / "seen.sqlite")
+    deduplicator = dedupe.Deduplicator("id", spill_path=spill_path)
+    deduplicator.unique(hits(range(25)))
+    assert len(deduplicator.pending) == 5
+    # Keys in the spill file and pending keys are both found
+    assert deduplicator.unique(hits([0, 24, 25])) == hits([25])
+    deduplicator.close()
+    # A given spill file is kept
+    with sqlite3.connect(spill_path) as db:
+        assert db.execute("SELECT COUNT(*) FROM seen").fetchone() == (26,)
+
+
+def test_close_removes_temporary_spill_file():
+    deduplicator = dedupe.Deduplicator()
+    deduplicator.unique(hits(range(3)))
+    assert os.path.exists(deduplicator.spill_path)
+    deduplicator.close()
+    assert not os.path.exists(deduplicator.spill_path)
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError, match="id, content"):
+        dedupe.Deduplicator("source")
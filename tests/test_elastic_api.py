@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from elastic_api import core, planner, retry
+from elastic_api.elastic_api import ElasticAPI
+from fake_elastic import FakeCluster, dead_host
+
+USERS = [{"name": f"user{number}", "age": number} for number in range(50)]
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    # Every test starts with closed circuits, and retries without waiting
+    monkeypatch.setattr(retry, "_breakers", {})
+    for policy in (retry.DEFAULT, retry.QUICK):
+        monkeypatch.setattr(policy, "base_delay", 0)
+        monkeypatch.setattr(policy, "max_delay", 0)
+
+
+@pytest.fixture
+def cluster():
+    cluster = FakeCluster({"users": USERS})
+    cluster.hosts = cluster.start_thread(nodes=2)
+    yield cluster
+    cluster.stop_thread()
+
+
+def test_failing_index_doesnt_stop_the_others(tmp_path, monkeypatch, capsys):
+    api = ElasticAPI("http://127.0.0.1:9200", download_path=str(tmp_path), max_workers=2)
+    api.filtered_indices = [core.ElasticIndex(index=name) for name in ("users", "orders", "logs")]
+    downloaded = []
+
+    def download_index_single(index, fieldnames=None):
+        if index == "orders":
+            raise retry.StatusError(500)
+        downloaded.append(index)
+
+    monkeypatch.setattr(api, "download_index_single", download_index_single)
+    monkeypatch.setattr(api, "plan_downloads", lambda: planner.DownloadPlan(
+        [planner.PlannedIndex(Index, 0, 0) for Index in api.filtered_indices],
+        str(tmp_path), 0, "ignore"))
+    assert api.download_indices() == [True, False, True]
+    assert sorted(downloaded) == ["logs", "users"]
+    assert "Failed to download http://127.0.0.1:9200/orders: HTTP 500" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("passthrough", [False, True])
+def test_dead_endpoint_slice_is_read_from_the_others(tmp_path, cluster, passthrough):
+    hosts = cluster.hosts
+    with ElasticAPI(hosts[0]) as api:
+        api.SEARCH_SIZE = 7
+        api.probe(fetch_indices=False)
+        api.download_index(hosts[0], "users", None, "users", str(tmp_path),
+                           export_format="json", endpoints=[hosts[1], dead_host()],
+                           passthrough=passthrough)
+    with open(tmp_path / "users.manifest.json", encoding="utf8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["complete"]
+    docs = []
+    for part in manifest["parts"]:
+        with open(tmp_path / part["file"], encoding="utf8") as part_file:
+            docs.extend(json.loads(line) for line in part_file)
+    assert sorted(docs, key=lambda doc: doc["age"]) == USERS
+    assert not cluster.pits
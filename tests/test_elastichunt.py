@@ -0,0 +1,142 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import elastichunt
+from elastic_api import retry
+from fake_elastic import FakeCluster
+from utils.liveness_cache import LivenessCache
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    monkeypatch.setattr(retry, "_breakers", {})
+
+
+def cli_args(cli, *argv):
+    args = cli.parser.parse_args(["--no-banner", *argv])
+    args.ports = args.ports or args.port
+    args.budget = args.deduplicator = args.cache = None
+    return args
+
+
+def test_failing_cluster_doesnt_stop_the_others(tmp_path, monkeypatch, capsys):
+    scanned = []
+
+    async def scan_db(self, nodes, args):
+        scanned.append(nodes[0].ElasticDB.cluster_uuid)
+        await asyncio.gather(*[node.close() for node in nodes])
+        if nodes[0].ElasticDB.cluster_uuid == "broken":
+            raise retry.HostUnavailable(f"{nodes[0].host} is not responding")
+
+    async def run():
+        broken, healthy = FakeCluster({}, cluster_uuid="broken"), FakeCluster({})
+        hosts = await broken.start() + await healthy.start()
+        try:
+            cli = elastichunt.AsyncCLI()
+            args = cli_args(cli, "127.0.0.1", "--downloadpath", str(tmp_path))
+            await cli.scan_potential_dbs(hosts, args)
+        finally:
+            await broken.stop()
+            await healthy.stop()
+        return hosts
+
+    monkeypatch.setattr(elastichunt.AsyncCLI, "scan_db", scan_db)
+    hosts = asyncio.run(run())
+    assert sorted(scanned) == ["broken", "fake-uuid"]
+    assert f"Failed to scan {hosts[0]}: {hosts[0]} is not responding" in capsys.readouterr().out
+
+
+class Node:
+    """Stands in for a probed ElasticAPI"""
+    def __init__(self, host, cluster_uuid, probe_rtt):
+        self.host = host
+        self.ElasticDB = SimpleNamespace(cluster_uuid=cluster_uuid)
+        self.probe_rtt = probe_rtt
+        self.endpoints = []
+        self.closed = self.automated = False
+
+    async def close(self):
+        self.closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def automate(self):
+        self.automated = True
+
+
+def hosts_of(clusters):
+    return [[node.host for node in nodes] for nodes in clusters]
+
+
+def test_group_clusters_by_uuid():
+    nodes = [Node("http://a:9200", "prod", 0.3), Node("http://b:9200", "test", 0.1),
+             Node("http://c:9200", "prod", 0.1), Node("http://d:9200", "prod", 0.2)]
+    assert hosts_of(elastichunt.AsyncCLI.group_clusters(nodes)) == [
+        ["http://c:9200", "http://d:9200", "http://a:9200"], ["http://b:9200"]]
+
+
+def test_nodes_without_a_cluster_stay_alone():
+    nodes = [Node("http://a:9200", "_na_", 0.1), Node("http://b:9200", "_na_", 0.1),
+             Node("http://c:9200", "", 0.1), Node("http://d:9200", None, 0.1)]
+    assert hosts_of(elastichunt.AsyncCLI.group_clusters(nodes)) == [
+        ["http://a:9200"], ["http://b:9200"], ["http://c:9200"], ["http://d:9200"]]
+
+
+def test_equally_fast_nodes_are_ordered_by_host():
+    nodes = [Node("http://b:9200", "prod", 0.1), Node("http://a:9200", "prod", 0.1)]
+    assert hosts_of(elastichunt.AsyncCLI.group_clusters(nodes)) == [
+        ["http://a:9200", "http://b:9200"]]
+
+
+def test_first_node_represents_the_cluster():
+    nodes = [Node("http://a:9200", "prod", 0.1), Node("http://b:9200", "prod", 0.2),
+             Node("http://c:9200", "prod", 0.3)]
+    asyncio.run(elastichunt.AsyncCLI().scan_db(nodes, None))
+    representative = nodes[0]
+    assert representative.automated and representative.closed
+    assert representative.endpoints == ["http://b:9200", "http://c:9200"]
+    # The other nodes only lend their address to download slices
+    assert all(node.closed and not node.automated for node in nodes[1:])
+
+
+def test_staged_scan_saves_the_cache_once(tmp_path, monkeypatch):
+    stages = []
+
+    class Scanner:
+        def __init__(self, ipaddr, ports, cache=None, **scanner_args):
+            self.ipaddr, self.ports, self.cache = ipaddr, ports, cache
+            self.potential_dbs, self.connect_rtts = [], {}
+
+        async def run_scan(self):
+            stages.append(self.ipaddr)
+            for ip in self.ipaddr:
+                self.cache.record(ip, self.ports[0], False)
+            self.cache.checkpoint()
+
+    saves = []
+    save = LivenessCache.save
+
+    def counting_save(cache):
+        saves.append(len(cache.closed))
+        save(cache)
+
+    async def scan_potential_dbs(self, potential_dbs, args, connect_rtts=None):
+        pass
+
+    monkeypatch.setattr(elastichunt.async_scanner, "AsyncScanner", Scanner)
+    monkeypatch.setattr(LivenessCache, "save", counting_save)
+    monkeypatch.setattr(elastichunt.AsyncCLI, "scan_potential_dbs", scan_potential_dbs)
+    cli = elastichunt.AsyncCLI()
+    args = cli.parser.parse_args(["--no-banner", "10.0.0.0/30", "--staged", "--numstages", "31",
+                                  "--cache-ttl", "1d",
+                                  "--cache-file", str(tmp_path / "liveness.bin")])
+    asyncio.run(cli.run_cli(args))
+    assert len(stages) == 2
+    assert saves == [4]
+    assert len(LivenessCache(str(tmp_path / "liveness.bin"), ttl=60)) == 4
@@ -0,0 +1,119 @@
+import csv
+import json
+import os
+
+import pytest
+
+from elastic_api import core, export
+
+
+def make_hits(count, size=100):
+    return [{"_source": {"id": number, "text": "x" * (size + number % 7),
+                         "name": "é" * (number % 5)}}
+            for number in range(count)]
+
+
+def read_part(folder, part, export_format):
+    path = os.path.join(folder, part["file"])
+    if export_format == "csv":
+        with open(path, newline="", encoding="utf8") as part_file:
+            return list(csv.DictReader(part_file))
+    with open(path, encoding="utf8") as part_file:
+        return [json.loads(line) for line in part_file]
+
+
+@pytest.mark.parametrize("export_format", ["csv", "json"])
+def test_parts_stay_within_max_file_size(tmp_path, export_format):
+    hits = make_hits(1000)
+    output = export.RotatingOutput(str(tmp_path), "users", export_format,
+                                   ["id", "text", "name"], max_file_size=5000)
+    for start in range(0, len(hits), 128):
+        output.write_hits(hits[start:start + 128])
+    parts = output.close()
+
+    assert len(parts) > 1
+    for part in parts:
+        assert part["bytes"] <= 5000
+        assert os.path.getsize(tmp_path / part["file"]) == part["bytes"]
+    # Every part loads on its own, CSV parts with their own header
+    documents = [document for part in parts
+                 for document in read_part(str(tmp_path), part, export_format)]
+    assert [int(document["id"]) for document in documents] == list(range(1000))
+
+
+def test_document_larger_than_limit_gets_its_own_part(tmp_path):
+    output = export.RotatingOutput(str(tmp_path), "big", "json", max_file_size=50)
+    output.write_hits([{"_source": {"text": "x" * 200}}, {"_source": {"text": "y"}},
+                       {"_source": {"text": "z"}}])
+    parts = output.close()
+    assert [part["docs"] for part in parts] == [1, 2]
+
+
+def test_max_docs_per_file(tmp_path):
+    output = export.RotatingOutput(str(tmp_path), "users", "json", max_docs_per_file=300)
+    output.write_hits(make_hits(1000))
+    assert [part["docs"] for part in output.close()] == [300, 300, 300, 100]
+
+
+def test_unsharded_output_is_a_single_file(tmp_path):
+    output = export.RotatingOutput(str(tmp_path), "users", "csv", ["id"])
+    output.write_hits(make_hits(10))
+    parts = output.close()
+    assert [part["file"] for part in parts] == ["users.csv"]
+    assert parts[0]["docs"] == 10
+
+
+def test_empty_export_still_leaves_a_file(tmp_path):
+    parts = export.RotatingOutput(str(tmp_path), "empty", "json").close()
+    assert parts == [{"file": "empty.json", "docs": 0, "bytes": 0,
+                      export.CHECKSUM: export.file_checksum(tmp_path / "empty.json")}]
+
+
+def export_with_manifest(folder, totals):
+    folder.mkdir(exist_ok=True)
+    output = export.RotatingOutput(str(folder), "users", "json", max_docs_per_file=4)
+    output.write_hits(make_hits(10))
+    output.close()
+    return export.write_manifest(str(folder), "users", "users", "json", [output], totals)
+
+
+def test_manifest_of_a_complete_export_verifies(tmp_path):
+    manifest_path = export_with_manifest(tmp_path, core.ReadTotals(10, 10, 0, 10, True))
+    with open(manifest_path, encoding="utf8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["docs"] == 10
+    assert manifest["expected_docs"] == 10
+    assert [part["docs"] for part in manifest["parts"]] == [4, 4, 2]
+    assert export.verify_manifest(manifest_path) == []
+    assert export.find_manifests(str(tmp_path)) == [manifest_path]
+
+
+def test_verify_manifest_reports_incomplete_downloads(tmp_path):
+    short = export_with_manifest(tmp_path / "short", core.ReadTotals(12, 10, 0, 10, False))
+    assert export.verify_manifest(short) == ["read 10 of 12 documents"]
+    unfinished = export_with_manifest(tmp_path / "unfinished", core.ReadTotals(10, 10, 0, 10, False))
+    assert export.verify_manifest(unfinished) == ["the download didn't finish"]
+    # Counted from the parts, whatever the writers reported
+    lost = export_with_manifest(tmp_path / "lost", core.ReadTotals(12, 12, 1, 12, True))
+    assert export.verify_manifest(lost) == ["wrote 10 of 11 documents"]
+    filtered = export_with_manifest(tmp_path / "filtered", core.ReadTotals(12, 12, 2, 10, True))
+    assert export.verify_manifest(filtered) == []
+    unknown = export_with_manifest(tmp_path / "unknown", None)
+    assert export.verify_manifest(unknown) == ["no document counts recorded"]
+
+
+def test_verify_manifest_reports_damaged_parts(tmp_path):
+    manifest_path = export_with_manifest(tmp_path, core.ReadTotals(10, 10, 0, 10, True))
+    parts = sorted(tmp_path.glob("users*.json"))
+    parts = [part for part in parts if not part.name.endswith(".manifest.json")]
+    os.remove(parts[0])
+    with open(parts[1], "ab") as part_file:
+        part_file.write(b"\n")
+    # Same size, different bytes
+    data = bytearray(parts[2].read_bytes())
+    data[0:1] = b"["
+    parts[2].write_bytes(bytes(data))
+    problems = export.verify_manifest(manifest_path)
+    assert problems[0] == f"{parts[0].name} is missing"
+    assert problems[1].startswith(f"{parts[1].name} is ")
+    assert problems[2] == f"{parts[2].name} doesn't match its checksum"
@@ -0,0 +1,95 @@
+import re
+
+import pytest
+
+from elastic_api import core, mapping
+from elastic_api.filters import NestedRegexDictFilter, RegexDictFilter
+
+FIELDS = mapping.queryable_fields({
+    "name": {"type": "keyword"},
+    "code": {"type": "constant_keyword"},
+    "path": {"type": "wildcard"},
+    "title": {"type": "text"},
+    "email": {"type": "keyword", "normalizer": "lowercase"},
+    "tag": {"type": "keyword", "ignore_above": 256},
+    "address": {"properties": {"city": {"type": "keyword"}}},
+    "orders": {"type": "nested", "properties": {"sku": {"type": "keyword"}}},
+})
+
+
+def regex_filter(field_name, *patterns, filter_class=RegexDictFilter):
+    doc_filter = filter_class(field_name)
+    for pattern in patterns:
+        doc_filter.add_filter(pattern)
+    return doc_filter
+
+
+@pytest.mark.parametrize("field_name", ["name", "code", "path"])
+def test_literal_patterns_on_exact_keywords_are_pushed_down(field_name):
+    assert regex_filter(field_name, "ab1", "Zed").to_query(FIELDS) == {
+        "regexp": {field_name: {"value": ".*([aA][bB]1|[zZ][eE][dD]).*"}}}
+
+
+def test_pushed_down_query_matches_like_the_regex():
+    query = regex_filter("name", "ann").to_query(FIELDS)
+    # Elasticsearch regexps are anchored, like fullmatch
+    pattern = re.compile(query["regexp"]["name"]["value"])
+    for value in ["ann", "JoANNa", "xANNx"]:
+        assert pattern.fullmatch(value)
+    assert not pattern.fullmatch("an n")
+
+
+@pytest.mark.parametrize("field_name", [
+    "title",    # analyzed
+    "email",    # normalized
+    "tag",      # longer values aren't indexed
+    "missing",  # not in the mapping
+    "orders.sku",  # needs a nested query
+])
+def test_fields_that_dont_store_values_as_they_are_stay_client_side(field_name):
+    assert regex_filter(field_name, "ann").to_query(FIELDS) is None
+
+
+@pytest.mark.parametrize("patterns", [(), ("an+",), ("ann", "b.b"), ("ann bob",), ("ünï",)])
+def test_non_literal_patterns_stay_client_side(patterns):
+    assert regex_filter("name", *patterns).to_query(FIELDS) is None
+
+
+def test_nested_object_fields_are_pushed_down_by_path():
+    doc_filter = regex_filter("address.city", "oslo", filter_class=NestedRegexDictFilter)
+    assert doc_filter.to_query(FIELDS) == {
+        "regexp": {"address.city": {"value": ".*([oO][sS][lL][oO]).*"}}}
+
+
+def test_filters_query_keeps_only_translated_filters():
+    doc_filters = [regex_filter("name", "ann"), regex_filter("title", "ann")]
+    assert core.filters_query(doc_filters, FIELDS) == {
+        "bool": {"filter": [doc_filters[0].to_query(FIELDS)]}}
+    assert core.filters_query(doc_filters[1:], FIELDS) is None
+    assert core.filters_query(None, FIELDS) is None
+
+
+def test_apply_matches_case_insensitively_and_in_arrays():
+    items = [{"name": "Ann"}, {"name": ["x", "joanna"]}, {"name": 12}, {"name": None}, {}]
+    assert regex_filter("name", "ann", "^1").apply(items) == items[:3]
+    # Without patterns nothing matches
+    assert regex_filter("name").apply(items) == []
+
+
+def test_nested_apply_follows_objects_and_arrays_of_objects():
+    items = [
+        {"address": {"city": "Oslo"}},
+        {"address": [{"city": "Rome"}, {"city": "oslo"}]},
+        {"address": {"city": "Bergen"}},
+        {"address": "Oslo"},
+        {},
+    ]
+    doc_filter = regex_filter("address.city", "oslo", filter_class=NestedRegexDictFilter)
+    assert doc_filter.apply(items) == items[:2]
+
+
+def test_patterns_added_later_are_compiled_in():
+    doc_filter = regex_filter("name", "ann")
+    assert doc_filter.apply([{"name": "bob"}]) == []
+    doc_filter.add_filter("bob")
+    assert doc_filter.apply([{"name": "bob"}]) == [{"name": "bob"}]
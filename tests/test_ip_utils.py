@@ -0,0 +1,125 @@
+import random
+
+import pytest
+
+from utils import ip_utils
+
+
+def test_parse_port_spec():
+    assert ip_utils.parse_port_spec("9200-9202,19200") == [9200, 9201, 9202, 19200]
+    assert ip_utils.parse_port_spec(9200) == [9200]
+    # Order is kept and duplicates dropped
+    assert ip_utils.parse_port_spec("9300, 9200-9201,9300,9200,") == [9300, 9200, 9201]
+
+
+@pytest.mark.parametrize("port_spec", ["", ",", "0", "65536", "9205-9200", "http", "1-2-3"])
+def test_parse_port_spec_rejects(port_spec):
+    with pytest.raises(ValueError):
+        ip_utils.parse_port_spec(port_spec)
+
+
+def test_iter_targets_interleaves_hosts():
+    ips = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    assert list(ip_utils.iter_targets(ips, [9200, 9201], block_size=2)) == [
+        ("10.0.0.1", 9200), ("10.0.0.2", 9200), ("10.0.0.1", 9201), ("10.0.0.2", 9201),
+        ("10.0.0.3", 9200), ("10.0.0.3", 9201),
+    ]
+
+
+def test_iter_targets_is_lazy():
+    def endless():
+        number = 0
+        while True:
+            yield f"10.0.{number >> 8 & 255}.{number & 255}"
+            number += 1
+
+    targets = ip_utils.iter_targets(endless(), [9200], block_size=4)
+    assert [next(targets) for _ in range(6)] == [(f"10.0.0.{n}", 9200) for n in range(6)]
+
+
+def test_parse_target():
+    assert ip_utils.parse_target("10.0.0.0/30") == (167772160, 167772163)
+    # Host bits of a CIDR range are ignored
+    assert ip_utils.parse_target(" 10.0.0.5/30\n") == (167772164, 167772167)
+    assert ip_utils.parse_target("10.0.0.1-10.0.0.3") == (167772161, 167772163)
+    assert ip_utils.parse_target("0.0.0.0/0") == (0, 0xffffffff)
+    assert ip_utils.parse_target("10.0.0.1") == (167772161, 167772161)
+
+
+@pytest.mark.parametrize("target", ["10.0.0.0/33", "10.0.0.0/x", "10.0.0.3-10.0.0.1",
+                                    "10.0.0.256", "example.com", "::1"])
+def test_parse_target_rejects(target):
+    with pytest.raises(ValueError):
+        ip_utils.parse_target(target)
+
+
+def test_iter_target_lines_skips_comments_and_names_bad_lines():
+    lines = ["# estate\n", "10.0.0.1\n", "\n", "10.0.0.0/31  # office\n"]
+    assert list(ip_utils.iter_target_lines(lines)) == [(167772161, 167772161),
+                                                        (167772160, 167772161)]
+    with pytest.raises(ValueError, match="estate.txt:2"):
+        list(ip_utils.iter_target_lines(["10.0.0.1", "10.0.0.x"], "estate.txt"))
+
+
+def test_interval_set_merges_overlapping_and_adjacent_ranges():
+    targets = ip_utils.IntervalSet.from_targets(
+        ["10.0.0.8/30", "10.0.0.1", "10.0.0.2-10.0.0.4", "10.0.0.5", "10.0.0.9", "10.0.1.0"])
+    assert list(targets.ranges()) == [("10.0.0.1", "10.0.0.5"), ("10.0.0.8", "10.0.0.11"),
+                                      ("10.0.1.0", "10.0.1.0")]
+    assert len(targets) == 10
+    assert list(targets)[:6] == ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4", "10.0.0.5",
+                                 "10.0.0.8"]
+
+
+def test_interval_set_merges_sorted_runs(monkeypatch):
+    monkeypatch.setattr(ip_utils, "RUN_SIZE", 3)
+    monkeypatch.setattr(ip_utils, "MAX_RUNS", 2)
+    shuffled = random.Random(7)
+    intervals = []
+    for _ in range(200):
+        start = shuffled.randrange(1000)
+        intervals.append((start, start + shuffled.randrange(5)))
+    targets = ip_utils.IntervalSet.from_intervals(intervals)
+    addresses = sorted({ip_int for start, end in intervals for ip_int in range(start, end + 1)})
+    assert len(targets) == len(addresses)
+    assert [ip_int for start, end in zip(targets.starts, targets.ends)
+            for ip_int in range(start, end + 1)] == addresses
+    # Merged ranges are neither overlapping nor adjacent
+    assert all(start > end + 1 for start, end in zip(targets.starts[1:], targets.ends))
+    assert len(ip_utils.IntervalSet.from_intervals([])) == 0
+
+
+def test_interval_set_of_the_whole_space():
+    everything = ip_utils.IntervalSet.from_targets(["0.0.0.0/0", "10.0.0.0/8"])
+    assert len(everything) == 2 ** 32
+    assert list(everything.ranges()) == [("0.0.0.0", "255.255.255.255")]
+
+
+def test_interval_set_subtraction():
+    targets = ip_utils.IntervalSet.from_targets(["10.0.0.0/28", "10.0.1.0/30"])
+    excluded = ip_utils.IntervalSet.from_targets(
+        ["9.0.0.0/8", "10.0.0.0", "10.0.0.4-10.0.0.5", "10.0.0.15-10.0.1.1"])
+    remaining = targets - excluded
+    assert list(remaining.ranges()) == [("10.0.0.1", "10.0.0.3"), ("10.0.0.6", "10.0.0.14"),
+                                        ("10.0.1.2", "10.0.1.3")]
+    assert len(remaining) == 14
+    assert set(remaining) == set(targets) - set(excluded - ip_utils.target_set("9.0.0.0/8"))
+    assert len(targets - targets) == 0
+    assert list(targets - ip_utils.IntervalSet()) == list(targets)
+
+
+def test_interval_set_chunks():
+    targets = ip_utils.IntervalSet.from_targets(["10.0.0.0/30", "10.0.1.0/29"])
+    chunks = list(targets.chunks(5))
+    assert [len(chunk) for chunk in chunks] == [5, 5, 2]
+    # A chunk may span ranges, and together the chunks are the set in order
+    assert list(chunks[0].ranges()) == [("10.0.0.0", "10.0.0.3"), ("10.0.1.0", "10.0.1.0")]
+    assert [ip for chunk in chunks for ip in chunk] == list(targets)
+    assert list(ip_utils.IntervalSet().chunks(5)) == []
+
+
+def test_target_set():
+    targets = ip_utils.IntervalSet.from_targets(["10.0.0.0/30"])
+    assert ip_utils.target_set(targets) is targets
+    assert list(ip_utils.target_set("10.0.0.0/31")) == ["10.0.0.0", "10.0.0.1"]
+    assert len(ip_utils.target_set(["10.0.0.1", "10.0.0.1"])) == 1
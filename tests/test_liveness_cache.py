@@ -0,0 +1,122 @@
+import pytest
+
+from utils import ip_utils
+from utils import liveness_cache
+from utils.liveness_cache import LivenessCache, parse_duration
+
+DAY = 86400
+
+
+def test_parse_duration():
+    assert parse_duration("90") == 90
+    assert parse_duration(90) == 90
+    assert parse_duration("30m") == 1800
+    assert parse_duration(" 12H ") == 12 * 3600
+    assert parse_duration("1.5d") == 1.5 * DAY
+    assert parse_duration("2w") == 14 * DAY
+    for duration in ("", "d", "-1d", "7y", "7 days"):
+        with pytest.raises(ValueError):
+            parse_duration(duration)
+
+
+def scanned_cache(path, now):
+    cache = LivenessCache(str(path), ttl=DAY)
+    cache.now = now
+    cache.record("10.0.0.1", 9200, True)
+    cache.record("10.0.0.2", 9200, False)
+    cache.record("10.0.0.2", 9201, False)
+    cache.record("10.0.0.3", 9200, True)
+    cache.save()
+    return cache
+
+
+def test_missing_cache_is_empty(tmp_path):
+    cache = LivenessCache(str(tmp_path / "none" / "liveness.bin"), ttl=DAY)
+    assert len(cache) == 0
+    assert cache.lookup("10.0.0.1", 9200) is None
+    assert not cache.skip("10.0.0.1", 9200)
+    # Nothing recorded, nothing written
+    cache.save()
+    assert not (tmp_path / "none").exists()
+
+
+def test_saved_results_are_read_back(tmp_path):
+    path = tmp_path / "cache" / "liveness.bin"
+    scanned_cache(path, 1000).close()
+    cache = LivenessCache(str(path), ttl=DAY)
+    assert len(cache) == 4
+    assert cache.lookup("10.0.0.1", 9200) == (1000, 0)
+    assert cache.lookup("10.0.0.2", 9201) == (0, 1000)
+    assert cache.lookup(ip_utils.ip_to_int("10.0.0.3"), 9200) == (1000, 0)
+    assert cache.lookup("10.0.0.3", 9201) is None
+    assert cache.lookup("10.0.0.4", 9200) is None
+    cache.close()
+
+
+def test_closed_targets_are_skipped_within_ttl(tmp_path):
+    cache = scanned_cache(tmp_path / "liveness.bin", 1000)
+    cache.now = 1000 + DAY - 1
+    assert cache.skip("10.0.0.2", 9200)
+    # Known open targets are scanned first, and not again in the full pass
+    assert cache.skip("10.0.0.1", 9200)
+    assert not cache.skip("10.0.0.4", 9200)
+    cache.now = 1000 + DAY
+    assert not cache.skip("10.0.0.2", 9200)
+    cache.close()
+
+
+def test_select(tmp_path):
+    cache = scanned_cache(tmp_path / "liveness.bin", 1000)
+    cache.now = 2000
+    targets = ip_utils.target_set("10.0.0.0/30")
+    assert cache.select(targets, [9200, 9201]) == ([("10.0.0.1", 9200), ("10.0.0.3", 9200)], 4)
+    assert cache.select(targets, [9201]) == ([], 1)
+    assert cache.select(ip_utils.target_set("10.0.0.3"), [9200]) == ([("10.0.0.3", 9200)], 1)
+    assert cache.select(ip_utils.target_set("10.1.0.0/16"), [9200]) == ([], 0)
+    cache.close()
+
+
+def test_later_scans_merge_into_the_cache(tmp_path):
+    path = tmp_path / "liveness.bin"
+    cache = scanned_cache(path, 1000)
+    cache.now = 5000
+    # A target closing keeps when it was last open, the latest result wins
+    cache.record("10.0.0.1", 9200, False)
+    cache.record("10.0.0.2", 9200, True)
+    cache.record("10.0.0.9", 9200, False)
+    cache.record("10.0.0.9", 9200, False)
+    cache.save()
+    assert len(cache) == 5
+    assert cache.lookup("10.0.0.1", 9200) == (1000, 5000)
+    assert not cache.is_known_open(*cache.lookup("10.0.0.1", 9200))
+    assert cache.is_known_open(*cache.lookup("10.0.0.2", 9200))
+    assert cache.lookup("10.0.0.2", 9201) == (0, 1000)
+    assert cache.lookup("10.0.0.9", 9200) == (0, 5000)
+    cache.close()
+    assert [entry.name for entry in tmp_path.iterdir()] == ["liveness.bin"]
+
+
+def test_damaged_cache_raises(tmp_path):
+    path = tmp_path / "liveness.bin"
+    scanned_cache(path, 1000).close()
+    with open(path, "ab") as cache_file:
+        cache_file.write(b"\0")
+    with pytest.raises(ValueError, match="damaged"):
+        LivenessCache(str(path), ttl=DAY)
+    path.write_bytes(b"not a liveness cache at all")
+    with pytest.raises(ValueError):
+        LivenessCache(str(path), ttl=DAY)
+
+
+def test_checkpoint_saves_past_the_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr(liveness_cache, "SAVE_THRESHOLD", 3)
+    path = tmp_path / "liveness.bin"
+    cache = LivenessCache(str(path), ttl=DAY)
+    cache.record("10.0.0.1", 9200, True)
+    cache.record("10.0.0.2", 9200, False)
+    cache.checkpoint()
+    assert not path.exists()
+    cache.record("10.0.0.3", 9200, False)
+    cache.checkpoint()
+    assert len(LivenessCache(str(path), ttl=DAY)) == 3
+    assert not cache.opened and not cache.closed
@@ -0,0 +1,77 @@
+from elastic_api import export, mapping
+
+PROPERTIES = {
+    "name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+    "address": {"properties": {
+        "city": {"type": "keyword"},
+        "geo": {"properties": {"lat": {"type": "float"}, "lon": {"type": "float"}}},
+    }},
+    "orders": {"type": "nested", "properties": {"sku": {"type": "keyword"}}},
+    "suggest": {"type": "completion"},
+    "tags": {"type": "keyword"},
+}
+
+
+def test_plan_columns_flattens_objects_and_nested_fields():
+    # Multi-fields and disallowed types are left out
+    assert mapping.plan_columns(PROPERTIES) == [
+        "name", "address.city", "address.geo.lat", "address.geo.lon", "orders.sku", "tags"]
+
+
+def test_mapping_properties_before_and_after_types():
+    typeless = {"users": {"mappings": {"properties": {"name": {"type": "text"}}}}}
+    typed = {"users": {"mappings": {"_doc": {"properties": {"name": {"type": "text"}}}}}}
+    assert mapping.mapping_properties(typeless, "users") == {"name": {"type": "text"}}
+    assert mapping.mapping_properties(typed, "users") == {"name": {"type": "text"}}
+
+
+def test_resolve_follows_objects_and_collects_across_arrays():
+    source = {"address": {"geo": {"lat": 1.5}},
+              "orders": [{"sku": "a"}, {"sku": ["b", "c"]}, {"other": 1}, "loose"]}
+    assert mapping.resolve(source, ("address", "geo", "lat")) == 1.5
+    assert mapping.resolve(source, ("orders", "sku")) == ["a", "b", "c"]
+    assert mapping.resolve(source, ("orders", "missing")) is None
+    assert mapping.resolve(source, ("address", "street", "number")) is None
+    # Paths can't go through a leaf
+    assert mapping.resolve(source, ("address", "geo", "lat", "deg")) is None
+
+
+def test_compile_accessor_formats_containers_as_json():
+    assert mapping.compile_accessor("tags")({"tags": ["a", "b"]}) == '["a","b"]'
+    assert mapping.compile_accessor("tags")({}) is None
+    assert mapping.compile_accessor("orders.sku")({"orders": [{"sku": "a"}, {"sku": "b"}]}) \
+        == '["a","b"]'
+    assert mapping.compile_accessor("address.city")({"address": {"city": "Oslo"}}) == "Oslo"
+    # Documents indexed with the dotted name as a plain key
+    assert mapping.compile_accessor("address.city")({"address.city": "Bergen"}) == "Bergen"
+    assert mapping.compile_accessor("address.city")({"address": None}) is None
+
+
+def test_flattening_plan_rows():
+    plan = mapping.FlatteningPlan(mapping.plan_columns(PROPERTIES))
+    sources = [
+        {"name": "ann", "address": {"city": "Oslo", "geo": {"lat": 59.9, "lon": 10.7}},
+         "orders": [{"sku": "a1"}], "tags": ["x"]},
+        {"name": "bob"},
+    ]
+    assert plan.rows(sources) == [
+        ["ann", "Oslo", 59.9, 10.7, '["a1"]', '["x"]'],
+        ["bob", None, None, None, None, None],
+    ]
+    assert plan.row(sources[1]) == plan.rows(sources)[1]
+
+
+def test_columns_from_source_without_a_mapping():
+    source = {"name": "ann", "address": {"city": "Oslo", "geo": {"lat": 1}},
+              "empty": {}, "tags": ["x"]}
+    assert mapping.columns_from_source(source) == [
+        "name", "address.city", "address.geo.lat", "empty", "tags"]
+
+
+def test_csv_sink_takes_its_columns_from_the_first_document():
+    sink = export.CsvSink()
+    rows = sink.encode([{"name": "ann", "address": {"city": "Oslo"}},
+                        {"name": "bob", "extra": 1}])
+    assert sink.plan.columns == ["name", "address.city"]
+    # Fields the first document lacks are not exported
+    assert rows == [["ann", "Oslo"], ["bob", None]]
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from utils import memory_budget
+from utils.memory_budget import ByteGate, MemoryBudget
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def no_rss(monkeypatch):
+    # Only the estimates apply, whatever the memory of the test process
+    monkeypatch.setattr(memory_budget, "rss_bytes", lambda: None)
+
+
+def test_byte_gate_admits_within_capacity():
+    async def run():
+        gate = ByteGate(100)
+        await gate.acquire(60)
+        await gate.acquire(40)
+        waiting = asyncio.ensure_future(gate.acquire(10))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        gate.release(60)
+        await asyncio.wait_for(waiting, 1)
+        return gate.in_flight
+
+    assert asyncio.run(run()) == 50
+
+
+def test_byte_gate_admits_oversized_work_alone():
+    async def run():
+        gate = ByteGate(100)
+        await gate.acquire(500)
+        waiting = asyncio.ensure_future(gate.acquire(1))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        gate.release(500)
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_is_forgotten():
+    async def run():
+        gate = ByteGate(100)
+        await gate.acquire(100)
+        waiting = asyncio.ensure_future(gate.acquire(10))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert not gate.waiters
+        gate.release(100)
+        assert gate.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_limits_follow_the_budget():
+    small, large = MemoryBudget(64 * MB), MemoryBudget(64 * 1024 * MB)
+    assert small.pages.capacity == 32 * MB
+    assert memory_budget.MIN_PROBES <= small.probe_limit < large.probe_limit
+    assert small.connect_limit < large.connect_limit
+    # A tiny budget still probes and connects
+    tiny = MemoryBudget(1024)
+    assert tiny.probe_limit == memory_budget.MIN_PROBES
+    assert tiny.connect_limit == memory_budget.MIN_CONNECTS
+    assert MemoryBudget(1 << 50).probe_limit == memory_budget.MAX_PROBES
+
+
+def test_observe_page_corrects_the_hit_estimate():
+    budget = MemoryBudget(64 * MB)
+    assert budget.hit_bytes == memory_budget.HIT_BYTES
+    budget.observe_page(0, 0)
+    assert budget.pages_observed == 0
+    # The first page replaces the guess, later ones are averaged in
+    budget.observe_page(100 * 250, 100)
+    assert budget.hit_bytes == 250 * memory_budget.DECODED_RATIO
+    budget.observe_page(100 * 50, 100)
+    assert budget.hit_bytes == int(1000 * 0.75 + 200 * 0.25)
+    assert budget.pages_observed == 2
+
+
+def test_page_size_shrinks_pages_that_dont_fit():
+    budget = MemoryBudget(8 * MB)
+    budget.hit_bytes = 4096
+    assert budget.page_size(500) == 500
+    assert budget.page_size(10000) == 4 * MB // 4096
+    budget.hit_bytes = 1 << 30
+    assert budget.page_size(10000) == memory_budget.MIN_PAGE_SIZE
+    # Never larger than asked for
+    assert budget.page_size(10) == 10
+
+
+def test_pages_wait_for_room():
+    async def run():
+        budget = MemoryBudget(2 * MB)
+        budget.hit_bytes = 1024
+        first = await budget.acquire_page(1000)
+        assert first == 1000 * 1024
+        waiting = asyncio.ensure_future(budget.acquire_page(100))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        budget.release_page(first)
+        budget.release_page(await asyncio.wait_for(waiting, 1))
+        return budget.pages.in_flight
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from elastic_api import passthrough
+
+SOURCES = [
+    {"name": "plain", "age": 30},
+    {"text": "braces } ] { [ and \"quotes\" and \\ backslashes", "empty": {}},
+    {"unicode": "żółć ☃", "escaped": "é\n\t"},
+    {"deep": {"a": {"b": {"c": {"d": {"e": [1, {"f": None}]}}}}}},
+    {"list": [[1, 2], [], [{"x": True}]], "number": -1.5e10},
+    {},
+]
+
+
+def search_body(sources, total={"value": 6, "relation": "eq"}, scroll_id="scroll==",
+                pit_id=None, extra_hit_fields=False):
+    """A search response, with the sources serialized the way the database might"""
+    hits = []
+    for number, source in enumerate(sources):
+        hit = {"_index": "users", "_id": str(number), "_score": None, "_source": source,
+               "sort": [number, f"tie-{number}"]}
+        if extra_hit_fields:
+            # Objects around the source take the tokenizer instead of the fast path
+            hit = {"highlight": {"name": ["<em>x</em>"]}, **hit, "fields": {"n": [number]}}
+        hits.append(hit)
+    response = {"took": 3, "timed_out": False, "_shards": {"total": 1, "failed": 0},
+                "hits": {"total": total, "max_score": None, "hits": hits}}
+    if scroll_id is not None:
+        response = {"_scroll_id": scroll_id, **response}
+    if pit_id is not None:
+        response["pit_id"] = pit_id
+    return json.dumps(response, ensure_ascii=False, indent=1).encode("utf8")
+
+
+def stream(body, chunk_size):
+    written = []
+    source_stream = passthrough.SourceStream(
+        lambda sources: written.extend(bytes(source) for source in sources))
+    for start in range(0, len(body), chunk_size):
+        source_stream.feed(body[start:start + chunk_size])
+    return written, source_stream.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 17, 64, 1 << 16])
+@pytest.mark.parametrize("extra_hit_fields", [False, True])
+def test_sources_are_copied_byte_for_byte(chunk_size, extra_hit_fields):
+    body = search_body(SOURCES, extra_hit_fields=extra_hit_fields)
+    written, page = stream(body, chunk_size)
+    assert [json.loads(source) for source in written] == SOURCES
+    # Exactly the bytes of the response, whitespace included
+    for source in written:
+        assert source in body
+    assert page.hit_count == len(SOURCES)
+    assert page.total_hits == 6
+    assert page.scroll_id == "scroll=="
+    assert page.last_sort == [5, "tie-5"]
+
+
+def test_envelope_values():
+    _, page = stream(search_body(SOURCES[:2], total=42, scroll_id=None, pit_id="pit"), 5)
+    assert page.total_hits == 42
+    assert page.scroll_id is None
+    assert page.pit_id == "pit"
+    assert page.last_sort == [1, "tie-1"]
+
+
+def test_empty_page():
+    written, page = stream(search_body([], total={"value": 0}), 8)
+    assert written == []
+    assert page.hit_count == 0
+    assert page.last_sort is None
+
+
+def test_truncated_response_raises():
+    body = search_body(SOURCES)
+    with pytest.raises(ValueError):
+        stream(body[:len(body) // 2], 64)
+
+
+def test_response_without_hits_raises():
+    with pytest.raises(ValueError):
+        stream(json.dumps({"error": {"type": "search_phase_execution_exception"}}).encode(), 64)
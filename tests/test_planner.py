@@ -0,0 +1,98 @@
+import shutil
+import threading
+
+import pytest
+
+from elastic_api import planner
+from elastic_api.core import ElasticIndex, IndexStats
+
+# 100kb disk with 10kb free, of which the 2% headroom keeps 2kb
+DISK = shutil._ntuple_diskusage(total=100_000, used=90_000, free=10_000)
+
+
+@pytest.fixture(autouse=True)
+def disk(monkeypatch):
+    monkeypatch.setattr(planner, "_reserved", {})
+    monkeypatch.setattr(planner.shutil, "disk_usage", lambda path: DISK)
+
+
+def index(name, size):
+    return ElasticIndex(index=name, docs_count="1", pri_store_size=str(size))
+
+
+def plan(tmp_path, *sizes, policy="trim", reserve=True):
+    indices = [index(f"index-{number}", size) for number, size in enumerate(sizes)]
+    return planner.plan_downloads(indices, str(tmp_path), "csv", policy=policy, reserve=reserve)
+
+
+def names(download_plan):
+    return [Index.index for Index in download_plan.selected]
+
+
+def test_headroom_is_kept_free(tmp_path):
+    download_plan = plan(tmp_path, 8_000)
+    assert download_plan.free_bytes == 8_000
+    assert download_plan.fits
+    assert plan(tmp_path, 1, reserve=False).free_bytes == 0
+
+
+def test_trim_skips_what_doesnt_fit(tmp_path):
+    download_plan = plan(tmp_path, 5_000, 4_000, 3_000)
+    assert not download_plan.fits
+    # Later indices that still fit are kept
+    assert names(download_plan) == ["index-0", "index-2"]
+    assert download_plan.output_bytes == 8_000
+
+
+def test_refuse_calls_off_the_whole_download(tmp_path):
+    download_plan = plan(tmp_path, 5_000, 4_000, policy="refuse")
+    assert not download_plan.fits
+    assert download_plan.selected == []
+    assert planner._reserved[download_plan.device] == 0
+
+
+def test_ignore_downloads_everything(tmp_path):
+    download_plan = plan(tmp_path, 5_000, 4_000, policy="ignore")
+    assert download_plan.output_bytes > download_plan.free_bytes
+    assert names(download_plan) == ["index-0", "index-1"]
+
+
+def test_unknown_policy(tmp_path):
+    with pytest.raises(ValueError):
+        plan(tmp_path, 1, policy="hope")
+
+
+def test_exact_sizes_from_stats_come_first(tmp_path):
+    Index = index("users", "9kb")
+    Index.stats = IndexStats(docs=1, pri_store_bytes=7_000, store_bytes=14_000)
+    download_plan = planner.plan_downloads([Index], str(tmp_path), "json")
+    assert download_plan.entries[0].store_bytes == 7_000
+    assert download_plan.entries[0].output_bytes == int(7_000 * 1.2)
+
+
+def test_plans_reserve_against_each_other_until_released(tmp_path):
+    first = plan(tmp_path, 5_000)
+    assert planner._reserved[first.device] == 5_000
+    second = plan(tmp_path, 5_000, 3_000)
+    assert second.free_bytes == 3_000
+    assert names(second) == ["index-1"]
+    first.release()
+    second.release()
+    assert planner._reserved[first.device] == 0
+    assert plan(tmp_path, 5_000, 3_000).fits
+
+
+def test_concurrent_plans_dont_count_on_the_same_space(tmp_path):
+    barrier = threading.Barrier(2)
+    plans = []
+
+    def run():
+        barrier.wait()
+        plans.append(plan(tmp_path, 6_000))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(download_plan.fits for download_plan in plans) == [False, True]
@@ -0,0 +1,79 @@
+from elastic_api import profile
+from elastic_api.profile import ProfileField
+
+PROPERTIES = {
+    "name": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+    "bio": {"type": "text"},
+    "age": {"type": "integer"},
+    "address": {"properties": {"city": {"type": "keyword"}}},
+    "tags": {"type": "nested", "properties": {"label": {"type": "keyword"}}},
+    "photo": {"type": "binary"},
+    "created": {"type": "date"},
+}
+
+FIELDS = [
+    ProfileField("name", "text", "name.raw"),
+    ProfileField("bio", "text", None),
+    ProfileField("age", "integer", "age"),
+    ProfileField("address.city", "keyword", "address.city"),
+    ProfileField("created", "date", "created"),
+]
+
+
+def test_profile_fields():
+    assert profile.profile_fields(PROPERTIES) == FIELDS
+
+
+def test_profile_requests_batch_fields():
+    requests = profile.profile_requests("users", FIELDS, query={"term": {"a": 1}}, batch_size=2)
+    assert len(requests) == 3
+    assert all(request.path == "/users/_search" for request in requests)
+    first = requests[0].body
+    assert first["size"] == 0
+    assert first["query"] == {"term": {"a": 1}}
+    assert set(first["aggs"]) == {"docs", "f0_missing", "f0_cardinality", "f0_top",
+                                  "f1_missing"}
+    assert first["aggs"]["f0_top"]["terms"]["field"] == "name.raw"
+    assert set(requests[1].body["aggs"]) == {
+        "docs", "f0_missing", "f0_cardinality", "f0_min", "f0_max",
+        "f1_missing", "f1_cardinality", "f1_top"}
+    # An index without fields still gets its documents counted
+    assert len(profile.profile_requests("empty", [])) == 1
+
+
+def test_parse_profile():
+    responses = [
+        {"aggregations": {
+            "docs": {"doc_count": 10},
+            "f0_missing": {"doc_count": 1},
+            "f0_cardinality": {"value": 7},
+            "f0_top": {"buckets": [{"key": "ann", "doc_count": 3}]},
+            "f1_missing": {"doc_count": 4},
+        }},
+        {"aggregations": {
+            "docs": {"doc_count": 10},
+            "f0_missing": {"doc_count": 0},
+            "f0_cardinality": {"value": 50},
+            "f0_min": {"value": 18.0},
+            "f0_max": {"value": 90.0},
+            "f1_missing": {"doc_count": 2},
+            "f1_cardinality": {"value": 3},
+            "f1_top": {"buckets": [{"key": 1, "key_as_string": "true", "doc_count": 8}]},
+        }},
+        {"aggregations": {
+            "docs": {"doc_count": 10},
+            "f0_min": {"value": 0, "value_as_string": "2020-01-01"},
+            "f0_max": None,
+        }},
+    ]
+    total_docs, stats = profile.parse_profile(FIELDS, responses, batch_size=2)
+    assert total_docs == 10
+    assert stats["name"] == {"type": "text", "agg_field": "name.raw", "missing": 1,
+                             "cardinality": 7, "top": [["ann", 3]]}
+    assert stats["bio"] == {"type": "text", "agg_field": None, "missing": 4}
+    assert stats["age"] == {"type": "integer", "missing": 0, "cardinality": 50,
+                            "min": 18.0, "max": 90.0}
+    assert stats["address.city"]["top"] == [["true", 8]]
+    # Aggregations a version doesn't return are left unknown
+    assert stats["created"] == {"type": "date", "missing": None, "cardinality": None,
+                                "min": "2020-01-01", "max": None}
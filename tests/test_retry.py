@@ -0,0 +1,206 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from elastic_api import core, retry
+from elastic_api.async_elastic_api import ElasticAPI, CONNECTION_ERRORS, TIMEOUT_ERRORS
+
+# Retries without waiting
+INSTANT = retry.RetryPolicy(attempts=3, base_delay=0, max_delay=0)
+
+
+@pytest.mark.parametrize("status", [200, 201, 204, 304])
+def test_check_status_passes_success(status):
+    retry.check_status(status)
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_check_status_raises_retryable(status):
+    with pytest.raises(retry.ResponseError) as raised:
+        retry.check_status(status)
+    assert raised.value.status == status
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404, 501, 505])
+def test_check_status_raises_fatal(status):
+    with pytest.raises(retry.StatusError) as raised:
+        retry.check_status(status)
+    assert not isinstance(raised.value, retry.ResponseError)
+    assert retry.classify(raised.value) == retry.FATAL
+
+
+def test_check_status_reads_retry_after():
+    with pytest.raises(retry.ResponseError) as raised:
+        retry.check_status(429, {"Retry-After": "7"})
+    assert raised.value.retry_after == 7.0
+    with pytest.raises(retry.ResponseError) as raised:
+        retry.check_status(503, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    assert raised.value.retry_after is None
+
+
+def test_classify():
+    assert retry.classify(retry.ResponseError(429)) == retry.THROTTLED
+    assert retry.classify(retry.ResponseError(500)) == retry.SERVER
+    assert retry.classify(asyncio.TimeoutError(), TIMEOUT_ERRORS, CONNECTION_ERRORS) == retry.TIMEOUT
+    assert retry.classify(aiohttp.ClientConnectionError(), TIMEOUT_ERRORS,
+                          CONNECTION_ERRORS) == retry.CONNECTION
+    assert retry.classify(KeyError("hits")) == retry.FATAL
+
+
+def test_delay_is_jittered_within_backoff():
+    policy = retry.RetryPolicy(attempts=8, base_delay=0.5, max_delay=4.0)
+    for failures in range(1, 8):
+        backoff = min(4.0, 0.5 * 2 ** (failures - 1))
+        assert all(0 <= policy.delay(failures) <= backoff for _ in range(50))
+    assert policy.delay(1, retry_after=3) >= 3
+    assert policy.delay(1, retry_after=60) <= 4.0
+
+
+def test_attempts_raise_fatal_at_once():
+    attempts = retry.Attempts(INSTANT, "http://fatal.test")
+    error = retry.StatusError(404)
+    with pytest.raises(retry.StatusError):
+        attempts.failed(error)
+    assert attempts.failures == 1
+
+
+def test_attempts_give_up_after_policy():
+    attempts = retry.Attempts(INSTANT, "http://flaky.test")
+    assert attempts.failed(retry.ResponseError(500)) == 0
+    assert attempts.failed(retry.ResponseError(500)) == 0
+    with pytest.raises(retry.ResponseError):
+        attempts.failed(retry.ResponseError(500))
+
+
+def serve(statuses):
+    """Run `send_search` against a server answering with `statuses` in turn
+
+    Returns:
+        tuple: what `send_search` returned or raised, and the requests served
+    """
+    served = []
+
+    async def handler(request):
+        status = statuses[min(len(served), len(statuses) - 1)]
+        served.append(status)
+        return web.json_response({"error": "x"} if status >= 400 else {"hits": {}},
+                                 status=status)
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                request = core.SearchRequest("POST", "/users/_search", None, {})
+                try:
+                    return await ElasticAPI.send_search(session, f"http://127.0.0.1:{port}",
+                                                        request, 5, INSTANT), served
+                except Exception as ex:
+                    return ex, served
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_send_search_retries_server_errors():
+    result, served = serve([500, 503, 200])
+    assert result == {"hits": {}}
+    assert served == [500, 503, 200]
+
+
+def test_send_search_raises_error_statuses():
+    result, served = serve([404])
+    assert isinstance(result, retry.StatusError)
+    assert result.status == 404
+    assert served == [404]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def open_breaker(clock):
+    breaker = retry.CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    assert breaker.is_open
+    with pytest.raises(retry.HostUnavailable):
+        breaker.check()
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now = 10
+    assert breaker.is_half_open
+    breaker.check()
+    for _ in range(5):
+        with pytest.raises(retry.HostUnavailable):
+            breaker.check()
+
+
+def test_successful_trial_closes_breaker():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now = 10
+    breaker.check()
+    breaker.record_success()
+    breaker.check()
+    breaker.check()
+    assert not breaker.is_open and not breaker.is_half_open
+
+
+def test_failed_trial_opens_breaker_again():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now = 10
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.is_open
+    clock.now = 19
+    with pytest.raises(retry.HostUnavailable):
+        breaker.check()
+    clock.now = 20
+    breaker.check()
+
+
+def test_lost_trial_is_replaced():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now = 10
+    breaker.check()
+    clock.now = 15
+    with pytest.raises(retry.HostUnavailable):
+        breaker.check()
+    clock.now = 20
+    breaker.check()
+
+
+def test_error_status_settles_trial():
+    attempts = retry.Attempts(INSTANT, "http://trial.test")
+    clock = FakeClock()
+    attempts.breaker = open_breaker(clock)
+    clock.now = 10
+    attempts.check()
+    with pytest.raises(retry.StatusError):
+        attempts.failed(retry.StatusError(404))
+    attempts.check()
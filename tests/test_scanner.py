@@ -0,0 +1,59 @@
+import socket
+
+from utils.scanner import Scanner, TimerWheel
+
+
+def test_timer_expires_at_its_deadline():
+    wheel = TimerWheel(timeout=1, tick=0.25)
+    start = wheel.last_tick
+    wheel.schedule("a", ("10.0.0.1", 9200), now=start)
+    assert len(wheel) == 1
+    assert wheel.advance(start + 0.9) == []
+    assert wheel.advance(start + 1.01) == [("a", ("10.0.0.1", 9200))]
+    assert len(wheel) == 0
+    assert wheel.advance(start + 3) == []
+
+
+def test_cancelled_timer_never_expires():
+    wheel = TimerWheel(timeout=1, tick=0.25)
+    start = wheel.last_tick
+    wheel.schedule("a", 1, now=start)
+    wheel.schedule("b", 2, now=start)
+    wheel.cancel("a")
+    # Unknown keys are ignored
+    wheel.cancel("c")
+    assert len(wheel) == 1
+    assert wheel.advance(start + 1.01) == [("b", 2)]
+
+
+def test_timer_scheduled_while_the_wheel_lags_keeps_its_deadline():
+    wheel = TimerWheel(timeout=1, tick=0.25)
+    start = wheel.last_tick
+    # The wheel hasn't been advanced for 5 seconds when the connect starts
+    wheel.schedule("late", 1, now=start + 5)
+    wheel.schedule("early", 2, now=start)
+    assert wheel.advance(start + 1.01) == [("early", 2)]
+    assert wheel.advance(start + 5.9) == []
+    assert wheel.advance(start + 6.01) == [("late", 1)]
+    assert len(wheel) == 0
+
+
+def test_iter_scan_finds_a_listening_port():
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        port = server.getsockname()[1]
+        scanner = Scanner("127.0.0.1", port, timeout=2, threads=1)
+        assert list(scanner.iter_scan()) == [("127.0.0.1", port)]
+    assert scanner.potential_dbs == [f"http://127.0.0.1:{port}"]
+    assert scanner.scanned == 1
+
+
+def test_iter_scan_skips_a_closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    scanner = Scanner("127.0.0.1", port, timeout=2, threads=1)
+    assert list(scanner.iter_scan()) == []
+    assert scanner.potential_dbs == []
+    assert scanner.scanned == 1
@@ -0,0 +1,45 @@
+# Startup Benchmark
+"""Keep the CLI from loading heavy modules before a command needs them.
+
+The CLI is run thousands of times from cron and orchestration jobs, so
+`--help` and a probe that finds nothing must not pay for aiohttp, tqdm
+and friends. Modules loaded through `cli_helper.lazy_import` don't show
+up in `-X importtime` themselves when they are finally executed, but the
+modules they import do, so packages are checked by their top-level name.
+
+Which modules get loaded is what decides the startup time, and unlike a
+wall-clock limit it doesn't depend on how loaded the machine is.
+"""
+import os
+import re
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r"import time:\s+\d+ \|\s+\d+ \|\s+(\S+)")
+HEAVY_PACKAGES = {"asyncio", "aiohttp", "tqdm", "prettytable"}
+
+
+def import_profile(*cli_args):
+    """Run the CLI with `-X importtime`
+
+    Returns:
+        set: the top-level packages it imported
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "elastichunt.py",
+                             "--no-banner", *cli_args],
+                            cwd=REPO_ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return {match.group(1).split(".")[0] for match in IMPORT_LINE.finditer(result.stderr)}
+
+
+def test_help_skips_heavy_imports():
+    assert not import_profile("--help") & HEAVY_PACKAGES
+
+
+def test_probe_of_closed_host_skips_api_imports():
+    # The scan itself needs the event loop and its progress bar, the Elastic
+    # API is only loaded once a host answers
+    packages = import_profile("127.0.0.1", "-p", "1", "-t", "1")
+    assert "asyncio" in packages
+    assert not packages & {"aiohttp", "prettytable"}
@@ -0,0 +1,37 @@
+from elastic_api import timeouts
+from elastic_api.timeouts import METADATA, PROBE, SEARCH, Timeouts
+
+
+def test_defaults_before_any_round_trip():
+    assert Timeouts().settings(PROBE) == (1.0, 2.0, 5.0)
+    assert Timeouts().settings(METADATA) == (1.0, 10.0, 31.0)
+    # Pages aren't capped as a whole
+    assert Timeouts().settings(SEARCH) == (1.0, 60.0, None)
+
+
+def test_limits_scale_with_round_trip_time_within_bounds():
+    nearby, far = Timeouts(rtt=0.001), Timeouts(rtt=0.5)
+    assert nearby.settings(PROBE).connect == timeouts.MIN_CONNECT
+    assert nearby.settings(PROBE).read == 1.0
+    assert far.settings(PROBE) == (2.0, 4.0, 10.0)
+    assert far.settings(METADATA).read == 20.0
+    slow = Timeouts(rtt=60)
+    assert slow.settings(PROBE) == (timeouts.MAX_CONNECT, 10.0, 30.0)
+    assert slow.settings(SEARCH).read == 300.0
+
+
+def test_fixed_connect_is_the_least_any_read_gets():
+    fixed = Timeouts(connect=3, rtt=0.001)
+    assert fixed.settings(PROBE) == (3, 3, 9)
+    assert fixed.settings(SEARCH).connect == 3
+
+
+def test_observe_keeps_the_slowest_round_trip():
+    host = Timeouts()
+    host.observe(None)
+    assert host.rtt is None
+    host.observe(0.2)
+    host.observe(0.05)
+    assert host.rtt == 0.2
+    host.observe(0.3)
+    assert host.rtt == 0.3
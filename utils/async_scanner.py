@@ -1,10 +1,11 @@
 import socket
 import logging
 import asyncio
+import time
 
 import tqdm
 
-from utils.ip_utils import ip_range_to_list, split_ip_list_into_subnets
+from utils.ip_utils import iter_targets, parse_port_spec, target_set
 
 logger = logging.getLogger('AsyncScanner')
 logging.basicConfig(level=logging.INFO)
@@ -12,65 +13,150 @@ logging.basicConfig(level=logging.INFO)
 class AsyncScanner:
     """AsyncScanner Class.
     This class is used to create an asynchronous scanner.
+
+    Every (ip, port) target is fed lazily to a single connect engine of
+    `num_workers * max_hosts_per_subnet` concurrent connects. Ports are
+    interleaved over blocks of `max_subnets * max_hosts_per_subnet` hosts,
+    so consecutive connects go to different hosts.
+
+    With a `liveness_cache.LivenessCache`, targets that were open on the
+    last scan are connected to first, and targets that were closed within
+    the cache's TTL are skipped. Every result is recorded in the cache and
+    checkpointed after the scan, the owner of the cache saves it once every
+    scan is done.
+
+    With a `memory_budget.MemoryBudget`, the connects in flight are also
+    capped by the budget's `connect_limit`.
     """
 
     SOCKET_FAMILY = socket.AF_INET
     SOCKET_KIND = socket.SOCK_STREAM
-
-    def __init__(self, ipaddr, port, timeout=1, num_workers=4, max_subnets=16, max_hosts_per_subnet=256):
-        self.ipaddr = ip_range_to_list(ipaddr)
-        self.port = port
+    PROGRESS_INTERVAL = 0.5
+    # Weight of the newest sample in the smoothed connect rate
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self, ipaddr, port, timeout=1, num_workers=4, max_subnets=16, max_hosts_per_subnet=256,
+                 cache=None, memory_budget=None):
+        # An ip_utils.IntervalSet, so addresses are only expanded as they are scanned
+        self.ipaddr = target_set(ipaddr)
+        # A single port, a list of ports, or a port spec like "9200-9205,19200"
+        self.ports = port if isinstance(port, list) else parse_port_spec(port)
+        self.port = self.ports[0]
         self.timeout = timeout
         self.num_workers = num_workers
         self.max_subnets = max_subnets
         self.max_hosts_per_subnet = max_hosts_per_subnet
-        
-        self.potential_dbs = []
+        self.cache = cache
+        self.memory_budget = memory_budget
 
-    async def scan_ip(self, ip, progress_queue):
+        self.potential_dbs = []
+        # Connect time of every open target, an estimate of its round trip time
+        self.connect_rtts = {}
+        # Progress counters, sampled by the progress ticker
+        self.scanned = 0
+        # Targets left out because the cache has them closed
+        self.skipped = 0
+
+    async def scan_ip(self, ip, port=None):
+        port = self.port if port is None else port
         scanning_socket = socket.socket(AsyncScanner.SOCKET_FAMILY, AsyncScanner.SOCKET_KIND)
-        scanning_socket.settimeout(self.timeout)
+        scanning_socket.setblocking(False)
 
         try:
-            await asyncio.get_running_loop().sock_connect(scanning_socket, (str(ip), self.port))
-            self.potential_dbs.append(f"http://{ip}:{self.port}")
-        except:
-            pass
+            started = time.monotonic()
+            await asyncio.wait_for(
+                asyncio.get_running_loop().sock_connect(scanning_socket, (str(ip), port)),
+                self.timeout)
+            self.potential_dbs.append(f"http://{ip}:{port}")
+            self.connect_rtts[f"http://{ip}:{port}"] = time.monotonic() - started
+            if self.cache is not None:
+                self.cache.record(ip, port, True)
+        except (OSError, asyncio.TimeoutError):
+            if self.cache is not None:
+                self.cache.record(ip, port, False)
         finally:
             scanning_socket.close()
-            await progress_queue.put(ip)
-
-    async def scan_subnet(self, subnet, progress_queue):
-        tasks = [self.scan_ip(ip, progress_queue) for ip in subnet]
-        await asyncio.gather(*tasks)
+            self.scanned += 1
+
+    async def scan_worker(self, targets):
+        """Connect to targets from the shared iterator until it runs dry"""
+        for ip, port in targets:
+            await self.scan_ip(ip, port)
+
+    def update_progress(self, pbar, num_targets, rate):
+        """Bring the progress bar up to date with the scan counters
+
+        Args:
+            pbar (tqdm.tqdm): progress bar
+            num_targets (int): total number of targets
+            rate (float): smoothed connects per second
+        """
+        pbar.update(self.scanned - pbar.n)
+        remaining = num_targets - self.scanned
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate else '--:--:--'
+        pbar.set_postfix_str(f'{rate:.0f} connects/s, ETA {eta}, {len(self.potential_dbs)} open',
+                             refresh=False)
+        pbar.refresh()
+
+    async def progress_ticker(self, pbar, num_targets):
+        """Periodically sample the scan counters into the progress bar
+
+        Args:
+            pbar (tqdm.tqdm): progress bar
+            num_targets (int): total number of targets
+        """
+        rate = 0.0
+        last_scanned = self.scanned
+        last_tick = time.monotonic()
+        while True:
+            await asyncio.sleep(AsyncScanner.PROGRESS_INTERVAL)
+            now = time.monotonic()
+            sample = (self.scanned - last_scanned) / (now - last_tick)
+            rate = sample if not rate else (AsyncScanner.RATE_SMOOTHING * sample
+                                            + (1 - AsyncScanner.RATE_SMOOTHING) * rate)
+            last_scanned, last_tick = self.scanned, now
+            self.update_progress(pbar, num_targets, rate)
+
+    def iter_cached_targets(self, known_open, targets):
+        """Known open targets first, then the full pass without the ones the cache skips"""
+        yield from known_open
+        for ip, port in targets:
+            if not self.cache.skip(ip, port):
+                yield ip, port
+
+    def prepare_targets(self):
+        """The (ip, port) targets to scan and their number"""
+        targets = iter_targets(self.ipaddr, self.ports,
+                               block_size=self.max_subnets * self.max_hosts_per_subnet)
+        num_targets = len(self.ipaddr) * len(self.ports)
+        if self.cache is None:
+            return targets, num_targets
+        known_open, skipped = self.cache.select(self.ipaddr, self.ports)
+        self.skipped = skipped - len(known_open)
+        if skipped:
+            tqdm.tqdm.write(f"Liveness cache: scanning {len(known_open)} known open targets first, "
+                            f"skipping {self.skipped} recently closed")
+        return self.iter_cached_targets(known_open, targets), num_targets - self.skipped
 
     async def run_scan(self):
-        progress_queue = asyncio.Queue()
-        num_targets = len(self.ipaddr)
+        targets, num_targets = self.prepare_targets()
         pbar = tqdm.tqdm(total=num_targets, position=0, desc='Scanning IPs', unit='ip', dynamic_ncols=True)
-        progress_message = 'Scanned {} out of {} IPs'
-
-        if len(self.ipaddr) == 1:
-            async with asyncio.Semaphore(self.num_workers):
-                tasks = [self.scan_subnet(self.ipaddr, progress_queue)]
-                await asyncio.gather(*tasks)
-
-        if len(self.ipaddr) >= self.max_subnets:
-            subnets = split_ip_list_into_subnets(self.ipaddr, self.max_subnets)
-
-            async with asyncio.Semaphore(self.num_workers):
-                tasks = [self.scan_subnet(subnet, progress_queue) for subnet in subnets]
-                await asyncio.gather(*tasks)
-
-        elif len(self.ipaddr) <= self.max_subnets:
-            async with asyncio.Semaphore(self.num_workers):
-                tasks = [self.scan_subnet(subnet, progress_queue) for subnet in self.ipaddr]
-                await asyncio.gather(*tasks)
+        started = time.monotonic()
+        ticker = asyncio.create_task(self.progress_ticker(pbar, num_targets))
+        try:
+            await self.scan_targets(targets, num_targets)
+        finally:
+            ticker.cancel()
+            if self.cache is not None:
+                self.cache.checkpoint()
 
         # Print final progress message
-        while not progress_queue.empty():
-            ip = await progress_queue.get()
-            pbar.update(1)
-            pbar.set_description(progress_message.format(pbar.n, num_targets))
-
-        pbar.close()
\ No newline at end of file
+        elapsed = time.monotonic() - started
+        self.update_progress(pbar, num_targets, self.scanned / elapsed if elapsed else 0.0)
+        pbar.close()
+
+    async def scan_targets(self, targets, num_targets):
+        num_connects = min(self.num_workers * self.max_hosts_per_subnet, num_targets)
+        if self.memory_budget is not None:
+            num_connects = min(num_connects, self.memory_budget.connect_limit)
+        await asyncio.gather(*[self.scan_worker(targets) for _ in range(num_connects)])
@@ -1,6 +1,6 @@
-import colorama
-from colorama import Fore, Style
-import os
+import importlib.util
+import shutil
+import sys
 
 banner = """
                                       ____    _     __     _    ____
@@ -23,15 +23,38 @@ banner = """
 +========================================================================================+
 """
 
+def lazy_import(name):
+  """Import a module on first attribute access instead of right away.
+
+  Keeps the CLI from paying for aiohttp, tqdm and friends on runs that
+  never touch them (e.g. `--help`).
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  spec = importlib.util.find_spec(name)
+  loader = importlib.util.LazyLoader(spec.loader)
+  spec.loader = loader
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  loader.exec_module(module)
+  return module
+
 def print_banner():
-  if os.name == 'nt':
+  # Nothing to draw on when the output is piped or redirected (cron, CI, ...)
+  if not sys.stdout.isatty():
+    return
+
+  import colorama
+  from colorama import Fore, Style
+
+  if sys.platform == 'win32':
     colorama.init()
 
-  rows, columns = os.get_terminal_size()
+  columns, rows = shutil.get_terminal_size()
   print(Fore.LIGHTRED_EX + Style.BRIGHT + f"{banner:^{columns}}")
 
   # move the cursor to the second row
   print(Fore.RESET + Style.RESET_ALL + f"\033[{rows - 1};0H")
 
-  if os.name == 'nt':
+  if sys.platform == 'win32':
     colorama.deinit()
@@ -1,4 +1,15 @@
+import heapq
 import ipaddress
+import itertools
+import socket
+import struct
+import sys
+from array import array
+
+# Ranges `IntervalSet.from_intervals` sorts at once, larger inputs are merged run by run
+RUN_SIZE = 1 << 16
+# Sorted runs kept before they are merged into one
+MAX_RUNS = 16
 
 def dashed_ip_range_to_list(ipaddr):
     """Convert IP Address or IP Address range to list
@@ -104,4 +115,285 @@ def split_subnet_into_subnets(ip_addr, target_cidr=16):
         ip_address = ip_range_to_cidr(ip_addr)
     network = ipaddress.ip_network(ip_address, strict=False)
     subnets = network.subnets(new_prefix=target_cidr)
-    return [str(subnet) for subnet in subnets]
\ No newline at end of file
+    return [str(subnet) for subnet in subnets]
+
+def parse_port_spec(port_spec):
+    """Parse a port list with ranges into a list of ports
+
+    Args:
+        port_spec (str or int): ports and port ranges, e.g. "9200-9205,19200"
+
+    Returns:
+        list: the ports, in the given order and without duplicates
+
+    Raises:
+        ValueError: If a port is out of range or malformed.
+
+    Example:
+        >>> parse_port_spec("9200-9202,19200")
+        [9200, 9201, 9202, 19200]
+    """
+    if isinstance(port_spec, int):
+        port_spec = str(port_spec)
+    ports = dict()
+    for part in port_spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = (int(port) for port in part.split('-', 1))
+        else:
+            start = end = int(part)
+        if not 0 < start <= end <= 65535:
+            raise ValueError(f"Invalid port range: {part}")
+        for port in range(start, end + 1):
+            ports[port] = None
+    if not ports:
+        raise ValueError(f"No ports in: {port_spec}")
+    return list(ports)
+
+def iter_targets(ip_list, ports, block_size=4096):
+    """Lazily expand IP addresses and ports into (ip, port) targets
+
+    Targets are interleaved so that consecutive connects go to different
+    hosts: every port of a block of `block_size` hosts is scanned before
+    moving on to the next block.
+
+    Args:
+        ip_list (iterable): IP addresses to scan
+        ports (list): ports to scan on every IP address
+        block_size (int, optional): hosts per block. Defaults to 4096.
+
+    Yields:
+        tuple: (ip, port)
+    """
+    block = []
+    for ip in ip_list:
+        block.append(str(ip))
+        if len(block) == block_size:
+            for port in ports:
+                for block_ip in block:
+                    yield block_ip, port
+            block = []
+    for port in ports:
+        for block_ip in block:
+            yield block_ip, port
+
+
+def ip_to_int(ip):
+    """Convert a dotted IPv4 address to an integer
+
+    Raises:
+        ValueError: If the address is malformed.
+    """
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip.strip()), 'big')
+    except OSError:
+        raise ValueError(f"Invalid IPv4 address: {ip}") from None
+
+
+def int_to_ip(ip_int):
+    """Convert an integer back to a dotted IPv4 address"""
+    return socket.inet_ntoa(struct.pack('!I', ip_int))
+
+
+def parse_target(target):
+    """Parse a single IP address, CIDR range or dashed range
+
+    Returns:
+        tuple: first and last address of the range, as integers
+
+    Raises:
+        ValueError: If the target is malformed.
+
+    Example:
+        >>> parse_target("10.0.0.0/30")
+        (167772160, 167772163)
+    """
+    target = target.strip()
+    if '/' in target:
+        ip, prefix = target.split('/', 1)
+        if not prefix.isdigit() or int(prefix) > 32:
+            raise ValueError(f"Invalid CIDR range: {target}")
+        host_bits = 0xffffffff >> int(prefix)
+        start = ip_to_int(ip) & ~host_bits & 0xffffffff
+        return start, start | host_bits
+    if '-' in target:
+        start, end = (ip_to_int(ip) for ip in target.split('-', 1))
+        if start > end:
+            raise ValueError(f"Invalid IP range: {target}")
+        return start, end
+    ip_int = ip_to_int(target)
+    return ip_int, ip_int
+
+
+def iter_target_lines(lines, source="<targets>"):
+    """Lazily parse targets, one per line. Blank lines and `#` comments are skipped.
+
+    Args:
+        lines (iterable): lines of text
+        source (str, optional): name of the input, for error messages
+
+    Yields:
+        tuple: first and last address of each range, as integers
+
+    Raises:
+        ValueError: If a line is malformed, naming the source and line number.
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            yield parse_target(line)
+        except ValueError as ex:
+            raise ValueError(f"{source}:{line_number}: {ex}") from None
+
+
+def iter_target_file(path):
+    """Lazily parse a file of targets, `-` for stdin (see `iter_target_lines`)"""
+    if path == '-':
+        yield from iter_target_lines(sys.stdin, "<stdin>")
+        return
+    with open(path, encoding='utf8') as target_file:
+        yield from iter_target_lines(target_file, path)
+
+
+def merge_keys(keys):
+    """Merge the overlapping and adjacent ranges of sorted `start << 32 | end` keys"""
+    start = end = None
+    for key in keys:
+        key_start, key_end = key >> 32, key & 0xffffffff
+        if end is not None and key_start <= end + 1:
+            if key_end > end:
+                end = key_end
+        else:
+            if end is not None:
+                yield start << 32 | end
+            start, end = key_start, key_end
+    if end is not None:
+        yield start << 32 | end
+
+
+class IntervalSet:
+    """A set of IPv4 addresses, stored as sorted, merged ranges of integers.
+
+    Overlapping and adjacent ranges are merged, so duplicates cost nothing
+    and memory grows with the number of distinct ranges rather than
+    addresses. Excluding addresses subtracts ranges in a single merge pass,
+    and iterating yields the addresses lazily:
+
+    ```
+    targets = IntervalSet.from_intervals(iter_target_file("estate.txt"))
+    targets -= IntervalSet.from_intervals(iter_target_file("exclude.txt"))
+    for ip in targets:
+        ...
+    ```
+
+    Args:
+        starts (array, optional): first address of every range, sorted
+        ends (array, optional): last address of every range
+    """
+    def __init__(self, starts=None, ends=None):
+        self.starts = starts if starts is not None else array('L')
+        self.ends = ends if ends is not None else array('L')
+        self.size = sum(self.ends) - sum(self.starts) + len(self.starts)
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """Build the set from (first, last) integer ranges in any order
+
+        Ranges are sorted `RUN_SIZE` at a time and merged into compact runs,
+        which are then merged together, so a large target file is never
+        held as one list of ranges.
+        """
+        intervals = iter(intervals)
+        runs = []
+        while True:
+            # One int per range sorts by start, then end, without a tuple per range
+            keys = sorted(start << 32 | end for start, end in itertools.islice(intervals, RUN_SIZE))
+            if not keys:
+                break
+            runs.append(array('Q', merge_keys(keys)))
+            if len(runs) == MAX_RUNS:
+                runs = [array('Q', merge_keys(heapq.merge(*runs)))]
+        starts, ends = array('L'), array('L')
+        for key in merge_keys(heapq.merge(*runs)):
+            starts.append(key >> 32)
+            ends.append(key & 0xffffffff)
+        return cls(starts, ends)
+
+    @classmethod
+    def from_targets(cls, targets):
+        """Build the set from IP addresses, CIDR ranges and dashed ranges"""
+        return cls.from_intervals(parse_target(target) for target in targets)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        pack = struct.Struct('!I').pack
+        ntoa = socket.inet_ntoa
+        for start, end in zip(self.starts, self.ends):
+            for ip_int in range(start, end + 1):
+                yield ntoa(pack(ip_int))
+
+    def __sub__(self, other):
+        """The addresses of this set that aren't in `other`"""
+        starts, ends = array('L'), array('L')
+        other_starts, other_ends = other.starts, other.ends
+        count = len(other_starts)
+        first = 0
+        for start, end in zip(self.starts, self.ends):
+            # Skip the exclusions that end before this range
+            while first < count and other_ends[first] < start:
+                first += 1
+            index = first
+            while index < count and other_starts[index] <= end:
+                if other_starts[index] > start:
+                    starts.append(start)
+                    ends.append(other_starts[index] - 1)
+                start = max(start, other_ends[index] + 1)
+                if start > end:
+                    break
+                index += 1
+            if start <= end:
+                starts.append(start)
+                ends.append(end)
+        return IntervalSet(starts, ends)
+
+    def ranges(self):
+        """Yield every range as a (first, last) pair of dotted addresses"""
+        for start, end in zip(self.starts, self.ends):
+            yield int_to_ip(start), int_to_ip(end)
+
+    def chunks(self, chunk_size):
+        """Split the set into consecutive sets of at most `chunk_size` addresses
+
+        Yields:
+            IntervalSet: the next chunk
+        """
+        starts, ends = array('L'), array('L')
+        room = chunk_size
+        for start, end in zip(self.starts, self.ends):
+            while start <= end:
+                last = min(end, start + room - 1)
+                starts.append(start)
+                ends.append(last)
+                room -= last - start + 1
+                start = last + 1
+                if not room:
+                    yield IntervalSet(starts, ends)
+                    starts, ends = array('L'), array('L')
+                    room = chunk_size
+        if starts:
+            yield IntervalSet(starts, ends)
+
+
+def target_set(targets):
+    """An IntervalSet from an IntervalSet, a single target string or an iterable of them"""
+    if isinstance(targets, IntervalSet):
+        return targets
+    if isinstance(targets, str):
+        targets = [targets]
+    return IntervalSet.from_targets(targets)
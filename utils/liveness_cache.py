@@ -0,0 +1,223 @@
+# Liveness Cache
+"""Remember which ip:port targets were open or closed on earlier scans.
+
+Most of a routinely scanned range stays dark from one run to the next,
+and the few open hosts stay open. `LivenessCache` keeps, for every
+target ever scanned, the last time it was seen open and the last time it
+was seen closed, so a rescan can skip targets that were closed less than
+a TTL ago and connect to the known open ones first.
+
+The cache is a single file of three sorted columns, memory-mapped and
+searched in place, so opening even a cache of millions of targets
+costs nothing:
+
+```
+header   magic, version, count           16 bytes
+keys     ip << 16 | port, sorted          8 bytes * count
+opened   last seen open, epoch seconds    4 bytes * count
+closed   last seen closed, epoch seconds  4 bytes * count
+```
+
+New results are kept in memory as plain key arrays and merged into a
+new file by `save`, which replaces the old one atomically. Long runs
+call `checkpoint` as they go, which only saves once enough results are
+recorded.
+"""
+import heapq
+import mmap
+import os
+import re
+import struct
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from utils.ip_utils import ip_to_int, int_to_ip
+
+MAGIC = b"EHLC"
+VERSION = 1
+# Native byte order, the cache is only read by the machine that wrote it
+HEADER = struct.Struct("=4sIQ")
+DEFAULT_CACHE_FILE = os.path.join("~", ".cache", "elastichunt", "liveness.bin")
+# Results kept in memory before `checkpoint` merges them into the file
+SAVE_THRESHOLD = 1 << 20
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(duration):
+    """Parse a duration like "90", "30m", "12h" or "7d" into seconds
+
+    Raises:
+        ValueError: If the duration is malformed.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*", str(duration).lower())
+    if not match:
+        raise ValueError(f"Invalid duration: {duration}. Use e.g. 90, 30m, 12h or 7d")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or "s"]
+
+
+def target_key(ip_int, port):
+    return ip_int << 16 | port
+
+
+class LivenessCache:
+    """The open/closed history of scanned targets, stored in `path`.
+
+    Args:
+        path (str): cache file, created on the first `save`
+        ttl (float): seconds a target seen closed is skipped for
+    """
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.now = int(time.time())
+        self.opened = array("Q")
+        self.closed = array("Q")
+        self._file = self._map = None
+        self.count = 0
+        self.keys = self.opened_at = self.closed_at = ()
+        self._load()
+
+    def _load(self):
+        try:
+            self._file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        if os.fstat(self._file.fileno()).st_size < HEADER.size:
+            self.close()
+            return
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or len(self._map) != HEADER.size + 16 * count:
+            raise ValueError(f"{self.path} is not a liveness cache, or is damaged")
+        view = memoryview(self._map)
+        keys_end = HEADER.size + 8 * count
+        self.count = count
+        self.keys = view[HEADER.size:keys_end].cast("Q")
+        self.opened_at = view[keys_end:keys_end + 4 * count].cast("I")
+        self.closed_at = view[keys_end + 4 * count:].cast("I")
+
+    def close(self):
+        """Unmap the cache file. Results not saved yet are kept."""
+        for column in (self.keys, self.opened_at, self.closed_at):
+            if isinstance(column, memoryview):
+                column.release()
+        self.keys = self.opened_at = self.closed_at = ()
+        self.count = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, ip, port):
+        """When a target was last seen open and closed
+
+        Returns:
+            tuple: (opened, closed) in epoch seconds, 0 for never, or None if
+                the target was never scanned
+        """
+        key = target_key(ip if isinstance(ip, int) else ip_to_int(ip), port)
+        position = bisect_left(self.keys, key)
+        if position < self.count and self.keys[position] == key:
+            return self.opened_at[position], self.closed_at[position]
+        return None
+
+    def is_known_open(self, opened, closed):
+        """Whether a target was open the last time it was scanned"""
+        return opened > closed
+
+    def is_recently_closed(self, opened, closed):
+        """Whether a target was closed the last time it was scanned, within the TTL"""
+        return closed > opened and self.now - closed < self.ttl
+
+    def select(self, targets, ports):
+        """Sort the cached targets of a scan
+
+        Args:
+            targets (ip_utils.IntervalSet): addresses to scan
+            ports (list): ports to scan on every address
+
+        Returns:
+            tuple: the known open (ip, port) targets, to scan first, and the
+                number of targets `skip` will leave out of the full pass
+        """
+        ports = set(ports)
+        known_open = []
+        skipped = 0
+        for start, end in zip(targets.starts, targets.ends):
+            low = bisect_left(self.keys, target_key(start, 0))
+            high = bisect_right(self.keys, target_key(end, 0xffff))
+            for position in range(low, high):
+                port = self.keys[position] & 0xffff
+                if port not in ports:
+                    continue
+                opened, closed = self.opened_at[position], self.closed_at[position]
+                if self.is_known_open(opened, closed):
+                    known_open.append((int_to_ip(self.keys[position] >> 16), port))
+                    skipped += 1
+                elif self.is_recently_closed(opened, closed):
+                    skipped += 1
+        return known_open, skipped
+
+    def skip(self, ip, port):
+        """Whether the full pass leaves a target out: it was either scanned
+        first as known open, or was closed within the TTL"""
+        seen = self.lookup(ip, port)
+        return seen is not None and (self.is_known_open(*seen) or self.is_recently_closed(*seen))
+
+    def record(self, ip, port, is_open):
+        """Remember the result of a connect, until `save`"""
+        key = target_key(ip_to_int(ip), port)
+        (self.opened if is_open else self.closed).append(key)
+
+    def _records(self):
+        """Every target with its (opened, closed) times, old and new, sorted by key"""
+        old = ((self.keys[position], self.opened_at[position], self.closed_at[position])
+               for position in range(self.count))
+        new_opened = ((key, self.now, 0) for key in sorted(set(self.opened)))
+        new_closed = ((key, 0, self.now) for key in sorted(set(self.closed)))
+        record = None
+        for key, opened, closed in heapq.merge(old, new_opened, new_closed):
+            if record is not None and record[0] == key:
+                record = (key, max(record[1], opened), max(record[2], closed))
+                continue
+            if record is not None:
+                yield record
+            record = (key, opened, closed)
+        if record is not None:
+            yield record
+
+    def checkpoint(self):
+        """Save once `SAVE_THRESHOLD` results are recorded
+
+        Every save rewrites the whole file, so scans that run in stages
+        checkpoint after each stage and `save` once at the end.
+        """
+        if len(self.opened) + len(self.closed) >= SAVE_THRESHOLD:
+            self.save()
+
+    def save(self):
+        """Merge the recorded results into the cache file, and map the new file"""
+        if not self.opened and not self.closed:
+            return
+        keys, opened_at, closed_at = array("Q"), array("I"), array("I")
+        for key, opened, closed in self._records():
+            keys.append(key)
+            opened_at.append(opened)
+            closed_at.append(closed)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(HEADER.pack(MAGIC, VERSION, len(keys)))
+            for column in (keys, opened_at, closed_at):
+                column.tofile(cache_file)
+        self.close()
+        os.replace(temp_path, self.path)
+        self.opened, self.closed = array("Q"), array("Q")
+        self._load()
@@ -0,0 +1,177 @@
+# Memory Budget
+"""Keep a whole run within a fixed amount of memory.
+
+Most of the memory of a large run goes to work in flight: decoded pages
+of hits waiting to be written, probe tasks and their sessions, and
+connects of the scanner. A `MemoryBudget` splits a limit between them:
+
+- pages: a `ByteGate` admits a page only while the estimated bytes of
+  every page in flight, across all downloads, fit in `PAGE_SHARE` of
+  the limit. Pages are also made smaller when a full one wouldn't fit.
+  The bytes of a hit start out as a guess and follow the size of the
+  pages actually read.
+- probes and connects: fixed caps on how many run at once, derived
+  from their share of the limit.
+
+On top of the estimates, producers wait while the resident set size of
+the process is over `HIGH_WATER` of the limit and pages are still in
+flight, whose writing will free memory:
+
+```
+budget = MemoryBudget(core.parse_size("2gb"))
+nbytes = await budget.acquire_page(size)
+try:
+    hits, body_bytes = await read_page()
+    budget.observe_page(body_bytes, len(hits))
+    write(hits)
+finally:
+    budget.release_page(nbytes)
+```
+
+The resident set size is read from /proc/self/statm. Where it isn't
+available only the estimates apply.
+"""
+import asyncio
+import collections
+import os
+import time
+
+# Shares of the limit for each kind of work
+PAGE_SHARE = 0.5
+PROBE_SHARE = 0.1
+CONNECT_SHARE = 0.05
+# Estimated memory of a decoded hit until pages are read, a probe and a connect, in bytes
+HIT_BYTES = 4096
+PROBE_BYTES = 256 * 1024
+CONNECT_BYTES = 8 * 1024
+# Bounds of the probe and connect caps
+MIN_PROBES, MAX_PROBES = 4, 4096
+MIN_CONNECTS, MAX_CONNECTS = 16, 65536
+# Memory of a decoded hit per byte of its JSON
+DECODED_RATIO = 4
+# Weight of the latest page in the estimated bytes of a hit
+HIT_BYTES_WEIGHT = 0.25
+# Smallest page a budget shrinks pages to, in hits
+MIN_PAGE_SIZE = 100
+# Resident set size, as a fraction of the limit, above which producers wait
+HIGH_WATER = 0.9
+# Seconds a reading of the resident set size is reused for
+RSS_INTERVAL = 0.25
+
+
+def clamp(value, lowest, highest):
+    return max(lowest, min(value, highest))
+
+
+def rss_bytes():
+    """Resident set size of the process in bytes, None where it can't be read"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class ByteGate:
+    """Admits work while the bytes in flight stay under a capacity.
+
+    Work is always admitted when nothing else is in flight, so an item
+    larger than the capacity goes through on its own instead of never.
+
+    Args:
+        capacity (int): bytes allowed in flight
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self, nbytes):
+        while self.in_flight and self.in_flight + nbytes > self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += nbytes
+
+    def release(self, nbytes):
+        self.in_flight -= nbytes
+        # Every waiter checks again whether it fits now
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class MemoryBudget:
+    """How much work of each kind may be in flight under a memory limit.
+
+    Args:
+        limit (int): memory limit of the run in bytes
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.pages = ByteGate(int(limit * PAGE_SHARE))
+        self.probe_limit = clamp(int(limit * PROBE_SHARE) // PROBE_BYTES,
+                                 MIN_PROBES, MAX_PROBES)
+        self.connect_limit = clamp(int(limit * CONNECT_SHARE) // CONNECT_BYTES,
+                                   MIN_CONNECTS, MAX_CONNECTS)
+        # Estimated memory of a decoded hit, corrected by every page read
+        self.hit_bytes = HIT_BYTES
+        self.pages_observed = 0
+        self._rss = None
+        self._rss_time = None
+
+    def rss(self):
+        """The resident set size, read at most every RSS_INTERVAL seconds"""
+        now = time.monotonic()
+        if self._rss_time is None or now - self._rss_time >= RSS_INTERVAL:
+            self._rss, self._rss_time = rss_bytes(), now
+        return self._rss
+
+    def over_limit(self):
+        """Whether the resident set size is near the limit"""
+        rss = self.rss()
+        return rss is not None and rss > self.limit * HIGH_WATER
+
+    async def throttle(self):
+        """Wait while the process is near the limit and pages in flight can still free memory
+
+        Freed memory isn't always given back to the system, so with nothing
+        in flight there is nothing to wait for.
+        """
+        while self.over_limit() and self.pages.in_flight:
+            await asyncio.sleep(RSS_INTERVAL)
+
+    def observe_page(self, nbytes, hits):
+        """Correct the estimated bytes of a hit with a page of `hits` whose
+        response body was `nbytes` long"""
+        if not hits:
+            return
+        sample = nbytes * DECODED_RATIO / hits
+        if self.pages_observed:
+            sample = self.hit_bytes * (1 - HIT_BYTES_WEIGHT) + sample * HIT_BYTES_WEIGHT
+        self.hit_bytes = max(int(sample), 1)
+        self.pages_observed += 1
+
+    def page_size(self, size):
+        """The largest number of hits per page, up to `size`, whose page fits the budget"""
+        return min(size, max(self.pages.capacity // self.hit_bytes, MIN_PAGE_SIZE))
+
+    async def acquire_page(self, size):
+        """Wait for room for a page of `size` hits
+
+        Returns:
+            int: the bytes taken, to give back with `release_page`
+        """
+        await self.throttle()
+        nbytes = size * self.hit_bytes
+        await self.pages.acquire(nbytes)
+        return nbytes
+
+    def release_page(self, nbytes):
+        """Give back the room of a page once it is written"""
+        self.pages.release(nbytes)
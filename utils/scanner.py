@@ -1,66 +1,253 @@
 # Python Port Scanner
-import socket
+import errno
 import logging
+import math
+import queue
+import selectors
+import socket
 import threading
+import time
 
-from ip_utils import ip_range_to_list
+from utils.ip_utils import target_set
 
 logger  = logging.getLogger('Scanner')
 logging.basicConfig(level=logging.INFO)
 
-def thread_scanner(IpScanner, thread_id, ips):
-    for ip in ips:
-        IpScanner.scan_ip(ip)
-    logger.info(f"Thread {thread_id} finished scanning.")
+# connect_ex results that mean "connection in progress"
+CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                       getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+# Errors that mean we ran out of sockets and should retry later
+OUT_OF_SOCKETS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS}
+
+
+class TimerWheel(object):
+    """Hashed timer wheel.
+
+    Timers are dropped into the slot their deadline falls in, so scheduling,
+    cancelling and expiring are all O(1) no matter how many connects are in
+    flight. Deadlines are rounded up to the next tick.
+
+    Every timer keeps its absolute deadline. The wheel only moves when
+    `advance` is called, so a timer scheduled while it lags behind the clock
+    may come up before its deadline; it is then put back in the slot of the
+    time it has left instead of expiring early.
+    """
+
+    def __init__(self, timeout, tick=0.05):
+        self.timeout = timeout
+        self.tick = tick
+        # One extra slot so a timer never lands in the slot being expired
+        self.slots = [dict() for _ in range(int(math.ceil(timeout / tick)) + 1)]
+        self.timeout_slots = len(self.slots) - 1
+        self.current = 0
+        self.last_tick = time.monotonic()
+        # Slot of every timer, by key
+        self.timers = dict()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def _add(self, key, value, deadline):
+        ticks = math.ceil((deadline - self.last_tick) / self.tick)
+        slot = (self.current + min(max(ticks, 1), self.timeout_slots)) % len(self.slots)
+        self.slots[slot][key] = (deadline, value)
+        self.timers[key] = slot
+
+    def schedule(self, key, value, now=None):
+        """Start a timer that expires `timeout` seconds after `now`"""
+        if now is None:
+            now = time.monotonic()
+        self._add(key, value, now + self.timeout)
+
+    def cancel(self, key):
+        """Stop a timer"""
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self, now):
+        """Move the wheel up to `now` and return the expired (key, value) pairs"""
+        expired = []
+        early = []
+        while now - self.last_tick >= self.tick:
+            self.last_tick += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            for key, (deadline, value) in slot.items():
+                if deadline > now:
+                    early.append((key, value, deadline))
+                else:
+                    del self.timers[key]
+                    expired.append((key, value))
+            slot.clear()
+        for key, value, deadline in early:
+            self._add(key, value, deadline)
+        return expired
+
 
 class Scanner(object):
     """Scanner Class.
-    This class is used to create a Scanner (wow!)
+    Non-blocking connect scanner for when asyncio is not an option.
+
+    Every thread runs its own selector and keeps up to `max_inflight`
+    non-blocking connects in flight; connects that don't complete within
+    `timeout` are expired by a timer wheel. Open ports are collected in
+    `potential_dbs`, and can be streamed through `callback` or `iter_scan()`.
     """
 
     SOCKET_FAMILY = socket.AF_INET
     SOCKET_KIND = socket.SOCK_STREAM
+    # Targets a thread takes from the shared target iterator at once
+    BATCH_SIZE = 256
 
-    def __init__(self, ipaddr, port, timeout=1, threads=4):
-        self.ipaddr = ip_range_to_list(ipaddr)
+    def __init__(self, ipaddr, port, timeout=1, threads=4, max_inflight=1024, callback=None):
+        # An ip_utils.IntervalSet, so addresses are only expanded as they are scanned
+        self.ipaddr = target_set(ipaddr)
         self.timeout = timeout
         self.threads = threads
         self.port = port
-        
+        self.max_inflight = max_inflight
+        self.callback = callback
+
         self.potential_dbs = list()
+        self.scanned = 0
+        self._targets = None
+        self._lock = threading.Lock()
+
+    def targets(self):
+        """Yield the (ip, port) pairs to scan"""
+        for ip in self.ipaddr:
+            yield str(ip), self.port
+
+    def next_batch(self):
+        """Take the next batch of targets from the shared iterator"""
+        with self._lock:
+            batch = []
+            for target in self._targets:
+                batch.append(target)
+                if len(batch) == Scanner.BATCH_SIZE:
+                    break
+            return batch
+
+    def report(self, ip, port, is_open):
+        """Record the outcome of a connect"""
+        with self._lock:
+            self.scanned += 1
+            if is_open:
+                self.potential_dbs.append(f"http://{ip}:{port}")
+        if is_open and self.callback:
+            self.callback(ip, port)
 
     def scan_ip(self, ip):
+        """Scan a single IP with a blocking connect"""
         scanning_socket = socket.socket(Scanner.SOCKET_FAMILY, Scanner.SOCKET_KIND)
         scanning_socket.settimeout(self.timeout)
-        logging.info(f"Scanning {ip}:{self.port}")
+        try:
+            scanning_result = scanning_socket.connect_ex((str(ip), self.port))
+        finally:
+            scanning_socket.close()
+        self.report(ip, self.port, scanning_result == 0)
 
-        scanning_result = scanning_socket.connect_ex((str(ip), self.port))
-        if scanning_result == 0:
-            self.potential_dbs.append(f"{ip}:{self.port}")
-        scanning_socket.close()
+    def scan_worker(self, thread_id):
+        """Keep connects in flight until every target has been scanned"""
+        selector = selectors.DefaultSelector()
+        # Sockets of the connects in flight, each with its timer
+        wheel = TimerWheel(self.timeout)
+        pending = []
+        exhausted = False
 
-    def run_scan(self):
-        num_ips = len(self.ipaddr)
-        if num_ips == 0:
-            return
+        def finish(scanning_socket, target, is_open):
+            selector.unregister(scanning_socket)
+            scanning_socket.close()
+            self.report(*target, is_open)
 
-        ips_per_thread = max(num_ips // self.threads, 1)
-        num_threads = min(num_ips, self.threads)
+        try:
+            while True:
+                # Top up the connects in flight
+                while len(wheel) < self.max_inflight:
+                    if not pending:
+                        if exhausted:
+                            break
+                        pending = self.next_batch()
+                        pending.reverse()
+                        if not pending:
+                            exhausted = True
+                            break
+                    target = pending[-1]
+                    try:
+                        scanning_socket = socket.socket(Scanner.SOCKET_FAMILY,
+                                                        Scanner.SOCKET_KIND)
+                    except OSError as err:
+                        if err.errno in OUT_OF_SOCKETS and wheel:
+                            break
+                        raise
+                    pending.pop()
+                    scanning_socket.setblocking(False)
+                    result = scanning_socket.connect_ex(target)
+                    if result in CONNECT_IN_PROGRESS:
+                        selector.register(scanning_socket, selectors.EVENT_WRITE, target)
+                        # From the time of the connect, however long topping up takes
+                        wheel.schedule(scanning_socket, target)
+                    else:
+                        scanning_socket.close()
+                        self.report(*target, result == 0)
 
-        threads = []
-        for thread_id in range(num_threads):
-            if thread_id == num_threads - 1:
-                ip_addrs = self.ipaddr[thread_id * ips_per_thread]
-            else:
-                ip_addrs = self.ipaddr[thread_id * ips_per_thread: (thread_id + 1) * ips_per_thread]
-            if not isinstance(ip_addrs, list):
-                ip_addrs = [ip_addrs]
+                if not wheel:
+                    if exhausted:
+                        break
+                    continue
 
-            scan_thread = threading.Thread(target=thread_scanner, args=(self, thread_id, ip_addrs))
-            threads.append(scan_thread)
+                for key, _ in selector.select(timeout=wheel.tick):
+                    scanning_socket = key.fileobj
+                    wheel.cancel(scanning_socket)
+                    result = scanning_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    finish(scanning_socket, key.data, result == 0)
+
+                for scanning_socket, target in wheel.advance(time.monotonic()):
+                    finish(scanning_socket, target, False)
+        finally:
+            for scanning_socket in wheel.timers:
+                scanning_socket.close()
+            selector.close()
+        logger.info(f"Thread {thread_id} finished scanning.")
+
+    def run_scan(self):
+        """Scan every target, blocking until done"""
+        self._targets = self.targets()
+        threads = [threading.Thread(target=self.scan_worker, args=(thread_id,))
+                   for thread_id in range(max(self.threads, 1))]
 
         for scan in threads:
             scan.start()
 
         for scan in threads:
             scan.join()
+
+    def iter_scan(self):
+        """Scan every target in the background, yielding (ip, port) as ports are found open"""
+        results = queue.Queue()
+        done = object()
+        callback = self.callback
+
+        def collect(ip, port):
+            results.put((ip, port))
+            if callback:
+                callback(ip, port)
+
+        def run():
+            try:
+                self.run_scan()
+            finally:
+                results.put(done)
+
+        self.callback = collect
+        scan_thread = threading.Thread(target=run, daemon=True)
+        scan_thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    break
+                yield result
+        finally:
+            self.callback = callback